@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Round trips and time to update, save and delete a set of rows, one
+# save() or delete() per object versus update_many(), save_all() and
+# delete_many(), on the inline and the threaded SQLite backends.
+#
+#   python benchmarks/bulk.py [nrows]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class items(txdbapi.DatabaseModel):
+    pass
+
+
+@defer.inlineCallbacks
+def populate(nrows):
+    yield items.delete()
+    objs = yield items.insert_many([dict(name="item-%d" % n, n=n)
+                                    for n in xrange(nrows)])
+    defer.returnValue(objs)
+
+
+@defer.inlineCallbacks
+def loop_update(objs):
+    for obj in objs:
+        obj.n += 1
+        yield obj.save()
+
+
+def bulk_update(objs):
+    return items.update_many(objs, n=0)
+
+
+@defer.inlineCallbacks
+def loop_save(objs):
+    for obj in objs:
+        obj.name = obj.name.upper()
+        obj.n = -obj.n
+        yield obj.save()
+
+
+def bulk_save(objs):
+    for obj in objs:
+        obj.name = obj.name.lower()
+        obj.n = -obj.n
+    return items.save_all(objs)
+
+
+@defer.inlineCallbacks
+def loop_delete(objs):
+    for obj in objs:
+        yield obj.delete()
+
+
+def bulk_delete(objs):
+    return items.delete_many(objs)
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+        db.runOperation("create table items "
+                        "(id integer primary key, name text, n int)")
+        db.close()
+
+        for inline in (True, False):
+            items.db = db = txdbapi.ConnectionPool("sqlite3", dbname,
+                                                   inline=inline)
+            stats = db.instrument()
+            for op, loop, bulk in (("update", loop_update, bulk_update),
+                                   ("save", loop_save, bulk_save),
+                                   ("delete", loop_delete, bulk_delete)):
+                for name, run in (("loop", loop), ("bulk", bulk)):
+                    objs = yield populate(nrows)
+                    stats.reset()
+                    started = time.time()
+                    yield run(objs)
+                    print "%-8s %-6s %-4s rows=%d calls=%-6d %.4fs" % (
+                        inline and "inline" or "threaded", op, name, nrows,
+                        stats.calls, time.time() - started)
+            db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
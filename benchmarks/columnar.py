@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Rows/sec and peak memory of summing two numeric columns over a table,
+# from select() objects, select(raw=True) rows and select(as_columns=True)
+# arrays, on the inline and the threaded SQLite backends. Each run is a
+# process of its own, so that its peak RSS is its own.
+#
+#   python benchmarks/columnar.py [nrows]
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class metrics(txdbapi.DatabaseModel):
+    pass
+
+
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table metrics (id integer primary key, "
+                    "host text, hits int, load real)")
+    for n in xrange(0, nrows, 10000):
+        db.runOperationMany(
+            "insert into metrics (host, hits, load) values (%s, %s, %s)",
+            [("host-%d" % (i % 100), i, i / 3.0)
+             for i in xrange(n, min(nrows, n + 10000))])
+    db.close()
+
+
+@defer.inlineCallbacks
+def objects():
+    objs = yield metrics.select()
+    defer.returnValue((sum([obj.hits for obj in objs]),
+                       sum([obj.load for obj in objs]), len(objs)))
+
+
+@defer.inlineCallbacks
+def raw():
+    rs = yield metrics.select(raw=True)
+    defer.returnValue((sum([r["hits"] for r in rs]),
+                       sum([r["load"] for r in rs]), len(rs)))
+
+
+@defer.inlineCallbacks
+def columns():
+    cols = yield metrics.select(as_columns=True, batch_size=10000)
+    defer.returnValue((sum(cols["hits"]), sum(cols["load"]),
+                       len(cols["id"])))
+
+
+@defer.inlineCallbacks
+def child(dbname, backend, mode):
+    metrics.db = txdbapi.ConnectionPool("sqlite3", dbname,
+                                        inline=backend == "inline")
+    try:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        hits, load, nrows = yield globals()[mode]()
+        elapsed = time.time() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print "%-8s %-8s rows=%d %10.0f rows/s  peak=+%dkB  sum=%d/%.0f" % (
+            backend, mode, nrows, nrows / elapsed, peak - base, hits, load)
+    finally:
+        metrics.db.close()
+        reactor.stop()
+
+
+def main():
+    if len(sys.argv) == 4:
+        reactor.callWhenRunning(child, *sys.argv[1:])
+        reactor.run()
+        return
+
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        populate(dbname, nrows)
+        for backend in ("inline", "threaded"):
+            for mode in ("objects", "raw", "columns"):
+                subprocess.call([sys.executable, os.path.abspath(__file__),
+                                 dbname, backend, mode])
+    finally:
+        os.unlink(dbname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Time per count() on a large table: exact select count(*), with the
+# model's count cache, and approximate from the planner statistics
+# (sqlite_stat1, after ANALYZE), on the threaded SQLite backend.
+#
+#   python benchmarks/count.py [nrows] [ncounts]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table items "
+                    "(id integer primary key, name text, qty int)")
+    db.runOperation("create index items_qty on items (qty)")
+    db.runOperationMany("insert into items (name, qty) values (%s, %s)",
+                        [("item-%d" % n, n % 100) for n in xrange(nrows)])
+    db.runOperation("analyze")
+    db.close()
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ncounts = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        populate(dbname, nrows)
+        db = txdbapi.ConnectionPool("sqlite3", dbname)
+
+        class items(txdbapi.DatabaseModel):
+            pass
+
+        items.db = db
+        for name, ttl, kwargs in (("exact", None, {}),
+                                  ("cached", 5, {}),
+                                  ("approximate", None,
+                                   {"approximate": True})):
+            items.count_cache_ttl = ttl
+            started = time.time()
+            for n in xrange(ncounts):
+                total = yield items.count(**kwargs)
+            elapsed = time.time() - started
+            print "%-11s count=%d %.6fs per count" % (name, total,
+                                                      elapsed / ncounts)
+        db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
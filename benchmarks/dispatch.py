@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Per-call overhead of the CRUD hot paths on an in-memory SQLite, where
+# the database itself costs the least: building a select, converting its
+# placeholders, and full find_first/insert calls.
+#
+#   python benchmarks/dispatch.py [ncalls]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+
+class asd(txdbapi.DatabaseModel):
+    db = txdbapi.ConnectionPool("sqlite3", ":memory:")
+
+
+def bench(label, ncalls, f, *args, **kwargs):
+    started = time.time()
+    for n in xrange(ncalls):
+        f(*args, **kwargs)
+    elapsed = time.time() - started
+    print "%-14s %7.2fus/call" % (label, elapsed / ncalls * 1e6)
+
+
+def main():
+    ncalls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    asd.db.runOperation("create table asd "
+                        "(id integer primary key, age int, name text)")
+    asd.db.runOperation("insert into asd (age, name) values (1, 'foo')")
+
+    q, args = asd._select_query({"where": ("id=%s", 1), "limit": 1})
+    bench("select_query", ncalls, asd._select_query,
+          {"where": ("id=%s", 1), "limit": 1})
+    bench("convert", ncalls, asd.db._convert, q)
+    bench("find_first", ncalls / 10, asd.find_first, where=("id=%s", 1))
+    bench("insert", ncalls / 10, asd.insert, age=2, name="bar")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Queries and end-to-end latency of a fan-out of primary-key lookups
+# made in the same reactor turn, one find_first() per lookup versus
+# load(), on the inline and the threaded SQLite backends.
+#
+#   python benchmarks/loader.py [nlookups] [nrows]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class users(txdbapi.DatabaseModel):
+    pass
+
+
+def find_first(ids):
+    return defer.gatherResults([users.find_first(where=("id=%s", id))
+                                for id in ids])
+
+
+def load(ids):
+    return defer.gatherResults([users.load(id) for id in ids])
+
+
+@defer.inlineCallbacks
+def main():
+    nlookups = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    nrows = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+        db.runOperation("create table users "
+                        "(id integer primary key, name text)")
+        db.runOperationMany("insert into users (name) values (%s)",
+                            [("user-%d" % n,) for n in xrange(nrows)])
+        db.close()
+
+        # some ids repeat, as when handlers look up the same user
+        ids = [random.randint(1, nrows) for n in xrange(nlookups)]
+        for inline in (True, False):
+            users.db = db = txdbapi.ConnectionPool("sqlite3", dbname,
+                                                   inline=inline)
+            stats = db.instrument()
+            for name, run in (("find_first", find_first), ("load", load)):
+                stats.reset()
+                started = time.time()
+                objs = yield run(ids)
+                assert [obj.id for obj in objs] == ids
+                print "%-8s %-10s lookups=%d queries=%-4d %.4fs" % (
+                    inline and "inline" or "threaded", name, nlookups,
+                    stats.calls, time.time() - started)
+            db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
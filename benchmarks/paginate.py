@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Latency of one page at increasing depths of a file-backed SQLite table,
+# with limit/offset versus paginate()'s seek predicate on (score, id).
+#
+#   python benchmarks/paginate.py [nrows] [page_size]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+
+class big(txdbapi.DatabaseModel):
+    pass
+
+
+def result(d):
+    rs = []
+    d.addBoth(rs.append)
+    return rs[0]
+
+
+def timed(f, *args, **kwargs):
+    started = time.time()
+    for n in xrange(3):
+        rs = result(f(*args, **kwargs))
+    return (time.time() - started) / 3, rs
+
+
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000100
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        big.db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+        big.db.runOperation("create table big "
+                            "(id integer primary key, score int, name text)")
+        big.db.runOperationMany("insert into big (score, name) "
+                                "values (%s, %s)",
+                                [(n % 1000, "name-%d" % n)
+                                 for n in xrange(nrows)])
+        big.db.runOperation("create index big_score on big (score, id)")
+
+        for depth in (10, 10000, 1000000):
+            if depth + page_size > nrows:
+                continue
+
+            # the row right before the page, as a token
+            last = result(big.find_first(orderby="score, id",
+                                         offset=depth - 1))
+            token = big.page_token(last, "score")
+
+            offset, rs = timed(big.select, orderby="score, id",
+                               limit=page_size, offset=depth)
+            seek, (objs, _) = timed(big.paginate, order_by="score",
+                                    after=token, page_size=page_size)
+            assert [o.id for o in rs] == [o.id for o in objs]
+            print "depth=%-8d offset=%.5fs seek=%.5fs" % (depth, offset,
+                                                         seek)
+        big.db.close()
+    finally:
+        os.unlink(dbname)
+
+
+if __name__ == "__main__":
+    main()
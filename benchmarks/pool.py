@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Checkout wait and throughput of an AdbapiPool (over an SQLite file, with
+# each interaction holding its connection for a few milliseconds, as a
+# round trip to a remote database would) for different cp_max under the
+# same concurrent load, as reported by pool_info().
+#
+#   python benchmarks/pool.py [nrequests] [latency_ms]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def interaction(trans, latency):
+    trans.execute("select 1")
+    rs = trans.fetchall()
+    time.sleep(latency)
+    return rs
+
+
+@defer.inlineCallbacks
+def run(dbname, size, nrequests, latency):
+    db = txdbapi.AdbapiPool("sqlite3", dbname, check_same_thread=False,
+                            cp_min=1, cp_max=size, cp_ping=1)
+    db.start()
+    started = time.time()
+    yield defer.gatherResults([db.runInteraction(interaction, latency)
+                               for n in xrange(nrequests)])
+    elapsed = time.time() - started
+    info = db.pool_info()
+    db.close()
+    defer.returnValue((info, elapsed))
+
+
+@defer.inlineCallbacks
+def main():
+    nrequests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2] if len(sys.argv) > 2 else 5) / 1000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        for size in (1, 2, 5, 10, 20):
+            info, elapsed = yield run(dbname, size, nrequests, latency)
+            print "cp_max=%-3d connections=%-3d avg_wait=%.4fs " \
+                  "max_wait=%.4fs %.4fs (%.0f req/s)" % (
+                      size, info["connections"], info["avg_wait"],
+                      info["max_wait"], elapsed, nrequests / elapsed)
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
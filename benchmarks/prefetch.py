@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Queries and time to load a set of users and then their phones, one
+# find_first per user versus select(prefetch=["phone"]), on the inline
+# and the threaded SQLite backends.
+#
+#   python benchmarks/prefetch.py [nusers] [nphones]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nusers, nphones):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table phones "
+                    "(id integer primary key, model text)")
+    db.runOperation("create table users "
+                    "(id integer primary key, name text, phone int)")
+    db.runOperationMany("insert into phones (model) values (%s)",
+                        [("model-%d" % n,) for n in xrange(nphones)])
+    db.runOperationMany("insert into users (name, phone) values (%s, %s)",
+                        [("user-%d" % n, n % nphones + 1)
+                         for n in xrange(nusers)])
+    return db
+
+
+def models(db):
+    class phones(txdbapi.DatabaseModel):
+        pass
+
+    class users(txdbapi.DatabaseModel):
+        relations = {"phone": txdbapi.BelongsTo(phones)}
+
+    phones.db = users.db = db
+    return users, phones
+
+
+def counting(db):
+    queries = [0]
+    runQuery = db.runQuery
+
+    def counted(*args, **kwargs):
+        queries[0] += 1
+        return runQuery(*args, **kwargs)
+
+    db.runQuery = counted
+    return queries
+
+
+@defer.inlineCallbacks
+def n_plus_one(users, phones):
+    objs = yield users.all()
+    for obj in objs:
+        yield phones.find_first(where=("id=%s", obj.phone))
+    defer.returnValue(len(objs))
+
+
+@defer.inlineCallbacks
+def prefetch(users, phones):
+    objs = yield users.select(prefetch=["phone"])
+    for obj in objs:
+        yield obj.related("phone")
+    defer.returnValue(len(objs))
+
+
+@defer.inlineCallbacks
+def main():
+    nusers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    nphones = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        populate(dbname, nusers, nphones).close()
+        for inline in (True, False):
+            db = txdbapi.ConnectionPool("sqlite3", dbname, inline=inline)
+            users, phones = models(db)
+            queries = counting(db)
+            for name, run in (("find_first", n_plus_one),
+                              ("prefetch", prefetch)):
+                queries[0] = 0
+                started = time.time()
+                nrows = yield run(users, phones)
+                print "%-8s %-10s rows=%d queries=%-5d %.4fs" % (
+                    inline and "inline" or "threaded", name, nrows,
+                    queries[0], time.time() - started)
+            db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
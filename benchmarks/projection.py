@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Bytes read from the driver and time to list the titles of a table with
+# a large text column: select * versus select(columns=["title"]) and
+# select(defer=["body"]), on the threaded SQLite backend.
+#
+#   python benchmarks/projection.py [nrows] [body_size] [nselects]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nrows, body_size):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table posts "
+                    "(id integer primary key, title text, body text)")
+    db.runOperationMany("insert into posts (title, body) values (%s, %s)",
+                        [("post-%d" % n, "x" * body_size)
+                         for n in xrange(nrows)])
+    db.close()
+
+
+def size(rs):
+    total = 0
+    for row in rs:
+        for k in row.keys():
+            total += len(unicode(row[k]))
+    return total
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    body_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    nselects = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        populate(dbname, nrows, body_size)
+        db = txdbapi.ConnectionPool("sqlite3", dbname)
+
+        class posts(txdbapi.DatabaseModel):
+            pass
+
+        posts.db = db
+        yield posts.table_columns()
+        for name, kwargs in (("select *", {}),
+                             ("columns", {"columns": ["title"]}),
+                             ("defer", {"defer": ["body"]})):
+            rs = yield posts.select(raw=True, **kwargs)
+            nbytes = size(rs)
+            started = time.time()
+            for n in xrange(nselects):
+                objs = yield posts.select(**kwargs)
+                titles = [obj.title for obj in objs]
+            elapsed = time.time() - started
+            print "%-9s rows=%d bytes=%-9d %.4fs per select" % (
+                name, len(titles), nbytes, elapsed / nselects)
+        db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Queries and time of repeated identical find() calls, one after another
+# and all at once (a stampede), with and without a QueryCache, on the
+# threaded SQLite backend.
+#
+#   python benchmarks/query_cache.py [nrows] [ncalls]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+class posts(txdbapi.DatabaseModel):
+    pass
+
+
+def find():
+    return posts.find(where=("score>%s", 500), orderby="score desc",
+                      limit=20)
+
+
+@defer.inlineCallbacks
+def sequential(ncalls):
+    for n in xrange(ncalls):
+        yield find()
+
+
+def stampede(ncalls):
+    return defer.gatherResults([find() for n in xrange(ncalls)])
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    ncalls = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+        db.runOperation("create table posts "
+                        "(id integer primary key, title text, score int)")
+        db.runOperationMany("insert into posts (title, score) "
+                            "values (%s, %s)",
+                            [("post-%d" % n, n % 1000)
+                             for n in xrange(nrows)])
+        db.close()
+
+        posts.db = db = txdbapi.ConnectionPool("sqlite3", dbname)
+        stats = db.instrument()
+        for cache in (None, txdbapi.QueryCache()):
+            posts.query_cache = cache
+            for name, run in (("sequential", sequential),
+                              ("stampede", stampede)):
+                if cache is not None:
+                    yield posts.insert(title="new", score=0)
+                stats.reset()
+                started = time.time()
+                yield run(ncalls)
+                print "%-8s %-10s calls=%d queries=%-5d %.4fs" % (
+                    cache and "cached" or "uncached", name, ncalls,
+                    stats.calls, time.time() - started)
+        print "cache:", posts.query_cache.info()
+        db.close()
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
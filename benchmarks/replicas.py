@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Throughput of concurrent count() reads sent to a single threaded SQLite
+# database versus spread over copies of it (stand-ins for replicas) with
+# txdbapi.Replicas, round-robin and least-busy.
+#
+#   python benchmarks/replicas.py [nreads] [nreplicas] [nrows]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table items "
+                    "(id integer primary key, name text, qty int)")
+    db.runOperationMany("insert into items (name, qty) values (%s, %s)",
+                        [("item-%d" % n, n % 100) for n in xrange(nrows)])
+    db.close()
+
+
+@defer.inlineCallbacks
+def run(dbnames, policy, nreads):
+    dbs = [txdbapi.ConnectionPool("sqlite3", dbname) for dbname in dbnames]
+    stats = dbs[0].instrument()
+
+    class items(txdbapi.DatabaseModel):
+        db = dbs[0]
+        if policy:
+            replicas = txdbapi.Replicas(dbs[1:], policy=policy)
+
+    yield items.count()
+    stats.reset()
+    started = time.time()
+    yield defer.gatherResults([items.count(where=("qty > %s", n % 100))
+                               for n in xrange(nreads)])
+    elapsed = time.time() - started
+    reads = [stats.calls] + (policy and items.replicas.reads or [])
+    for db in dbs:
+        db.close()
+    defer.returnValue((elapsed, reads))
+
+
+@defer.inlineCallbacks
+def main():
+    nreads = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nreplicas = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    nrows = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        primary = os.path.join(tmpdir, "primary.sqlite")
+        populate(primary, nrows)
+        dbnames = [primary]
+        for n in xrange(nreplicas):
+            dbnames.append(os.path.join(tmpdir, "replica%d.sqlite" % n))
+            shutil.copy(primary, dbnames[-1])
+
+        for name, policy in (("primary", None),
+                             ("round_robin", "round_robin"),
+                             ("least_busy", "least_busy")):
+            elapsed, reads = yield run(dbnames, policy, nreads)
+            print "%-11s reads=%d %.4fs (%.0f reads/s) primary,replicas=%s" \
+                % (name, nreads, elapsed, nreads / elapsed,
+                   ",".join(map(str, reads)))
+    finally:
+        shutil.rmtree(tmpdir)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
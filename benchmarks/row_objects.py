@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Bytes per row and rows per second for building and reading rows as
+# plain DatabaseObjects versus the slotted row classes generated per model.
+#
+#   python benchmarks/row_objects.py [nrows]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+
+class asd(txdbapi.DatabaseModel):
+    db = txdbapi.ConnectionPool("sqlite3", ":memory:")
+
+
+def rowsize(obj):
+    size = sys.getsizeof(obj)
+    if not isinstance(obj, txdbapi.DatabaseRow):
+        size += sys.getsizeof(obj._data) + sys.getsizeof(obj._changes)
+    return size
+
+
+def bench(name, factory, rs):
+    started = time.time()
+    objs = map(factory, rs)
+    built = time.time() - started
+
+    started = time.time()
+    total = 0
+    for obj in objs:
+        total += obj.id + obj.age
+        obj.name
+    read = time.time() - started
+
+    print "%-14s bytes/row=%-4d build=%8d rows/s  read=%8d rows/s" % (
+        name, rowsize(objs[0]), len(rs) / built, len(rs) / read)
+
+
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    asd.db.runOperation("create table asd "
+                        "(id integer primary key, age int, name text)")
+    asd.db.runOperationMany("insert into asd (age, name) values (%s, %s)",
+                            [(n % 100, "name-%d" % n) for n in xrange(nrows)])
+    rs = asd.db.runQuery("select * from asd")
+
+    bench("DatabaseObject", lambda d: txdbapi.DatabaseObject(asd, d), rs)
+    bench("DatabaseRow", asd.row_class(rs[0].keys()), rs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Peak memory of select() versus iter_select() over a file-backed SQLite
+# table. Each mode runs in its own process so peak RSS is not shared.
+#
+#   python benchmarks/select_memory.py [nrows] [batch_size]
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table big "
+                    "(id integer primary key, age int, name text)")
+    db.runOperationMany("insert into big (age, name) values (%s, %s)",
+                        [(n % 100, "name-%d" % n) for n in xrange(nrows)])
+    db.close()
+
+
+def maxrss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@defer.inlineCallbacks
+def run(mode, dbname, batch_size):
+    class big(txdbapi.DatabaseModel):
+        db = txdbapi.ConnectionPool("sqlite3", dbname)
+
+    base = maxrss()
+    started = time.time()
+    seen = [0]
+    if mode == "select":
+        objs = yield big.select()
+        for obj in objs:
+            seen[0] += obj.age
+    else:
+        def consume(objs):
+            for obj in objs:
+                seen[0] += obj.age
+
+        yield big.iter_select(consume, batch_size=batch_size)
+
+    print "%-12s %.3fs peak_rss_delta=%dKB" % (mode, time.time() - started,
+                                               maxrss() - base)
+    big.db.close()
+    reactor.stop()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ("select", "iter_select"):
+        reactor.callWhenRunning(run, sys.argv[1], sys.argv[2],
+                                int(sys.argv[3]))
+        reactor.run()
+        return
+
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        populate(dbname, nrows)
+        for mode in ("select", "iter_select"):
+            subprocess.check_call([sys.executable, __file__, mode, dbname,
+                                   str(batch_size)])
+    finally:
+        os.unlink(dbname)
+
+
+if __name__ == "__main__":
+    main()
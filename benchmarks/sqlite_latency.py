@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Reactor latency while slow SQLite reads run next to fast requests,
+# comparing the inline backend with the threaded one.
+#
+#   python benchmarks/sqlite_latency.py [nrows]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+SLOW = "select count(*) as n from big a, big b where a.v < b.v"
+TICK = 0.005
+
+
+@defer.inlineCallbacks
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table big (id integer primary key, v int)")
+    db.runOperationMany("insert into big (v) values (%s)",
+                        [(n,) for n in xrange(nrows)])
+    db.close()
+    yield None
+
+
+@defer.inlineCallbacks
+def measure(db, nslow=4, nfast=200):
+    lag = []
+    last = [time.time()]
+
+    def tick():
+        now = time.time()
+        lag.append(now - last[0] - TICK)
+        last[0] = now
+
+    ticker = task.LoopingCall(tick)
+    ticker.start(TICK, now=False)
+
+    fast = []
+
+    @defer.inlineCallbacks
+    def fast_request():
+        yield task.deferLater(reactor, 0, lambda: None)
+        fast.append(time.time() - started)
+
+    started = time.time()
+    calls = [defer.maybeDeferred(db.runQuery, SLOW) for n in xrange(nslow)]
+    for n in xrange(nfast):
+        calls.append(fast_request())
+    yield defer.DeferredList(calls)
+    elapsed = time.time() - started
+    ticker.stop()
+
+    lag.sort()
+    fast.sort()
+    defer.returnValue({
+        "elapsed": elapsed,
+        "ticks": len(lag),
+        "lag_max": lag[-1] if lag else elapsed,
+        "fast_p50": fast[len(fast) / 2],
+        "fast_max": fast[-1],
+    })
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        yield populate(dbname, nrows)
+        for inline in (True, False):
+            db = txdbapi.ConnectionPool("sqlite3", dbname, inline=inline)
+            rs = yield measure(db)
+            db.close()
+            print "%-8s elapsed=%.3fs ticks=%d max_lag=%.3fs " \
+                  "fast_p50=%.4fs fast_max=%.3fs" % (
+                      inline and "inline" or "threaded", rs["elapsed"],
+                      rs["ticks"], rs["lag_max"], rs["fast_p50"],
+                      rs["fast_max"])
+    finally:
+        os.unlink(dbname)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Benchmark suite of the CRUD hot paths: insert, select, update, save,
+# count, find_first, and DatabaseObject construction and attribute
+# access, over table sizes and row widths, on in-memory SQLite, file
+# SQLite, an adbapi pool over an SQLite file (standing in for MySQL and
+# Postgres, offline) and, when given, local MySQL and Postgres servers.
+#
+# Each (backend, rows, width) case runs in its own process, so that its
+# peak RSS is its own. Results are written as JSON with ops/sec and
+# p50/p99 latency per operation; --compare prints the change of ops/sec
+# against the results of an earlier run, e.g. of another commit.
+#
+#   python benchmarks/suite.py [-b memory,file,adbapi] [-r 1,1k,100k]
+#       [-w 4,32] [-n 500] [-o results.json] [--compare base.json]
+#       [--mysql host=localhost,user=root,db=test]
+#       [--postgres "dbname=test"]
+
+import json
+import optparse
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+OPS = ("find_first", "select", "count", "wrap", "getattr", "update", "save",
+       "insert")
+
+ID_COLUMN = {
+    "mysql": "id int auto_increment primary key",
+    "postgres": "id serial primary key",
+}
+
+# rows per select, and per batch of wrap and getattr
+BATCH = 100
+
+
+def parse_count(s):
+    s = s.strip().lower()
+    for suffix, scale in (("k", 1000), ("m", 1000000)):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * scale)
+    return int(s)
+
+
+def connect(backend, path, options):
+    if backend == "memory":
+        return txdbapi.ConnectionPool("sqlite3", ":memory:")
+    elif backend == "file":
+        return txdbapi.ConnectionPool("sqlite3", path)
+    elif backend == "adbapi":
+        db = txdbapi.AdbapiPool("sqlite3", path, check_same_thread=False,
+                                cp_min=1, cp_max=1)
+        db.on_connect(setattr, "row_factory", sqlite3.Row)
+        db.start()
+        return db
+    elif backend == "mysql":
+        kwargs = dict([kv.split("=", 1) for kv in options.mysql.split(",")])
+        db = txdbapi.ConnectionPool("MySQLdb", **kwargs)
+        db.start()
+        return db
+    elif backend == "postgres":
+        db = txdbapi.ConnectionPool("psycopg2", options.postgres)
+        db.start()
+        return db
+    raise ValueError("Unknown backend %r" % backend)
+
+
+def row(n, columns):
+    # alternate int and text columns
+    return [i % 2 and "v%d-%d" % (i, n) or i * n
+            for i in xrange(len(columns))]
+
+
+@defer.inlineCallbacks
+def populate(db, backend, nrows, columns):
+    yield db.runOperation("drop table if exists bench")
+    yield db.runOperation("create table bench (%s, %s)" % (
+        ID_COLUMN.get(backend, "id integer primary key"),
+        ", ".join(["%s %s" % (c, i % 2 and "text" or "int")
+                   for i, c in enumerate(columns)])))
+    q = db.dialect.convert("insert into bench (%s) values (%s)" % (
+        ",".join(columns), ",".join(["%s"] * len(columns))))
+    for n in xrange(0, nrows, 1000):
+        yield db.runOperationMany(q, [row(i, columns) for i in
+                                      xrange(n, min(nrows, n + 1000))])
+
+
+def percentile(times, q):
+    return times[min(len(times) - 1, int(round(q * (len(times) - 1))))]
+
+
+@defer.inlineCallbacks
+def measure(f, ncalls):
+    times = []
+    timer = time.time
+    for n in xrange(ncalls):
+        started = timer()
+        yield f(n)
+        times.append(timer() - started)
+    defer.returnValue(times)
+
+
+@defer.inlineCallbacks
+def run_case(backend, nrows, width, options):
+    columns = ["c%d" % n for n in xrange(width - 1)]
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    db = connect(backend, path, options)
+    try:
+        yield populate(db, backend, nrows, columns)
+
+        class bench(txdbapi.DatabaseModel):
+            pass
+
+        bench.db = db
+        ncalls = options.ncalls
+        pick = lambda: random.randint(1, nrows)
+        rs = yield bench.select(orderby="id", limit=BATCH, raw=True)
+        objs = bench._wrap(rs)
+        saved = yield bench.select(where=("id=%s", 1))
+
+        def getattrs(n):
+            for obj in objs:
+                for c in columns:
+                    getattr(obj, c)
+
+        def save(n):
+            obj = saved[0]
+            setattr(obj, columns[0], n)
+            return obj.save()
+
+        ops = {
+            "find_first": lambda n: bench.find_first(where=("id=%s",
+                                                            pick())),
+            "select": lambda n: bench.select(where=("id>=%s", pick()),
+                                             orderby="id", limit=BATCH),
+            "count": lambda n: bench.count(),
+            "wrap": lambda n: bench._wrap(rs),
+            "getattr": getattrs,
+            "update": lambda n: bench.update(where=("id=%s", pick()),
+                                             **{columns[0]: n}),
+            "save": save,
+            "insert": lambda n: bench.insert(**dict(zip(columns,
+                                                        row(n, columns)))),
+        }
+
+        results = []
+        for op in OPS:
+            if op not in options.ops:
+                continue
+            ncalls = op == "count" and max(1, options.ncalls / 10) or \
+                options.ncalls
+            times = yield measure(ops[op], ncalls)
+            total = sum(times)
+            times.sort()
+            results.append({
+                "backend": backend, "rows": nrows, "width": width, "op": op,
+                "calls": ncalls,
+                "batch": op in ("wrap", "getattr") and len(objs) or 1,
+                "seconds": total,
+                "ops_per_sec": total and ncalls / total or None,
+                "p50_us": percentile(times, 0.50) * 1e6,
+                "p99_us": percentile(times, 0.99) * 1e6,
+                "max_us": times[-1] * 1e6})
+    finally:
+        db.close()
+        os.unlink(path)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    for r in results:
+        r["peak_rss_kb"] = rss
+    defer.returnValue(results)
+
+
+def child(options):
+    backend, nrows, width = options.case.split(":")
+    out = []
+
+    def done(results):
+        out.extend(results)
+        reactor.stop()
+
+    def failed(f):
+        f.printTraceback(file=sys.stderr)
+        reactor.stop()
+
+    def start():
+        d = run_case(backend, int(nrows), int(width), options)
+        d.addCallbacks(done, failed)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+    if not out:
+        sys.exit(1)
+    print json.dumps(out)
+
+
+def meta():
+    try:
+        commit = subprocess.Popen(
+            ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).communicate()[0].strip() or None
+    except OSError:
+        commit = None
+
+    import twisted
+    return {"commit": commit, "python": sys.version.split()[0],
+            "twisted": twisted.__version__,
+            "sqlite": sqlite3.sqlite_version, "platform": sys.platform,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(results, path):
+    base = {}
+    for r in json.load(open(path))["results"]:
+        base[(r["backend"], r["rows"], r["width"], r["op"])] = r
+
+    print >>sys.stderr, "\n%-8s %8s %5s %-10s %12s %12s %8s" % (
+        "backend", "rows", "width", "op", "base ops/s", "ops/s", "change")
+    for r in results:
+        b = base.get((r["backend"], r["rows"], r["width"], r["op"]))
+        if b is None or not b["ops_per_sec"] or not r["ops_per_sec"]:
+            continue
+        change = r["ops_per_sec"] / b["ops_per_sec"] - 1
+        print >>sys.stderr, "%-8s %8d %5d %-10s %12.1f %12.1f %+7.1f%%%s" % (
+            r["backend"], r["rows"], r["width"], r["op"], b["ops_per_sec"],
+            r["ops_per_sec"], change * 100, change < -0.1 and " !" or "")
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-b", "--backends", default="memory,file,adbapi",
+                      help="memory, file, adbapi, mysql, postgres")
+    parser.add_option("-r", "--rows", default="1,1k,100k",
+                      help="table sizes, e.g. 1,1k,1M")
+    parser.add_option("-w", "--widths", default="4,32",
+                      help="columns per row, id included")
+    parser.add_option("-n", "--ncalls", type="int", default=500,
+                      help="calls per operation (count makes a tenth)")
+    parser.add_option("--ops", default=",".join(OPS))
+    parser.add_option("-o", "--output", help="write the results here")
+    parser.add_option("--compare", help="results of an earlier run")
+    parser.add_option("--mysql", help="MySQLdb.connect arguments, k=v,...")
+    parser.add_option("--postgres", help="psycopg2 connection string")
+    parser.add_option("--case", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    options.ops = options.ops.split(",")
+
+    if options.case:
+        return child(options)
+
+    results = []
+    for backend in options.backends.split(","):
+        if backend in ("mysql", "postgres") and \
+                not getattr(options, backend):
+            print >>sys.stderr, "skipping %s: pass --%s" % (backend,
+                                                            backend)
+            continue
+        for nrows in map(parse_count, options.rows.split(",")):
+            for width in map(int, options.widths.split(",")):
+                cmd = [sys.executable, os.path.abspath(__file__),
+                       "--case", "%s:%d:%d" % (backend, nrows, width),
+                       "-n", str(options.ncalls),
+                       "--ops", ",".join(options.ops)]
+                for k in ("mysql", "postgres"):
+                    if getattr(options, k):
+                        cmd += ["--" + k, getattr(options, k)]
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                out = proc.communicate()[0]
+                if proc.returncode:
+                    print >>sys.stderr, "%s rows=%d width=%d failed" % (
+                        backend, nrows, width)
+                    continue
+
+                for r in json.loads(out.splitlines()[-1]):
+                    results.append(r)
+                    print >>sys.stderr, \
+                        "%-8s rows=%-8d width=%-3d %-10s %10.1f ops/s " \
+                        "p50=%8.1fus p99=%8.1fus rss=%dkB" % (
+                            backend, nrows, width, r["op"],
+                            r["ops_per_sec"] or 0, r["p50_us"],
+                            r["p99_us"], r["peak_rss_kb"])
+
+    doc = {"meta": meta(), "results": results}
+    if options.output:
+        json.dump(doc, open(options.output, "w"), indent=1, sort_keys=True)
+    else:
+        print json.dumps(doc, indent=1, sort_keys=True)
+
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Queries and time to create-or-update a batch of rows, half of them
+# already present, with find_first then save() per row versus one
+# upsert() per row and a single upsert_many(), on the inline and the
+# threaded SQLite backends.
+#
+#   python benchmarks/upsert.py [nrows]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def populate(dbname, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname, inline=True)
+    db.runOperation("create table items "
+                    "(id integer primary key, sku text unique, qty int)")
+    db.runOperationMany("insert into items (sku, qty) values (%s, %s)",
+                        [("sku-%d" % n, 0) for n in xrange(0, nrows, 2)])
+    return db
+
+
+def model(db):
+    class items(txdbapi.DatabaseModel):
+        pass
+
+    items.db = db
+    return items
+
+
+def counting(db):
+    queries = [0]
+
+    def wrap(run):
+        def counted(*args, **kwargs):
+            queries[0] += 1
+            return run(*args, **kwargs)
+        return counted
+
+    for name in ("runQuery", "runOperation", "runInteraction"):
+        setattr(db, name, wrap(getattr(db, name)))
+    return queries
+
+
+@defer.inlineCallbacks
+def find_then_save(items, rows):
+    for row in rows:
+        obj = yield items.find_first(where=("sku=%s", row["sku"]))
+        if obj is None:
+            obj = items.new(**row)
+        else:
+            obj.qty = row["qty"]
+        yield obj.save()
+    defer.returnValue(len(rows))
+
+
+@defer.inlineCallbacks
+def upsert(items, rows):
+    for row in rows:
+        yield items.upsert(conflict=["sku"], **row)
+    defer.returnValue(len(rows))
+
+
+@defer.inlineCallbacks
+def upsert_many(items, rows):
+    objs = yield items.upsert_many(rows, conflict=["sku"])
+    defer.returnValue(len(objs))
+
+
+@defer.inlineCallbacks
+def main():
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rows = [{"sku": "sku-%d" % n, "qty": n} for n in xrange(nrows)]
+    for inline in (True, False):
+        for name, run in (("find+save", find_then_save),
+                          ("upsert", upsert),
+                          ("upsert_many", upsert_many)):
+            fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+            try:
+                populate(dbname, nrows).close()
+                db = txdbapi.ConnectionPool("sqlite3", dbname, inline=inline)
+                queries = counting(db)
+                started = time.time()
+                n = yield run(model(db), rows)
+                print "%-8s %-11s rows=%d queries=%-5d %.4fs" % (
+                    inline and "inline" or "threaded", name, n,
+                    queries[0], time.time() - started)
+                db.close()
+            finally:
+                os.unlink(dbname)
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
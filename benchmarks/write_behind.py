@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Database round trips and time to apply bursts of save() calls to a few
+# hot rows, each save written right away versus coalesced by the model's
+# write_behind queue, on the threaded SQLite backend.
+#
+#   python benchmarks/write_behind.py [nbursts] [nsaves] [nrows]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import txdbapi
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+def model(db, write_behind):
+    class counters(txdbapi.DatabaseModel):
+        pass
+
+    counters.db = db
+    counters.write_behind = write_behind
+    return counters
+
+
+@defer.inlineCallbacks
+def run(dbname, write_behind, nbursts, nsaves, nrows):
+    db = txdbapi.ConnectionPool("sqlite3", dbname)
+    yield db.runOperation("create table counters "
+                          "(id integer primary key, hits int, seen real)")
+    counters = model(db, write_behind)
+    objs = yield counters.insert_many([dict(hits=0, seen=0)
+                                       for n in xrange(nrows)])
+    stats = db.instrument()
+
+    started = time.time()
+    for burst in xrange(nbursts):
+        ds = []
+        for n in xrange(nsaves):
+            obj = objs[n % nrows]
+            obj.hits += 1
+            obj.seen = time.time()
+            ds.append(obj.save())
+        yield defer.gatherResults(ds)
+    elapsed = time.time() - started
+
+    rs = yield db.runQuery("select sum(hits) as hits from counters")
+    assert rs[0]["hits"] == nbursts * nsaves
+    db.close()
+    defer.returnValue((stats.calls, counters.write_behind_info()["rows"],
+                       elapsed))
+
+
+@defer.inlineCallbacks
+def main():
+    nbursts = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    nsaves = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    nrows = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    try:
+        for name, write_behind in (("direct", None),
+                                   ("write_behind", 0.01)):
+            fd, dbname = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+            try:
+                calls, rows, elapsed = yield run(dbname, write_behind,
+                                                 nbursts, nsaves, nrows)
+                print "%-12s saves=%d round_trips=%-5d rows_written=%-5d " \
+                      "%.4fs (%.0f saves/s)" % (
+                          name, nbursts * nsaves, calls,
+                          rows or nbursts * nsaves, elapsed,
+                          nbursts * nsaves / elapsed)
+            finally:
+                os.unlink(dbname)
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -2,6 +2,7 @@
 
 import txdbapi
 
+from twisted.enterprise import adbapi
 from twisted.internet import base
 from twisted.internet import defer
 from twisted.trial import unittest
@@ -90,3 +91,123 @@ class Test_Postgres(unittest.TestCase):
 
         obj = yield asd.find_first(where=("name=%s", "bar"))
         self.assertEqual(obj, None)
+
+    @defer.inlineCallbacks
+    def test_12_crud_insert_many(self):
+        objs = yield asd.insert_many([dict(name="m%d" % n, age=n)
+                                      for n in range(5)], chunk_size=2)
+        self.assertEqual([obj.id for obj in objs], [4, 5, 6, 7, 8])
+        self.assertEqual([obj.name for obj in objs],
+                         ["m0", "m1", "m2", "m3", "m4"])
+
+        objs = yield asd.find(where=("name like %s", "m%"), orderby="id")
+        self.assertEqual([obj.age for obj in objs], [0, 1, 2, 3, 4])
+
+    @defer.inlineCallbacks
+    def test_13_sql_cache(self):
+        yield asd.find(where=("name=%s", "foo"))
+        info = asd.sql_cache_info()
+        objs = yield asd.find(where=("name=%s", "foo"))
+        self.assertEqual(objs[0].id, 1)
+        self.assertEqual(asd.sql_cache_info()["hits"], info["hits"] + 1)
+        self.assertEqual(asd.sql_cache_info()["misses"], info["misses"])
+        self.assertEqual(BaseModel.sql_cache_info()["size"], 0)
+
+    @defer.inlineCallbacks
+    def test_14_crud_iter_select(self):
+        batches = []
+
+        def callback(objs):
+            batches.append([obj.id for obj in objs])
+            return defer.succeed(None)
+
+        total = yield asd.iter_select(callback, batch_size=4, orderby="id")
+        self.assertEqual(total, 6)
+        self.assertEqual(batches, [[1, 4, 5, 6], [7, 8]])
+
+    @defer.inlineCallbacks
+    def test_15_model_row_slots(self):
+        foo = yield asd.find_first(where=("name=%s", "foo"))
+        self.assertTrue(isinstance(foo, txdbapi.DatabaseRow))
+        self.assertFalse(hasattr(foo, "__dict__"))
+        self.assertEqual(foo._changes, set())
+
+        foo.age = 30
+        self.assertEqual(foo._changes, set(["age"]))
+        yield foo.save()
+        self.assertEqual(foo._changes, set())
+
+        # attributes that aren't columns are kept aside
+        foo.nope = 1
+        self.assertEqual((foo.nope, foo["nope"], foo._data["nope"]), (1, 1, 1))
+        self.assertEqual(foo._changes, set())
+        self.assertRaises(AttributeError, getattr, foo, "other")
+
+        foo = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(foo.age, 30)
+
+    @defer.inlineCallbacks
+    def test_16_db_transaction(self):
+        def work(txn, names):
+            for name in names:
+                asd.new(name=name, age=1).save()
+            asd.update(age=2, where=("name=%s", names[0]))
+            return asd.count(where=("name like %s", "t%"))
+
+        n = yield BaseModel.db.transaction(work, ["t1", "t2", "t3"])
+        self.assertEqual(n, 3)
+        obj = yield asd.find_first(where=("name=%s", "t1"))
+        self.assertEqual(obj.age, 2)
+
+        def fail(txn):
+            asd.insert(name="t4", age=1)
+            raise ValueError("rollback")
+
+        try:
+            yield BaseModel.db.transaction(fail)
+        except ValueError:
+            pass
+        else:
+            self.fail("transaction did not raise")
+        n = yield asd.count(where=("name like %s", "t%"))
+        self.assertEqual(n, 3)
+
+    @defer.inlineCallbacks
+    def test_17_crud_insert_round_trips(self):
+        executed = []
+
+        class counting(adbapi.Transaction):
+            def execute(self, *args, **kwargs):
+                executed.append(args[0])
+                return self._cursor.execute(*args, **kwargs)
+
+        BaseModel.db.transactionFactory = counting
+        try:
+            foo = yield asd.insert(name="r1", age=1)
+        finally:
+            del BaseModel.db.transactionFactory
+        self.assertEqual(len(executed), 1)
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(obj.name, "r1")
+
+    @defer.inlineCallbacks
+    def test_18_pool_init_hooks(self):
+        import psycopg2
+        self.assertTrue(psycopg2.connect.__module__.startswith("psycopg2"))
+
+        db = txdbapi.ConnectionPool(
+            "psycopg2", "dbname=postgres", cp_min=1, cp_max=2, cp_ping=0,
+            cp_init=["set application_name = 'txdbapi'",
+                     "prepare plus_one (int) as select $1 + 1 as v"])
+        db.start()
+        try:
+            rs = yield db.runQuery("show application_name")
+            self.assertEqual(rs[0]["application_name"], "txdbapi")
+            rs = yield db.runQuery("execute plus_one (%s)", (1,))
+            self.assertEqual(rs[0]["v"], 2)
+            info = db.pool_info()
+            self.assertEqual((info["checkouts"], info["ping_failures"]),
+                             (2, 0))
+            self.assertEqual(info["connects"], info["connections"])
+        finally:
+            db.close()
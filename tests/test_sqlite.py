@@ -1,9 +1,14 @@
 # coding: utf-8
 
+import json
+import sqlite3
+import threading
 import txdbapi
 
 from twisted.internet import base
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
 from twisted.trial import unittest
 
 base.DelayedCall.debug = False
@@ -24,6 +29,36 @@ class asd(BaseModel):
     pass
 
 
+decoded = []
+
+
+def json_loads(s):
+    decoded.append(s)
+    return json.loads(s)
+
+
+class asdjson(BaseModel):
+    codecs = {"name": (json.dumps, json_loads)}
+
+
+class asdcache(BaseModel):
+    table_name = "asd"
+    row_cache_size = 2
+    row_cache_ttl = 60
+
+
+class asdrefresh(BaseModel):
+    refresh = True
+
+
+class phones(BaseModel):
+    relations = {"users": txdbapi.HasMany("users", "phone")}
+
+
+class users(BaseModel):
+    relations = {"phone": txdbapi.BelongsTo(phones)}
+
+
 class Test_SQLite(unittest.TestCase):
     @defer.inlineCallbacks
     def test_01_setup(self):
@@ -90,3 +125,1105 @@ class Test_SQLite(unittest.TestCase):
 
         obj = yield asd.find_first(where=("name=%s", "bar"))
         self.assertEqual(obj, None)
+
+    @defer.inlineCallbacks
+    def test_12_crud_insert_many(self):
+        objs = yield asd.insert_many([dict(name="m%d" % n, age=n)
+                                      for n in range(5)], chunk_size=2)
+        self.assertEqual([obj.id for obj in objs], [4, 5, 6, 7, 8])
+        self.assertEqual([obj.name for obj in objs],
+                         ["m0", "m1", "m2", "m3", "m4"])
+
+        objs = yield asd.find(where=("name like %s", "m%"), orderby="id")
+        self.assertEqual([obj.age for obj in objs], [0, 1, 2, 3, 4])
+
+    @defer.inlineCallbacks
+    def test_13_sql_cache(self):
+        yield asd.find(where=("name=%s", "foo"))
+        info = asd.sql_cache_info()
+        objs = yield asd.find(where=("name=%s", "foo"))
+        self.assertEqual(objs[0].id, 1)
+        self.assertEqual(asd.sql_cache_info()["hits"], info["hits"] + 1)
+        self.assertEqual(asd.sql_cache_info()["misses"], info["misses"])
+        self.assertEqual(BaseModel.sql_cache_info()["size"], 0)
+
+        # clauses given as None are not cached as missing ones
+        yield self.assertFailure(asd.find(orderby=None), Exception)
+        objs = yield asd.find()
+        self.assertTrue(objs)
+
+    @defer.inlineCallbacks
+    def test_14_crud_iter_select(self):
+        batches = []
+
+        def callback(objs):
+            batches.append([obj.id for obj in objs])
+            return defer.succeed(None)
+
+        total = yield asd.iter_select(callback, batch_size=4, orderby="id")
+        self.assertEqual(total, 6)
+        self.assertEqual(batches, [[1, 4, 5, 6], [7, 8]])
+
+    @defer.inlineCallbacks
+    def test_15_model_row_slots(self):
+        foo = yield asd.find_first(where=("name=%s", "foo"))
+        self.assertTrue(isinstance(foo, txdbapi.DatabaseRow))
+        self.assertFalse(hasattr(foo, "__dict__"))
+        self.assertEqual(foo._changes, set())
+
+        foo.age = 30
+        self.assertEqual(foo._changes, set(["age"]))
+        yield foo.save()
+        self.assertEqual(foo._changes, set())
+
+        # attributes that aren't columns are kept aside
+        foo.nope = 1
+        self.assertEqual((foo.nope, foo["nope"], foo._data["nope"]), (1, 1, 1))
+        self.assertEqual(foo._changes, set())
+        self.assertRaises(AttributeError, getattr, foo, "other")
+
+        # so are private ones, which aren't part of the row
+        for obj in (foo, asd.new(name="new")):
+            obj._tag = 2
+            self.assertEqual(obj._tag, 2)
+            self.assertFalse("_tag" in obj._data)
+            self.assertRaises(AttributeError, getattr, obj, "_other")
+
+        class asddeny(BaseModel):
+            table_name = "asd"
+            deny = ["x"]
+
+        foo = yield asddeny.find_first(where=("id=%s", foo.id))
+        foo.x = 1
+        yield foo.save(force=True)
+
+        # a deleted row is inserted again with a new id
+        yield BaseModel.db.runOperation(
+            "create table asdgone (id integer primary key, age int)")
+
+        class asdgone(BaseModel):
+            pass
+
+        class returningless(txdbapi.SQLiteDialect):
+            returning = False
+
+        yield asdgone.insert(age=1)
+        foo = yield asdgone.find_first()
+        self.assertTrue(isinstance(foo, txdbapi.DatabaseRow))
+        yield foo.delete()
+        self.assertEqual(foo.id, None)
+        BaseModel.db.dialect = returningless()
+        try:
+            yield foo.save()
+        finally:
+            del BaseModel.db.dialect
+        self.assertEqual(foo.id, 1)
+        nobjs = yield asdgone.count()
+        self.assertEqual(nobjs, 1)
+
+        foo = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(foo.age, 30)
+
+    @defer.inlineCallbacks
+    def test_16_model_lazy_codecs(self):
+        yield BaseModel.db.runOperation(
+            "create table asdjson "
+            "(id integer primary key autoincrement, age int, name text)")
+        yield asdjson.insert_many([dict(name={"n": n}, age=n)
+                                   for n in range(3)])
+        objs = yield asdjson.all()
+        self.assertEqual(decoded, [])
+
+        self.assertEqual(objs[0].name, {"n": 0})
+        self.assertEqual(objs[0].name, {"n": 0})
+        self.assertEqual(len(decoded), 1)
+
+        objs[0].name = {"n": 10}
+        self.assertEqual(objs[0].name, {"n": 10})
+        self.assertEqual(objs[0].get("name"), '{"n": 10}')
+
+        rs = yield asdjson.select(where=("age=%s", 1), raw=True)
+        self.assertFalse(isinstance(rs[0], txdbapi.DatabaseObject))
+        self.assertEqual(rs[0]["name"], '{"n": 1}')
+
+    @defer.inlineCallbacks
+    def test_17_model_row_cache(self):
+        foo = yield asdcache.get(1)
+        self.assertEqual(foo.name, "foo")
+        obj = yield asdcache.find_first(where=("id=%s", 1))
+        self.assertTrue(obj is foo)
+        info = asdcache.row_cache_info()
+        self.assertEqual((info["hits"], info["misses"]), (1, 1))
+
+        foo.age = 40
+        yield foo.save()
+        obj = yield asdcache.get(1)
+        self.assertFalse(obj is foo)
+        self.assertEqual(obj.age, 40)
+
+        yield asdcache.update(age=41, where=("name=%s", "foo"))
+        obj = yield asdcache.get(1)
+        self.assertEqual(obj.age, 41)
+
+        now = [asdcache._row_cache().timer()]
+        asdcache._row_cache().timer = lambda: now[0]
+        yield asdcache.get(4)
+        yield asdcache.get(5)
+        self.assertEqual(asdcache.row_cache_info()["evictions"], 1)
+        now[0] += 61
+        obj = yield asdcache.get(5)
+        self.assertEqual(obj.id, 5)
+        self.assertEqual(asdcache.row_cache_info()["expirations"], 1)
+
+        yield obj.delete()
+        obj = yield asdcache.get(5)
+        self.assertEqual(obj, None)
+        self.assertEqual(asd.row_cache_info()["size"], 0)
+
+    @defer.inlineCallbacks
+    def test_18_db_transaction(self):
+        @defer.inlineCallbacks
+        def work(txn, names):
+            for name in names:
+                obj = asd.new(name=name, age=1)
+                yield obj.save()
+            yield asd.update(age=2, where=("name=%s", names[0]))
+            rs = yield txn.runQuery("select count(*) as n from asd "
+                                    "where name like %s", ("t%",))
+            defer.returnValue(rs[0]["n"])
+
+        n = yield BaseModel.db.transaction(work, ["t1", "t2", "t3"])
+        self.assertEqual(n, 3)
+        obj = yield asd.find_first(where=("name=%s", "t1"))
+        self.assertEqual(obj.age, 2)
+
+        def fail(txn):
+            asd.insert(name="t4", age=1)
+            raise ValueError("rollback")
+
+        try:
+            yield BaseModel.db.transaction(fail)
+        except ValueError:
+            pass
+        else:
+            self.fail("transaction did not raise")
+        n = yield asd.count(where=("name like %s", "t%"))
+        self.assertEqual(n, 3)
+
+    @defer.inlineCallbacks
+    def test_19_model_prefetch(self):
+        yield BaseModel.db.runOperation(
+            "create table phones "
+            "(id integer primary key autoincrement, model text)")
+        yield BaseModel.db.runOperation(
+            "create table users "
+            "(id integer primary key autoincrement, name text, phone int)")
+        iphone, android = yield phones.insert_many([dict(model="iPhone"),
+                                                    dict(model="Android")])
+        yield users.insert_many([dict(name="u%d" % n, phone=iphone)
+                                 for n in range(3)] +
+                                [dict(name="u3", phone=None)])
+
+        queries = []
+        runQuery = BaseModel.db.runQuery
+
+        def counted(*args):
+            queries.append(args[0])
+            return runQuery(*args)
+
+        BaseModel.db.runQuery = counted
+        try:
+            objs = yield users.find(orderby="id", prefetch=["phone"])
+            self.assertEqual(len(queries), 2)
+            phone = yield objs[0].related("phone")
+            self.assertEqual(phone.model, "iPhone")
+            self.assertTrue(phone is (yield objs[2].related("phone")))
+            phone = yield objs[3].related("phone")
+            self.assertEqual(phone, None)
+            self.assertEqual(len(queries), 2)
+
+            objs = yield phones.find(orderby="id", prefetch=["users"])
+            rs = yield objs[0].related("users")
+            self.assertEqual([obj.name for obj in rs], ["u0", "u1", "u2"])
+            rs = yield objs[1].related("users")
+            self.assertEqual(rs, [])
+            self.assertEqual(len(queries), 4)
+        finally:
+            del BaseModel.db.runQuery
+
+        obj = yield users.find_first(where=("name=%s", "u1"))
+        phone = yield obj.related("phone")
+        self.assertEqual(phone.id, iphone.id)
+
+        # names shared by models of the same module are ambiguous
+        class asd(BaseModel):
+            pass
+
+        rel = txdbapi.BelongsTo("asd")
+        self.assertRaises(ValueError, rel.resolve, users)
+        self.assertRaises(ValueError, lambda: rel.model)
+
+        # and those of other modules are left out
+        other = type("phones", (BaseModel,), {"__module__": "other"})
+        rel = txdbapi.HasMany("phones", "phone")
+        self.assertTrue(rel.resolve(users) is phones)
+        rel = txdbapi.HasMany("phones", "phone")
+        self.assertTrue(rel.resolve(other) is other)
+        self.assertRaises(ValueError, txdbapi.HasMany("nosuch").resolve)
+
+    @defer.inlineCallbacks
+    def test_20_db_instrument(self):
+        stats = BaseModel.db.instrument(txdbapi.QueryStats(slow=0))
+        try:
+            yield asd.find(where=("name=%s", "foo"))
+            yield asd.find(where=("name=%s", "nope"))
+            yield asd.update(age=20, where=("name=%s", "foo"))
+        finally:
+            BaseModel.db.recorder = None
+
+        info = stats.info()
+        self.assertEqual(info["calls"], 3)
+        self.assertEqual(len(info["slow_queries"]), 3)
+        q, = [q for q, st in info["templates"].items()
+              if st["kind"] == "runQuery"]
+        st = info["templates"][q]
+        self.assertTrue(q.startswith("select "))
+        self.assertEqual((st["calls"], st["rows"]), (2, 1))
+        self.assertEqual(sum(st["histogram"].values()), 2)
+
+        def touch(txn):
+            txn.runOperation("update asd set age=age where id=%s", (1,))
+
+        stats = BaseModel.db.instrument()
+        try:
+            yield BaseModel.db.transaction(touch)
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(stats.info()["templates"].keys(), ["touch"])
+        self.assertEqual(stats.info()["templates"]["touch"]["kind"],
+                         "transaction")
+
+        stats = BaseModel.db.instrument(txdbapi.QueryStats(sample_rate=0))
+        yield asd.count()
+        BaseModel.db.recorder = None
+        self.assertEqual(stats.info()["calls"], 0)
+
+    @defer.inlineCallbacks
+    def test_21_model_paginate(self):
+        yield asd.insert_many([dict(name="p%d" % n, age=n % 3)
+                               for n in range(7)])
+        where = ("name like %s", "p%")
+        pages, token = [], None
+        while True:
+            objs, token = yield asd.paginate(order_by="age", after=token,
+                                             page_size=3, where=where)
+            pages.append([(obj.age, obj.name) for obj in objs])
+            if token is None:
+                break
+            if len(pages) == 1:
+                # a row that sorts before the next page doesn't shift it
+                yield asd.insert(name="p7", age=-1)
+
+        self.assertEqual(pages, [[(0, "p0"), (0, "p3"), (0, "p6")],
+                                 [(1, "p1"), (1, "p4"), (2, "p2")],
+                                 [(2, "p5")]])
+
+        objs, token = yield asd.paginate(page_size=2, desc=True, where=where)
+        objs, token = yield asd.paginate(page_size=2, desc=True, where=where,
+                                         after=token)
+        self.assertEqual([obj.name for obj in objs], ["p5", "p4"])
+        self.assertRaises(ValueError, asd.paginate, after=token)
+        self.assertRaises(ValueError, asd.paginate, after="nope")
+
+    @defer.inlineCallbacks
+    def test_22_crud_returning(self):
+        executed = []
+        curs = BaseModel.db.curs
+
+        class counting(object):
+            def execute(self, *args):
+                executed.append(args[0])
+                return curs.execute(*args)
+
+            def __getattr__(self, k):
+                return getattr(curs, k)
+
+        BaseModel.db.curs = counting()
+        try:
+            foo = yield asd.insert(name="r1", age=1)
+        finally:
+            BaseModel.db.curs = curs
+        self.assertEqual(len(executed), 1)
+        self.assertTrue(executed[0].endswith(" returning id"))
+        obj = yield asd.get(foo.id)
+        self.assertEqual(obj.name, "r1")
+
+        rs = yield asd.update(age=2, where=("id=%s", foo.id), returning=True)
+        self.assertEqual([(r["id"], r["age"]) for r in rs], [(foo.id, 2)])
+
+        yield BaseModel.db.runOperation(
+            "create table asdrefresh (id integer primary key autoincrement, "
+            "age int, name text default 'anon')")
+        obj = yield asdrefresh.insert(age=1)
+        self.assertEqual(obj.name, "anon")
+        obj = asdrefresh.new(age=2)
+        yield obj.save()
+        self.assertEqual((obj.id, obj.name), (2, "anon"))
+        obj = yield asdrefresh.get(2)
+        obj.age = 3
+        yield obj.save()
+        self.assertEqual((obj.age, obj._changes), (3, set()))
+
+    def test_23_db_dialect(self):
+        dialect = BaseModel.db.dialect
+        self.assertTrue(isinstance(dialect, txdbapi.SQLiteDialect))
+        self.assertEqual(dialect.convert("id=%s"), "id=?")
+        self.assertEqual(dialect.quote("asd"), '"asd"')
+        self.assertEqual(asd._sql(("dialect",), lambda: "x=%s"), "x=?")
+
+        db = txdbapi.AdbapiPool("sqlite3", ":memory:")
+        self.assertTrue(isinstance(db.dialect, txdbapi.SQLiteDialect))
+        db.close()
+        db = txdbapi.AdbapiPool("sqlite3", ":memory:",
+                                dialect=txdbapi.MySQLDialect())
+        self.assertEqual(db.dialect.convert("id=%s"), "id=%s")
+        db.close()
+
+    @defer.inlineCallbacks
+    def test_24_crud_upsert(self):
+        yield BaseModel.db.runOperation(
+            "create table asdjson2 (id integer primary key autoincrement, "
+            "age int, name text unique)")
+
+        class asdjson2(BaseModel):
+            codecs = {"name": (json.dumps, json.loads)}
+            deny = ["x"]
+
+        foo = yield asdjson2.upsert(["name"], name=["foo"], age=1, x=1)
+        self.assertEqual((foo.id, foo.age, foo.name), (1, 1, ["foo"]))
+        foo = yield asdjson2.upsert(["name"], name=["foo"], age=2)
+        self.assertEqual((foo.id, foo.age), (1, 2))
+
+        objs = yield asdjson2.upsert_many(
+            [dict(name=[n], age=10 + n) for n in range(3)] +
+            [dict(name=["foo"], age=3), dict(name=[0], age=20)],
+            ["name"], chunk_size=2)
+        ids = [obj.id for obj in objs]
+        self.assertEqual((ids[3], ids[4]), (1, ids[0]))
+        self.assertEqual(len(set(ids)), 4)
+        rs = yield asdjson2.find(orderby="id")
+        self.assertEqual([(obj.id, obj.name, obj.age) for obj in rs],
+                         [(1, ["foo"], 3), (ids[0], [0], 20),
+                          (ids[1], [1], 11), (ids[2], [2], 12)])
+
+        class returningless(txdbapi.SQLiteDialect):
+            returning = False
+
+        BaseModel.db.dialect = returningless()
+        try:
+            objs = yield asdjson2.upsert_many(
+                [dict(name=[2], age=30), dict(name=[3], age=31)], ["name"],
+                update=["name"])
+        finally:
+            del BaseModel.db.dialect
+        self.assertEqual(objs[0].id, ids[2])
+        obj = yield asdjson2.find_first(where=("id=%s", ids[2]))
+        self.assertEqual(obj.age, 12)
+        obj = yield asdjson2.find_first(where=("id=%s", objs[1].id))
+        self.assertEqual((obj.name, obj.age), ([3], 31))
+        self.assertRaises(ValueError, asdjson2.upsert, ["name"], age=1)
+
+        # rows are matched as the database stores them
+        yield BaseModel.db.runOperation(
+            "create table asdcode (id integer primary key, code text unique)")
+
+        class asdcode(BaseModel):
+            pass
+
+        foo = yield asdcode.upsert(["code"], code=123)
+        self.assertEqual(foo.id, 1)
+        objs = yield asdcode.upsert_many([dict(code=123), dict(code=45)],
+                                         ["code"])
+        self.assertEqual([obj.id for obj in objs], [1, 2])
+
+        # and the objects returned hold values encoded once
+        yield BaseModel.db.runOperation(
+            "create table asdprice (id integer primary key, "
+            "name text unique, price int)")
+
+        class asdprice(BaseModel):
+            codecs = {"price": (lambda d: int(round(d * 100)),
+                                lambda c: c / 100.0)}
+
+        for refresh in (False, True):
+            asdprice.refresh = refresh
+            foo = yield asdprice.upsert(["name"], name="foo", price=3.5)
+            self.assertEqual(foo.price, 3.5)
+        rs = yield BaseModel.db.runQuery("select price from asdprice")
+        self.assertEqual(rs[0]["price"], 350)
+
+    @defer.inlineCallbacks
+    def test_25_model_write_behind(self):
+        class asdwb(BaseModel):
+            table_name = "asd"
+            write_behind = 60
+            write_behind_rows = 2
+
+        foo = yield asdwb.insert(name="wb1", age=0)
+        bar = yield asdwb.insert(name="wb2", age=0)
+        ds = []
+        for n in range(1, 6):
+            foo.age = n
+            ds.append(foo.save())
+        self.assertFalse([d for d in ds if d.called])
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(obj.age, 0)
+
+        nrows = yield asdwb.flush()
+        self.assertEqual(nrows, 1)
+        objs = yield defer.gatherResults(ds)
+        self.assertTrue(objs[0] is foo)
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(obj.age, 5)
+        info = asdwb.write_behind_info()
+        self.assertEqual((info["saves"], info["coalesced"], info["flushes"],
+                          info["rows"]), (5, 4, 1, 1))
+
+        # two pending rows reach write_behind_rows and flush right away
+        foo.age, bar.age = 6, 7
+        ds = [foo.save(), bar.save()]
+        self.assertEqual([d.called for d in ds], [True, True])
+        objs = yield asd.find(where=("name like %s", "wb%"), orderby="id")
+        self.assertEqual([obj.age for obj in objs], [6, 7])
+
+        # saves inside a transaction are part of it
+        def work(txn):
+            foo.age = 8
+            foo.save()
+
+        yield BaseModel.db.transaction(work)
+        info = asdwb.write_behind_info()
+        self.assertEqual((info["saves"], info["pending"]), (7, 0))
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(obj.age, 8)
+
+        # and the timer flushes what is left
+        asdwb.write_behind = 0
+        del asdwb._write_behind_queue
+        foo.age = 9
+        d = foo.save()
+        self.assertFalse(d.called)
+        yield d
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual(obj.age, 9)
+
+        # queued changes are filtered by allow and deny
+        class asdwbdeny(asdwb):
+            deny = ["name"]
+
+        foo = yield asdwbdeny.find_first(where=("id=%s", foo.id))
+        foo.name = "hacked"
+        yield foo.save()
+        self.assertEqual(asdwbdeny.write_behind_info()["saves"], 0)
+        foo.name, foo.age = "hacked", 10
+        d = foo.save()
+        yield asdwbdeny.flush()
+        yield d
+        obj = yield asd.find_first(where=("id=%s", foo.id))
+        self.assertEqual((obj.name, obj.age), ("wb1", 10))
+
+    @defer.inlineCallbacks
+    def test_26_model_replicas(self):
+        dbs = [txdbapi.ConnectionPool("sqlite3", ":memory:")
+               for n in range(3)]
+        for n, db in enumerate(dbs):
+            db.runOperation("create table rw "
+                            "(id integer primary key, name text)")
+            db.runOperation("insert into rw (name) values (%s)",
+                            ("db%d" % n,))
+
+        now = [100.0]
+        pools = txdbapi.Replicas(dbs[1:], read_your_writes=5)
+        pools.timer = lambda: now[0]
+
+        class rw(txdbapi.DatabaseModel):
+            db = dbs[0]
+            replicas = pools
+
+        names = []
+        for n in range(4):
+            obj = yield rw.find_first()
+            names.append(obj.name)
+        self.assertEqual(names, ["db1", "db2", "db1", "db2"])
+        batches = []
+        yield rw.iter_select(batches.append)
+        self.assertEqual(batches[0][0].name, "db1")
+
+        # reads after a write go to the primary for a while
+        yield rw.insert(name="new")
+        obj = yield rw.find_first(where=("name=%s", "new"))
+        self.assertEqual(obj.name, "new")
+        now[0] += 10
+        n = yield rw.count()
+        self.assertEqual(n, 1)
+        n = yield dbs[0].transaction(lambda txn: rw.count())
+        self.assertEqual(n, 2)
+        self.assertEqual(pools.info()["reads"], [3, 3])
+        self.assertEqual(pools.info()["primary_reads"], 1)
+
+        class stalled(object):
+            def __init__(self):
+                self.pending = []
+
+            def runQuery(self, *args):
+                self.pending.append(defer.Deferred())
+                return self.pending[-1]
+
+        slow = stalled()
+        rw.replicas = txdbapi.Replicas([slow, dbs[1]], policy="least_busy")
+        ds = [rw.count() for n in range(3)]
+        self.assertEqual(rw.replicas.info()["busy"], [1, 0])
+        self.assertEqual(rw.replicas.info()["reads"], [1, 2])
+        slow.pending[0].callback([{"count": 7}])
+        counts = yield defer.gatherResults(ds)
+        self.assertEqual(counts, [7, 1, 1])
+        self.assertEqual(rw.replicas.info()["busy"], [0, 0])
+        self.assertRaises(ValueError, txdbapi.Replicas, [], policy="random")
+        for db in dbs:
+            db.close()
+
+    @defer.inlineCallbacks
+    def test_27_model_count_cache(self):
+        yield BaseModel.db.runOperation(
+            "create table cnt (id integer primary key, name text)")
+
+        class cnt(BaseModel):
+            count_cache_ttl = 60
+
+        class cnt2(BaseModel):
+            table_name = "cnt"
+
+        yield cnt.insert_many([dict(name="c%d" % (n % 2)) for n in range(6)])
+        n = yield cnt.count()
+        self.assertEqual(n, 6)
+        n = yield cnt.count(where=("name=%s", "c0"))
+        self.assertEqual(n, 3)
+        yield cnt2.insert(name="c0")
+        n = yield cnt.count(where=("name=%s", "c0"))
+        self.assertEqual(n, 3)
+        info = cnt.count_cache_info()
+        self.assertEqual((info["hits"], info["size"]), (1, 2))
+
+        # writes through the model drop the cached counts
+        yield cnt.update(name="c0", where=("name=%s", "c1"))
+        n = yield cnt.count(where=("name=%s", "c0"))
+        self.assertEqual(n, 7)
+        yield cnt.insert(name="c1")
+        n = yield cnt.count()
+        self.assertEqual(n, 8)
+
+        def work(txn):
+            cnt.insert(name="c1")
+            return cnt.count()
+
+        n = yield BaseModel.db.transaction(work)
+        self.assertEqual(n, 9)
+        n = yield cnt.count()
+        self.assertEqual(n, 9)
+
+        # approximate counts use sqlite_stat1, once there is one
+        n = yield cnt2.count(approximate=True)
+        self.assertEqual(n, 9)
+        yield BaseModel.db.runOperation("analyze")
+        yield cnt2.insert(name="c1")
+        n = yield cnt2.count(approximate=True)
+        self.assertEqual(n, 9)
+        n = yield cnt2.count(approximate=True, where=("name=%s", "c1"))
+        self.assertEqual(n, 3)
+
+    @defer.inlineCallbacks
+    def test_28_model_projection(self):
+        yield BaseModel.db.runOperation(
+            "create table wide (id integer primary key, title text, "
+            "body text, meta text)")
+
+        class wide(BaseModel):
+            codecs = {"meta": (json.dumps, json.loads)}
+
+        yield wide.insert_many([dict(title="t%d" % n, body="b" * 1000,
+                                     meta={"n": n}) for n in range(5)])
+        rs = yield wide.select(columns=["title"], raw=True)
+        self.assertEqual(rs[0].keys(), ["id", "title"])
+
+        objs = yield wide.find(only=["title"], orderby="id")
+        self.assertEqual([obj.title for obj in objs],
+                         ["t%d" % n for n in range(5)])
+        self.assertRaises(AttributeError, getattr, objs[0], "body")
+        self.assertRaises(AttributeError, getattr, objs[0], "meta")
+
+        stats = BaseModel.db.instrument()
+        try:
+            yield wide.load_deferred(objs)
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual([obj.meta for obj in objs],
+                         [{"n": n} for n in range(5)])
+        self.assertEqual(len(objs[4].body), 1000)
+
+        obj = yield wide.find_first(defer=["body"], where=("id=%s", 2))
+        self.assertEqual(obj.meta, {"n": 1})
+        obj.title = "changed"
+        yield obj.save()
+        yield obj.load_deferred("body")
+        self.assertEqual(len(obj.body), 1000)
+        self.assertEqual(obj.title, "changed")
+
+        batches = []
+        yield wide.iter_select(batches.append, defer=["body", "meta"])
+        self.assertEqual(batches[0][0]._deferred, ("body", "meta"))
+        objs, token = yield wide.paginate(order_by="title", page_size=2,
+                                          only=["meta"])
+        self.assertEqual([obj.title for obj in objs], ["changed", "t0"])
+        objs, token = yield wide.paginate(order_by="title", page_size=2,
+                                          after=token, only=["meta"])
+        self.assertEqual([obj.title for obj in objs], ["t2", "t3"])
+
+    @defer.inlineCallbacks
+    def test_29_model_introspect(self):
+        yield BaseModel.db.runOperation(
+            "create table docs (id integer primary key, "
+            "title text not null default 'untitled', meta json)")
+
+        class docs(BaseModel):
+            type_codecs = {"json": (json.dumps, json.loads)}
+
+        class docs2(BaseModel):
+            table_name = "docs"
+
+        stats = BaseModel.db.instrument()
+        try:
+            models = yield txdbapi.introspect(docs, docs2, asd)
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(models, (docs, docs2, asd))
+        self.assertEqual(stats.calls, 1)
+
+        schema = yield docs.schema()
+        self.assertEqual(schema[0], txdbapi.Column("id", "INTEGER", True,
+                                                   None, True))
+        self.assertEqual(schema[1], txdbapi.Column("title", "TEXT", False,
+                                                   "'untitled'", False))
+        self.assertEqual(docs.table_columns().result,
+                         ("id", "title", "meta"))
+        self.assertEqual(docs.codecs.keys(), ["meta"])
+        self.assertEqual(docs2.codecs, {})
+
+        obj = yield docs.new(title="a", meta={"n": 1}).save()
+        self.assertRaises(ValueError, docs.update, nope=1)
+        yield self.assertFailure(docs.insert(title="b", nope=1), ValueError)
+        objs = yield docs.find(where=("id=%s", obj.id))
+        self.assertEqual(objs[0].meta, {"n": 1})
+        self.assertEqual(type(objs[0]).__name__, "docsRow")
+
+        yield self.assertFailure(txdbapi.introspect(asd, type(
+            "nosuch", (BaseModel,), {})), ValueError)
+
+    @defer.inlineCallbacks
+    def test_30_model_bulk_writes(self):
+        yield BaseModel.db.runOperation(
+            "create table bulk (id integer primary key, name text, n int)")
+
+        class bulk(BaseModel):
+            row_cache_size = 100
+
+        objs = yield bulk.insert_many([dict(name="b%d" % n, n=n)
+                                       for n in range(10)])
+        yield bulk.get(objs[0].id)
+
+        stats = BaseModel.db.instrument()
+        try:
+            n = yield bulk.update_many(objs[:5] + [objs[0].id], n=100)
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual((n, stats.calls), (5, 1))
+        self.assertEqual(objs[0].n, 100)
+        obj = yield bulk.get(objs[0].id)
+        self.assertEqual(obj.n, 100)
+
+        rows = yield bulk.find(orderby="id")
+        rows[0].name = "x"
+        rows[1].name = "y"
+        rows[2].n = 7
+        new = bulk.new(name="new", n=1)
+        stats = BaseModel.db.instrument()
+        try:
+            yield bulk.save_all(rows + [new])
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(new.id, 11)
+        self.assertEqual(rows[0]._changes, set())
+        rows = yield bulk.find(where=("id<=%s", 3), orderby="id")
+        self.assertEqual([(r.name, r.n) for r in rows],
+                         [("x", 100), ("y", 100), ("b2", 7)])
+
+        n = yield bulk.delete_many(rows + [new.id, 12])
+        self.assertEqual(n, 4)
+        self.assertFalse(rows[0]._saved())
+        n = yield bulk.count()
+        self.assertEqual(n, 7)
+        obj = yield bulk.get(1)
+        self.assertEqual(obj, None)
+
+        # values of objects are encoded once
+        yield BaseModel.db.runOperation(
+            "create table prices (id integer primary key, price int)")
+
+        class prices(BaseModel):
+            codecs = {"price": (lambda d: int(round(d * 100)),
+                                lambda c: c / 100.0)}
+
+        new = prices.new(price=1.5)
+        yield prices.save_all([new])
+        obj = yield prices.find_first(where=("id=%s", new.id))
+        self.assertEqual(obj.price, 1.5)
+        obj.price = 2.0
+        yield prices.save_all([obj])
+        rs = yield BaseModel.db.runQuery("select price from prices")
+        self.assertEqual(rs[0]["price"], 200)
+        objs = yield prices.insert_many([dict(price=2.5)])
+        self.assertEqual((objs[0].price, objs[0]._data["price"]), (2.5, 250))
+
+    @defer.inlineCallbacks
+    def test_31_model_as_columns(self):
+        yield BaseModel.db.runOperation(
+            "create table metrics (id integer primary key, host text, "
+            "hits int, load real)")
+
+        class metrics(BaseModel):
+            pass
+
+        yield metrics.insert_many([dict(host="h%d" % (n % 2), hits=n,
+                                        load=n / 2.0) for n in range(5)])
+        yield metrics.insert(host="h0", hits=None, load=None)
+        cols = yield metrics.select(as_columns=True, batch_size=2,
+                                    orderby="id")
+        self.assertEqual(sorted(cols), ["hits", "host", "id", "load"])
+        self.assertEqual(list(cols["id"]), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(cols["host"]),
+                         ["h0", "h1", "h0", "h1", "h0", "h0"])
+        self.assertEqual(list(cols["load"][:5]), [0, 0.5, 1, 1.5, 2])
+        self.assertEqual(sum(cols["hits"][:5]), 10)
+        self.assertTrue(cols["hits"][5] != cols["hits"][5])
+
+        cols = yield metrics.select(as_columns=True, columns=["hits"],
+                                    where=("host=%s", "h1"))
+        self.assertEqual(sorted(cols), ["hits", "id"])
+        self.assertEqual(list(cols["hits"]), [1, 3])
+
+        cols = yield metrics.select(as_columns=True, where=("id>%s", 10))
+        self.assertEqual(sorted(cols), ["hits", "host", "id", "load"])
+        self.assertEqual([len(v) for v in cols.values()], [0, 0, 0, 0])
+
+    @defer.inlineCallbacks
+    def test_32_model_query_cache(self):
+        yield BaseModel.db.runOperation(
+            "create table posts (id integer primary key, title text)")
+        cache = txdbapi.QueryCache(ttl=60)
+
+        class posts(BaseModel):
+            query_cache = cache
+
+        class posts2(BaseModel):
+            table_name = "posts"
+            query_cache = cache
+
+        yield posts.insert_many([dict(title="p%d" % n) for n in range(5)])
+        stats = BaseModel.db.instrument()
+        try:
+            for n in range(3):
+                objs = yield posts.find(where=("id>%s", 1), orderby="id",
+                                        limit=2)
+                n = yield posts.count()
+            self.assertEqual(stats.calls, 2)
+            self.assertEqual([obj.id for obj in objs], [2, 3])
+            self.assertEqual(n, 5)
+
+            # hits are new objects, not shared with other callers
+            objs[0].title = "changed"
+            objs = yield posts.find(where=("id>%s", 1), orderby="id",
+                                    limit=2)
+            self.assertEqual(objs[0].title, "p1")
+            self.assertEqual(stats.calls, 2)
+
+            # a write through any model on the table drops its results
+            yield posts2.insert(title="p5")
+            n = yield posts.count()
+            self.assertEqual(n, 6)
+            self.assertEqual(stats.calls, 4)
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(cache.info()["hits"], 5)
+
+        # results bigger than maxbytes are not kept
+        posts.query_cache = cache = txdbapi.QueryCache(maxbytes=300)
+        yield posts.find()
+        self.assertEqual(len(cache.lru), 0)
+        yield posts.count()
+        self.assertEqual(len(cache.lru), 1)
+        self.assertTrue(0 < cache.info()["weight"] <= 300)
+
+    @defer.inlineCallbacks
+    def test_33_model_load(self):
+        yield BaseModel.db.runOperation(
+            "create table people (id integer primary key, name text)")
+
+        class people(BaseModel):
+            row_cache_size = 10
+
+        yield people.insert_many([dict(name="p%d" % n) for n in range(5)])
+        stats = BaseModel.db.instrument()
+        try:
+            objs = yield defer.gatherResults([people.load(id)
+                                              for id in (3, 1, 3, 9, 2)])
+        finally:
+            BaseModel.db.recorder = None
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual([obj and obj.name for obj in objs],
+                         ["p2", "p0", "p2", None, "p1"])
+        self.assertTrue(objs[0] is objs[2])
+        info = people.load_info()
+        self.assertEqual((info["loads"], info["coalesced"], info["batches"]),
+                         (5, 1, 1))
+
+        # loaded rows go to the row cache, like get()
+        obj = yield people.load(1)
+        self.assertTrue(obj is objs[1])
+        self.assertEqual(people.load_info()["batches"], 1)
+
+        def work(txn):
+            return people.load(4)
+
+        obj = yield BaseModel.db.transaction(work)
+        self.assertEqual(obj.name, "p3")
+
+        # a failed batch fails its loads, and nothing else
+        class nosuch(BaseModel):
+            pass
+
+        yield self.assertFailure(nosuch.load(1), Exception)
+
+
+class Test_ThreadedSQLite(unittest.TestCase):
+    def setUp(self):
+        self.db = txdbapi.ConnectionPool("sqlite3", self.mktemp())
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_01_pool_type(self):
+        self.assertTrue(isinstance(self.db, txdbapi.ThreadedSQLite))
+        db = txdbapi.ConnectionPool("sqlite3", ":memory:")
+        self.assertFalse(isinstance(db, txdbapi.ThreadedSQLite))
+        db.close()
+
+    @defer.inlineCallbacks
+    def test_02_crud(self):
+        class asd(txdbapi.DatabaseModel):
+            db = self.db
+
+        d = self.db.runOperation(
+            "create table asd "
+            "(id integer primary key autoincrement, age int, name text)")
+        self.assertTrue(isinstance(d, defer.Deferred))
+        yield d
+
+        foo = yield asd.insert(name="foo", age=10)
+        self.assertEqual(foo.id, 1)
+        yield asd.update(age=20, where=("name=%s", "foo"))
+        foo = yield asd.find_first(where=("name=%s", "foo"))
+        self.assertEqual(foo.age, 20)
+        yield foo.delete()
+        nobjs = yield asd.count()
+        self.assertEqual(nobjs, 0)
+
+        yield asd.insert_many([dict(name="m%d" % n, age=n)
+                               for n in range(5)])
+        batches = []
+        total = yield asd.iter_select(batches.append, batch_size=2,
+                                      where=("name like %s", "m%"))
+        self.assertEqual(total, 5)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+        # the callback can query the db the batches are read from
+        counts = []
+        total = yield asd.iter_select(
+            lambda objs: asd.count().addCallback(counts.append),
+            batch_size=2)
+        self.assertEqual((total, counts), (5, [5, 5, 5]))
+        total = yield asd.iter_select(
+            lambda objs: asd.update(age=0, where=("id=%s", objs[0].id)),
+            batch_size=2)
+        self.assertEqual(total, 5)
+        nobjs = yield asd.count(where=("age=%s", 0))
+        self.assertEqual(nobjs, 3)
+
+    @defer.inlineCallbacks
+    def test_03_transaction(self):
+        class asd(txdbapi.DatabaseModel):
+            db = self.db
+
+        yield self.db.runOperation(
+            "create table asd "
+            "(id integer primary key autoincrement, age int, name text)")
+
+        def work(txn):
+            objs = [asd.new(name="t%d" % n, age=n) for n in range(3)]
+            for obj in objs:
+                obj.save()
+            return [obj.id for obj in objs]
+
+        ids = yield self.db.transaction(work)
+        self.assertEqual(ids, [1, 2, 3])
+        nobjs = yield asd.count()
+        self.assertEqual(nobjs, 3)
+
+    @defer.inlineCallbacks
+    def test_04_instrument(self):
+        stats = self.db.instrument()
+        yield self.db.runOperation("create table t (v int)")
+        yield self.db.runOperationMany("insert into t values (%s)",
+                                       [(n,) for n in range(3)])
+        rs = yield self.db.runQuery("select * from t")
+        self.assertEqual(len(rs), 3)
+        yield self.db.transaction(lambda txn: txn.runQuery("select 1"))
+
+        info = stats.info()
+        self.assertEqual(info["calls"], 4)
+        st = info["templates"]["select * from t"]
+        self.assertEqual((st["kind"], st["rows"]), ("runQuery", 3))
+        self.assertTrue(st["wait"] >= 0 and st["time"] >= 0)
+        self.assertEqual(info["templates"]["<lambda>"]["kind"], "transaction")
+
+    @defer.inlineCallbacks
+    def test_05_adbapi_pool_health(self):
+        self.db.close()
+        self.db = txdbapi.AdbapiPool("sqlite3", self.mktemp(),
+                                     check_same_thread=False,
+                                     cp_min=1, cp_max=2, cp_max_age=60,
+                                     cp_ping=0,
+                                     cp_init=["pragma cache_size=1234"])
+        opened = []
+        self.db.on_connect(opened.append)
+        self.db.start()
+
+        yield self.db.runOperation("create table t (v int)")
+        rs = yield self.db.runQuery("pragma cache_size")
+        self.assertEqual(rs[0][0], 1234)
+        yield defer.gatherResults([self.db.runQuery("select 1")
+                                   for n in range(10)])
+
+        info = self.db.pool_info()
+        self.assertEqual((info["checkouts"], info["checked_out"],
+                          info["waiters"]), (12, 0, 0))
+        self.assertTrue(1 <= info["connections"] <= 2)
+        self.assertEqual(info["idle"], info["connections"])
+        self.assertEqual(info["connects"], len(opened))
+        self.assertTrue(info["max_wait"] >= info["avg_wait"] >= 0)
+
+        # connections older than cp_max_age are reopened on checkout
+        self.db.max_age = 0
+        yield self.db.runQuery("select 1")
+        info = self.db.pool_info()
+        self.assertEqual(info["recycled"], 1)
+        self.assertEqual(info["connects"], len(opened))
+
+        # and idle ones beyond cp_min are closed
+        self.db.max_age = None
+        self.db.idle = 0
+        yield threads.deferToThreadPool(reactor, self.db.threadpool,
+                                        self.db._reap)
+        self.assertEqual(self.db.pool_info()["connections"], 1)
+
+    @defer.inlineCallbacks
+    def test_06_query_cache_single_flight(self):
+        class asd(txdbapi.DatabaseModel):
+            db = self.db
+            query_cache = txdbapi.QueryCache()
+
+        yield self.db.runOperation(
+            "create table asd (id integer primary key, name text)")
+        yield asd.insert(name="foo")
+        stats = self.db.instrument()
+        rs = yield defer.gatherResults([asd.find(where=("name=%s", "foo"))
+                                        for n in range(5)])
+        self.assertEqual([len(objs) for objs in rs], [1] * 5)
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(asd.query_cache.info()["coalesced"], 4)
+
+    @defer.inlineCallbacks
+    def test_07_plain_dialect_ids(self):
+        # a driver without a dialect of its own: ids come from lastrowid
+        class plain(txdbapi.Dialect):
+            mark = "?"
+            star = "id,*"
+
+        self.db.close()
+        self.db = txdbapi.AdbapiPool("sqlite3", self.mktemp(),
+                                     check_same_thread=False,
+                                     cp_min=1, cp_max=1, dialect=plain())
+        self.db.on_connect(setattr, "row_factory", sqlite3.Row)
+        self.db.start()
+
+        class asd(txdbapi.DatabaseModel):
+            db = self.db
+
+        yield self.db.runOperation(
+            "create table asd (id integer primary key, name text)")
+        foo = yield asd.insert(name="foo")
+        self.assertEqual(foo.id, 1)
+        objs = yield asd.insert_many([dict(name="m%d" % n)
+                                      for n in range(3)])
+        self.assertEqual([obj.id for obj in objs], [2, 3, 4])
+        self.assertRaises(NotImplementedError,
+                          plain().inserted_ids, None, 2)
+
+    @defer.inlineCallbacks
+    def test_08_transaction_caches(self):
+        # writes made on the pool thread touch the caches once committed
+        threads_seen = []
+
+        class queries(txdbapi.QueryCache):
+            def forget(self, table):
+                threads_seen.append(threading.current_thread())
+                txdbapi.QueryCache.forget(self, table)
+
+        class pools(txdbapi.Replicas):
+            def wrote(self):
+                threads_seen.append(threading.current_thread())
+                txdbapi.Replicas.wrote(self)
+
+        class asd(txdbapi.DatabaseModel):
+            db = self.db
+            query_cache = queries()
+            replicas = pools([])
+            count_cache_ttl = 60
+
+        yield self.db.runOperation(
+            "create table asd (id integer primary key, name text)")
+        nobjs = yield asd.count()
+        self.assertEqual(nobjs, 0)
+        del threads_seen[:]
+
+        def work(txn):
+            asd.insert(name="foo")
+            asd.update(name="bar", where=("name=%s", "foo"))
+            asd.upsert_many([dict(id=2, name="baz")], ["id"])
+
+        yield self.db.transaction(work)
+        self.assertTrue(threads_seen)
+        self.assertEqual(set(threads_seen),
+                         set([threading.current_thread()]))
+        nobjs = yield asd.count()
+        self.assertEqual(nobjs, 2)
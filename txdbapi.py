@@ -2,39 +2,666 @@
 # http://en.wikipedia.org/wiki/Active_record_pattern
 # http://en.wikipedia.org/wiki/Create,_read,_update_and_delete
 
+import array
+import base64
+import collections
+import json
+import random
+import re
 import sqlite3
 import sys
+import threading
+import time
 import types
 
 from twisted.enterprise import adbapi
 from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.python import failure
+from twisted.python import log
+from twisted.python import threadpool
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry.
+
+    Entries older than ``ttl`` seconds, if given, are dropped when read.
+    With ``maxweight``, entries are also evicted while the sum of their
+    ``weigh(value)`` exceeds it. Keeps ``hits``, ``misses``, ``evictions``
+    and ``expirations`` counters. A ``maxsize`` of zero disables it.
+    """
+    PREV, NEXT, KEY, VALUE, EXPIRES, WEIGHT = 0, 1, 2, 3, 4, 5
+    timer = staticmethod(time.time)
+
+    def __init__(self, maxsize=128, ttl=None, maxweight=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None, 0]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _drop(self, link):
+        self._unlink(link)
+        del self._map[link[self.KEY]]
+        self.weight -= link[self.WEIGHT]
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, root
+        last[self.NEXT] = root[self.PREV] = link
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        if link[self.EXPIRES] is not None and \
+                link[self.EXPIRES] <= self.timer():
+            self._drop(link)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = self.timer() + self.ttl
+
+        weight = 0
+        if self.maxweight is not None:
+            weight = self.weigh(value)
+            if weight > self.maxweight:
+                # would evict everything else; not cached
+                self.pop(key)
+                return
+
+        link = self._map.get(key)
+        if link is not None:
+            self._drop(link)
+
+        maxweight = self.maxweight
+        while self._map and (len(self._map) >= self.maxsize or
+                             maxweight is not None and
+                             self.weight + weight > maxweight):
+            self._drop(self._root[self.NEXT])
+            self.evictions += 1
+
+        link = [None, None, key, value, expires, weight]
+        self._append(link)
+        self._map[key] = link
+        self.weight += weight
+
+    def pop(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            return default
+
+        self._drop(link)
+        return link[self.VALUE]
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None, None, 0]
+        self.weight = 0
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": lookups and float(self.hits) / lookups or 0.0,
+                "size": len(self._map), "maxsize": self.maxsize,
+                "weight": self.weight, "maxweight": self.maxweight}
+
+
+class QueryStats(object):
+    """
+    Records the statements run through a database's run* methods.
+
+    For each statement template (the query string, or the name of an
+    interaction or transaction function) it keeps the number of calls
+    and errors, rows returned, time spent waiting for a thread, time
+    spent executing and a histogram of execution times. Statements
+    slower than ``slow`` seconds are logged and kept in ``slow_queries``.
+    Only a ``sample_rate`` fraction of the calls is recorded.
+    """
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    timer = staticmethod(time.time)
+
+    def __init__(self, slow=1.0, sample_rate=1.0, max_templates=1000,
+                 keep_slow=100):
+        self.slow = slow
+        self.sample_rate = sample_rate
+        self.max_templates = max_templates
+        self.keep_slow = keep_slow
+        self.reset()
+
+    def reset(self):
+        self.calls = self.errors = 0
+        self.templates = {}
+        self.slow_queries = []
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, kind, template, wait, elapsed, rows, failed=False):
+        st = self.templates.get(template)
+        if st is None:
+            if len(self.templates) >= self.max_templates:
+                template = "(other)"
+                st = self.templates.get(template)
+            if st is None:
+                st = self.templates[template] = {
+                    "kind": kind, "calls": 0, "errors": 0, "rows": 0,
+                    "wait": 0.0, "time": 0.0, "max": 0.0,
+                    "histogram": [0] * (len(self.buckets) + 1)}
+
+        self.calls += 1
+        st["calls"] += 1
+        st["rows"] += rows
+        st["wait"] += wait
+        st["time"] += elapsed
+        if elapsed > st["max"]:
+            st["max"] = elapsed
+        if failed:
+            self.errors += 1
+            st["errors"] += 1
+
+        n = 0
+        for bound in self.buckets:
+            if elapsed <= bound:
+                break
+            n += 1
+        st["histogram"][n] += 1
+
+        if self.slow is not None and elapsed >= self.slow:
+            log.msg("txdbapi: slow %s %.3fs (waited %.3fs): %s" %
+                    (kind, elapsed, wait, template))
+            self.slow_queries.append({"kind": kind, "template": template,
+                                      "wait": wait, "time": elapsed,
+                                      "at": self.timer()})
+            del self.slow_queries[:-self.keep_slow]
+
+    def info(self):
+        templates = {}
+        labels = ["<=%g" % b for b in self.buckets] + \
+                 [">%g" % self.buckets[-1]]
+        for template, st in self.templates.items():
+            st = dict(st)
+            st["histogram"] = dict(zip(labels, st["histogram"]))
+            templates[template] = st
+
+        return {"calls": self.calls, "errors": self.errors,
+                "sample_rate": self.sample_rate, "templates": templates,
+                "slow_queries": [dict(q) for q in self.slow_queries]}
+
+
+class Instrumented(object):
+    """
+    Lets a QueryStats, or anything with its ``sampled()`` and
+    ``record()`` methods, be plugged into a database.
+    """
+    recorder = None
+
+    def instrument(self, recorder=None):
+        """
+        Record statements into ``recorder``, a new QueryStats by default,
+        and return it. ``db.recorder = None`` turns it off.
+        """
+        self.recorder = recorder or QueryStats()
+        return self.recorder
+
+    @staticmethod
+    def _describe(f, args):
+        name = getattr(f, "__name__", "?")
+        kind = name.lstrip("_")
+        if kind in ("runQuery", "runOperation", "runOperationMany"):
+            return kind, args[0]
+        elif kind in ("runInteraction", "transaction"):
+            return kind, getattr(args[0], "__name__", "?")
+        return "runInteraction", name
+
+    def _measure(self, call, f, *args, **kwargs):
+        """
+        Return ``call(f, *args, **kwargs)``, where ``call`` runs ``f``,
+        possibly on another thread, and record it when sampled.
+        """
+        recorder = self.recorder
+        if recorder is None or not recorder.sampled():
+            return call(f, *args, **kwargs)
+
+        kind, template = self._describe(f, args)
+        timer = recorder.timer
+        times = [timer(), None, None]
+
+        def timed(*a, **kw):
+            times[1] = timer()
+            try:
+                return f(*a, **kw)
+            finally:
+                times[2] = timer()
+
+        def done(rs, failed=False):
+            started, finished = times[1] or times[0], times[2] or timer()
+            rows = len(rs) if kind == "runQuery" and not failed and \
+                isinstance(rs, (list, tuple)) else 0
+            recorder.record(kind, template, started - times[0],
+                            finished - started, rows, failed)
+            return rs
+
+        try:
+            rs = call(timed, *args, **kwargs)
+        except:
+            done(None, True)
+            raise
+
+        if isinstance(rs, defer.Deferred):
+            rs.addCallbacks(done, lambda f: done(f, True))
+            return rs
+        return done(rs)
+
+
+# a table column as read from the database catalog by introspect()
+Column = collections.namedtuple("Column",
+                                "name type nullable default primary_key")
+
+
+class Dialect(object):
+    """
+    What the CRUD code needs to know about a database driver, worked out
+    once when the database is created and kept as ``db.dialect``.
+
+    Supporting another driver takes a subclass registered in
+    ``dialects`` under its dbapiName.
+    """
+    name = None
+    # placeholder of the driver; generated SQL is written with %s
+    mark = "%s"
+    quote_char = '"'
+    # columns for select; sqlite3.Row needs id named explicitly
+    star = "*"
+    # insert/update ... returning, and on a multi-row insert in order
+    returning = False
+    returning_many = False
+    # (a, b) > (x, y) comparisons
+    row_values = True
+    # bound variables per statement, if limited
+    max_variables = None
+    # statement returning the id of the last insert as "id"; without
+    # one the DB-API cursor.lastrowid is used
+    last_id = None
+    # whether inserted_ids can tell the ids of a multi-row insert
+    many_ids = False
+    # catalog query for the columns of a list of tables, in order, as
+    # tbl, name, type, nullable, dflt and pk
+    describe_query = None
+
+    def convert(self, query):
+        if self.mark == "%s":
+            return query
+        return query.replace("%s", self.mark)
+
+    def quote(self, identifier):
+        return "%s%s%s" % (self.quote_char, identifier, self.quote_char)
+
+    def last_insert_id(self, trans):
+        """
+        Return the id of the row the last insert on ``trans`` created.
+        """
+        if self.last_id is not None:
+            trans.execute(self.last_id)
+            return trans.fetchall()[0]["id"]
+        id = getattr(trans, "lastrowid", None)
+        if id is None:
+            raise NotImplementedError(
+                "the %s dialect has no last_id statement and its cursor "
+                "no lastrowid" % (self.name or self.__class__.__name__))
+        return id
+
+    def inserted_ids(self, trans, nrows):
+        """
+        Return the ids of the ``nrows`` rows the last multi-row insert on
+        ``trans`` created.
+        """
+        if nrows == 1:
+            return [self.last_insert_id(trans)]
+        raise NotImplementedError(
+            "the %s dialect can't tell the ids of a multi-row insert" %
+            (self.name or self.__class__.__name__))
+
+    def stream_cursor(self, conn, name, batch_size):
+        """
+        Return a cursor that reads results from the server in batches.
+        """
+        return conn.cursor()
+
+    def estimate_rows(self, trans, table):
+        """
+        Return the number of rows of ``table`` according to the planner
+        statistics, or None if there are none.
+        """
+        return None
+
+    def describe(self, trans, tables):
+        """
+        Return ``{table: (Column, ...)}`` for the ``tables`` that exist,
+        read from the catalog with one query.
+        """
+        if self.describe_query is None:
+            raise NotImplementedError("%s has no introspection" % self.name)
+        trans.execute(self.convert(self.describe_query % ",".join(
+            ["%s"] * len(tables))), tuple(tables))
+        found = {}
+        for r in trans.fetchall():
+            found.setdefault(r["tbl"], []).append(self._column(
+                r["name"], r["type"], r["nullable"], r["dflt"], r["pk"]))
+        return dict([(k, tuple(v)) for k, v in found.items()])
+
+    @staticmethod
+    def _column(name, type, nullable, default, primary_key):
+        # names as the driver's rows are keyed: str, not unicode
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return Column(name, type or "", bool(nullable), default,
+                      bool(primary_key))
+
+    def upsert(self, table, keys, conflict, update, nrows=1):
+        """
+        Return an insert of ``nrows`` rows of ``keys`` into ``table`` that
+        updates the ``update`` columns of rows that conflict on
+        ``conflict`` instead.
+        """
+        raise NotImplementedError("%s has no upsert" % self.name)
+
+    @staticmethod
+    def _values(table, keys, nrows):
+        row = "(%s)" % ",".join(["%s"] * len(keys))
+        return "insert into %s (%s) values %s" % (
+            table, ",".join(keys), ",".join([row] * nrows))
+
+    def _on_conflict(self, table, keys, conflict, update, nrows):
+        q = "%s on conflict (%s) do " % (self._values(table, keys, nrows),
+                                         ",".join(conflict))
+        if update:
+            return q + "update set " + ",".join(
+                ["%s=excluded.%s" % (k, k) for k in update])
+        return q + "nothing"
+
+
+class SQLiteDialect(Dialect):
+    name = "sqlite3"
+    mark = "?"
+    star = "id,*"
+    returning = sqlite3.sqlite_version_info >= (3, 35)
+    row_values = sqlite3.sqlite_version_info >= (3, 15)
+    # SQLITE_MAX_VARIABLE_NUMBER defaults to 999
+    max_variables = 999
+    last_id = "select last_insert_rowid() as id"
+    many_ids = True
+    describe_query = (
+        'select m.name as tbl, p.name as name, p.type as type, '
+        'not p."notnull" as nullable, p.dflt_value as dflt, p.pk > 0 as pk '
+        "from sqlite_master m, pragma_table_info(m.name) p "
+        "where m.type in ('table', 'view') and m.name in (%s) "
+        "order by m.name, p.cid")
+
+    def inserted_ids(self, trans, nrows):
+        # id of the last row
+        last = self.last_insert_id(trans)
+        return range(last - nrows + 1, last + 1)
+
+    def estimate_rows(self, trans, table):
+        # sqlite_stat1 exists once ANALYZE has run; the first number of
+        # each entry is the row count of the table or index
+        trans.execute("select name from sqlite_master "
+                      "where name = 'sqlite_stat1'")
+        if not trans.fetchall():
+            return None
+        trans.execute(self.convert("select stat from sqlite_stat1 "
+                                   "where tbl = %s"), (table,))
+        rows = [int(r["stat"].split()[0]) for r in trans.fetchall()]
+        return rows and max(rows) or None
+
+    def describe(self, trans, tables):
+        # pragma functions can be joined from 3.16 on; before, it takes
+        # a pragma per table
+        if sqlite3.sqlite_version_info >= (3, 16):
+            return Dialect.describe(self, trans, tables)
+        found = {}
+        for table in tables:
+            trans.execute("pragma table_info(%s)" % self.quote(table))
+            columns = tuple([self._column(r["name"], r["type"],
+                                          not r["notnull"], r["dflt_value"],
+                                          r["pk"] > 0)
+                             for r in trans.fetchall()])
+            if columns:
+                found[table] = columns
+        return found
+
+    def upsert(self, table, keys, conflict, update, nrows=1):
+        if sqlite3.sqlite_version_info < (3, 24):
+            Dialect.upsert(self, table, keys, conflict, update)
+        return self._on_conflict(table, keys, conflict, update, nrows)
+
+
+class MySQLDialect(Dialect):
+    name = "MySQLdb"
+    quote_char = "`"
+    last_id = "select last_insert_id() as id"
+    many_ids = True
+    describe_query = (
+        "select table_name as tbl, column_name as name, data_type as type, "
+        "is_nullable = 'YES' as nullable, column_default as dflt, "
+        "column_key = 'PRI' as pk from information_schema.columns "
+        "where table_schema = database() and table_name in (%s) "
+        "order by table_name, ordinal_position")
+
+    def inserted_ids(self, trans, nrows):
+        # id of the first row; the rest are contiguous
+        first = self.last_insert_id(trans)
+        return range(first, first + nrows)
+
+    def stream_cursor(self, conn, name, batch_size):
+        import MySQLdb.cursors
+        return conn.cursor(MySQLdb.cursors.SSDictCursor)
+
+    def estimate_rows(self, trans, table):
+        trans.execute("select table_rows as count "
+                      "from information_schema.tables "
+                      "where table_schema = database() and table_name = %s",
+                      (table,))
+        rs = trans.fetchall()
+        return rs and rs[0]["count"] is not None and \
+            int(rs[0]["count"]) or None
+
+    def upsert(self, table, keys, conflict, update, nrows=1):
+        q = self._values(table, keys, nrows)
+        if update:
+            return q + " on duplicate key update " + ",".join(
+                ["%s=values(%s)" % (k, k) for k in update])
+        return q.replace("insert", "insert ignore", 1)
+
+
+class PostgresDialect(Dialect):
+    name = "psycopg2"
+    returning = True
+    returning_many = True
+    describe_query = (
+        "select c.relname as tbl, a.attname as name, "
+        "format_type(a.atttypid, a.atttypmod) as type, "
+        "not a.attnotnull as nullable, "
+        "pg_get_expr(d.adbin, d.adrelid) as dflt, "
+        "coalesce(a.attnum = any(i.indkey), false) as pk "
+        "from pg_attribute a join pg_class c on c.oid = a.attrelid "
+        "left join pg_attrdef d "
+        "on d.adrelid = a.attrelid and d.adnum = a.attnum "
+        "left join pg_index i on i.indrelid = c.oid and i.indisprimary "
+        "where c.relname in (%s) and c.relkind in ('r', 'v', 'm', 'p') "
+        "and pg_table_is_visible(c.oid) and a.attnum > 0 "
+        "and not a.attisdropped order by c.relname, a.attnum")
+
+    def stream_cursor(self, conn, name, batch_size):
+        curs = conn.cursor(name)
+        curs.itersize = batch_size
+        return curs
+
+    def estimate_rows(self, trans, table):
+        # reltuples is -1 until the table is first vacuumed or analyzed
+        trans.execute("select reltuples::bigint as count from pg_class "
+                      "where oid = %s::regclass", (table,))
+        rs = trans.fetchall()
+        return rs and rs[0]["count"] >= 0 and int(rs[0]["count"]) or None
+
+    def upsert(self, table, keys, conflict, update, nrows=1):
+        return self._on_conflict(table, keys, conflict, update, nrows)
+
+
+dialects = {
+    "sqlite3": SQLiteDialect,
+    "MySQLdb": MySQLDialect,
+    "psycopg2": PostgresDialect,
+}
+
+
+def _call(f, *args, **kwargs):
+    return f(*args, **kwargs)
+
+
+def _fetch(trans, *args, **kwargs):
+    trans.execute(*args, **kwargs)
+    return trans.fetchall()
+
+
+class InlineSQLite(Instrumented):
+    dbapiName = "sqlite3"
+    dialect = SQLiteDialect()
 
-
-class InlineSQLite:
     def __init__(self, dbname, autocommit=True, cursorclass=None):
+        self.dbname = dbname
         self.autocommit = autocommit
-        self.conn = sqlite3.connect(dbname)
-        if cursorclass:
-            self.conn.row_factory = cursorclass
+        self.cursorclass = cursorclass
+        self._queries = LRUCache(256)
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.dbname)
+        if self.cursorclass:
+            self.conn.row_factory = self.cursorclass
 
         self.curs = self.conn.cursor()
 
-    def runQuery(self, query, *args, **kwargs):
-        self.curs.execute(query.replace("%s", "?"), *args, **kwargs)
+    def _convert(self, query):
+        if "%s" not in query:
+            # the model's SQL is converted already
+            return query
+
+        q = self._queries.get(query)
+        if q is None:
+            q = query.replace("%s", "?")
+            self._queries.set(query, q)
+        return q
+
+    def runQuery(self, *args, **kwargs):
+        return self._measure(_call, self._runQuery, *args, **kwargs)
+
+    def runOperation(self, *args, **kwargs):
+        return self._measure(_call, self._runOperation, *args, **kwargs)
+
+    def runOperationMany(self, *args, **kwargs):
+        return self._measure(_call, self._runOperationMany, *args, **kwargs)
+
+    def runInteraction(self, *args, **kwargs):
+        return self._measure(_call, self._runInteraction, *args, **kwargs)
+
+    def _runQuery(self, query, *args, **kwargs):
+        self.curs.execute(self._convert(query), *args, **kwargs)
         return self.curs.fetchall()
 
-    def runOperation(self, command, *args, **kwargs):
-        self.curs.execute(command.replace("%s", "?"), *args, **kwargs)
+    def _runOperation(self, command, *args, **kwargs):
+        self.curs.execute(self._convert(command), *args, **kwargs)
         if self.autocommit is True:
             self.conn.commit()
 
-    def runOperationMany(self, command, *args, **kwargs):
-        self.curs.executemany(command.replace("%s", "?"), *args, **kwargs)
+    def _runOperationMany(self, command, *args, **kwargs):
+        self.curs.executemany(self._convert(command), *args, **kwargs)
         if self.autocommit is True:
             self.conn.commit()
 
-    def runInteraction(self, interaction, *args, **kwargs):
-        return interaction(self.curs, *args, **kwargs)
+    def _runInteraction(self, interaction, *args, **kwargs):
+        try:
+            result = interaction(self.curs, *args, **kwargs)
+        except:
+            if self.autocommit is True:
+                self.conn.rollback()
+            raise
+
+        if self.autocommit is True:
+            self.conn.commit()
+        return result
+
+    def runWithConnection(self, func, *args, **kwargs):
+        try:
+            result = func(self.conn, *args, **kwargs)
+        except:
+            if self.autocommit is True:
+                self.conn.rollback()
+            raise
+
+        if self.autocommit is True:
+            self.conn.commit()
+        return result
+
+    def _transaction(self, func, args, kwargs):
+        txn = Transaction(self, self.conn, self.curs)
+        try:
+            result = txn.run(func, args, kwargs)
+        except:
+            self.conn.rollback()
+            raise
+
+        self.conn.commit()
+        return txn, result
+
+    def transaction(self, func, *args, **kwargs):
+        """
+        Call ``func(txn, *args, **kwargs)`` with every statement, including
+        model calls, in one transaction that is committed once at the end,
+        whatever ``autocommit`` says, or rolled back if ``func`` raises.
+        """
+        txn = Transaction.current(self)
+        if txn is not None:
+            return txn.run(func, args, kwargs)
+
+        txn, result = self._measure(_call, self._transaction, func, args,
+                                    kwargs)
+        txn.committed()
+        return result
 
     def commit(self):
         self.conn.commit()
@@ -46,64 +673,1019 @@ class InlineSQLite:
         self.conn.close()
 
 
+class ThreadedSQLite(InlineSQLite):
+    """
+    SQLite on a dedicated worker thread.
+
+    The connection is created and used by a single thread, as sqlite3
+    requires, and every call returns a Deferred so that slow queries
+    don't block the reactor.
+    """
+    def __init__(self, dbname, autocommit=True, cursorclass=None):
+        from twisted.internet import reactor
+        self.dbname = dbname
+        self.autocommit = autocommit
+        self.cursorclass = cursorclass
+        self._queries = LRUCache(256)
+        self.conn = None
+        self.curs = None
+        self.running = False
+        self.threadpool = threadpool.ThreadPool(1, 1, "txdbapi-sqlite")
+        self.shutdownID = None
+        self._reactor = reactor
+        self.startID = reactor.callWhenRunning(self._start)
+
+    def _start(self):
+        self.startID = None
+        self.threadpool.start()
+        self.shutdownID = self._reactor.addSystemEventTrigger(
+            "during", "shutdown", self.finalClose)
+        self.running = True
+
+    def _call(self, f, *args, **kwargs):
+        return self._measure(self._defer, f, *args, **kwargs)
+
+    def _defer(self, f, *args, **kwargs):
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+                                         self._run, f, *args, **kwargs)
+
+    def _run(self, f, *args, **kwargs):
+        if self.conn is None:
+            self._connect()
+        return f(self, *args, **kwargs)
+
+    def _disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = self.curs = None
+
+    def runQuery(self, *args, **kwargs):
+        return self._call(InlineSQLite._runQuery, *args, **kwargs)
+
+    def runOperation(self, *args, **kwargs):
+        return self._call(InlineSQLite._runOperation, *args, **kwargs)
+
+    def runOperationMany(self, *args, **kwargs):
+        return self._call(InlineSQLite._runOperationMany, *args, **kwargs)
+
+    def runInteraction(self, *args, **kwargs):
+        return self._call(InlineSQLite._runInteraction, *args, **kwargs)
+
+    def runWithConnection(self, *args, **kwargs):
+        return self._defer(InlineSQLite.runWithConnection, *args, **kwargs)
+
+    def transaction(self, func, *args, **kwargs):
+        txn = Transaction.current(self)
+        if txn is not None:
+            return txn.run(func, args, kwargs)
+
+        d = self._call(InlineSQLite._transaction, func, args, kwargs)
+        d.addCallback(Transaction.finish)
+        return d
+
+    def commit(self):
+        return self._defer(InlineSQLite.commit)
+
+    def rollback(self):
+        return self._defer(InlineSQLite.rollback)
+
+    def close(self):
+        if self.shutdownID:
+            self._reactor.removeSystemEventTrigger(self.shutdownID)
+            self.shutdownID = None
+        if self.startID:
+            self._reactor.removeSystemEventTrigger(self.startID)
+            self.startID = None
+        self.finalClose()
+
+    def finalClose(self):
+        self.shutdownID = None
+        if self.running:
+            self.threadpool.callInThread(self._disconnect)
+            self.threadpool.stop()
+            self.running = False
+
+
+class AdbapiPool(adbapi.ConnectionPool, Instrumented):
+    """
+    ``adbapi.ConnectionPool`` for MySQL and Postgres, with transaction(),
+    runOperationMany(), instrument() and pool_info().
+
+    Besides adbapi's ``cp_*`` arguments it takes:
+
+    - ``cp_max_age``: seconds after which a connection is closed, and
+      reopened at its next checkout
+    - ``cp_idle``: seconds after which idle connections beyond ``cp_min``
+      are closed; their threads open new ones when the load comes back
+    - ``cp_ping``: seconds a connection may stay idle before it is
+      checked with ``cp_good_sql`` on checkout (0 checks it every time),
+      and reopened if that fails
+    - ``cp_init``: statements run on each new connection, such as session
+      settings or prepared statements; see also on_connect()
+
+    Connections are bound to the pool's threads, so at most ``cp_max``
+    are open. Idle connections are closed from another pool thread,
+    which the driver must allow.
+    """
+    CP_ARGS = adbapi.ConnectionPool.CP_ARGS + ["max_age", "idle", "ping",
+                                               "init"]
+    max_age = None
+    idle = None
+    ping = None
+    init = ()
+    timer = staticmethod(time.time)
+
+    def __init__(self, dbapiName, *args, **kwargs):
+        dialect = kwargs.pop("dialect", None)
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._busy = set()
+        self._used = {}
+        self._reaper = None
+        self.waiters = self.checked_out = self.checkouts = 0
+        self.wait_time = self.max_wait = 0.0
+        self.connects = self.disconnects = 0
+        self.recycled = self.ping_failures = 0
+        adbapi.ConnectionPool.__init__(self, dbapiName, *args, **kwargs)
+        self.dialect = dialect or dialects.get(dbapiName, Dialect)()
+
+    def on_connect(self, f, *args, **kwargs):
+        """
+        Call ``f(conn, *args, **kwargs)``, on a pool thread, for each new
+        connection, after the ``cp_init`` statements.
+        """
+        self._hooks.append((f, args, kwargs))
+
+    def resize(self, minconn, maxconn):
+        """
+        Change the number of pool threads, and so of connections, to
+        between ``minconn`` and ``maxconn``.
+        """
+        self.min, self.max = minconn, maxconn
+        self.threadpool.adjustPoolsize(minconn, maxconn)
+
+    def start(self):
+        adbapi.ConnectionPool.start(self)
+        if self.idle and self._reaper is None:
+            self._reaper = task.LoopingCall(self.threadpool.callInThread,
+                                            self._reap)
+            self._reaper.clock = self._reactor
+            self._reaper.start(self.idle, now=False)
+
+    def finalClose(self):
+        if self._reaper is not None:
+            if self._reaper.running:
+                self._reaper.stop()
+            self._reaper = None
+        adbapi.ConnectionPool.finalClose(self)
+
+    def pool_info(self):
+        with self._lock:
+            idle = len([tid for tid in self.connections.keys()
+                        if tid not in self._busy])
+            return {"min": self.min, "max": self.max,
+                    "connections": len(self.connections), "idle": idle,
+                    "checked_out": self.checked_out,
+                    "waiters": self.waiters, "checkouts": self.checkouts,
+                    "wait_time": self.wait_time, "max_wait": self.max_wait,
+                    "avg_wait": self.checkouts and
+                    self.wait_time / self.checkouts or 0.0,
+                    "connects": self.connects,
+                    "disconnects": self.disconnects,
+                    "recycled": self.recycled,
+                    "ping_failures": self.ping_failures}
+
+    def _dispatch(self, run, *args, **kwargs):
+        with self._lock:
+            self.waiters += 1
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+                                         self._checkout, self.timer(), run,
+                                         *args, **kwargs)
+
+    def _checkout(self, queued, run, *args, **kwargs):
+        tid = self.threadID()
+        wait = self.timer() - queued
+        with self._lock:
+            self.waiters -= 1
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_time += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+            self._busy.add(tid)
+
+        try:
+            return run(self, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.checked_out -= 1
+                self._busy.discard(tid)
+                if tid in self._used:
+                    self._used[tid][1] = self.timer()
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        return self._measure(self._interact, interaction, *args, **kwargs)
+
+    def _interact(self, interaction, *args, **kwargs):
+        return self._dispatch(adbapi.ConnectionPool._runInteraction,
+                              interaction, *args, **kwargs)
+
+    def runWithConnection(self, func, *args, **kwargs):
+        return self._dispatch(adbapi.ConnectionPool._runWithConnection,
+                              func, *args, **kwargs)
+
+    def connect(self):
+        """
+        Return this thread's connection, recycling it when older than
+        ``cp_max_age`` or when it fails the ``cp_ping`` check.
+        """
+        tid = self.threadID()
+        now = self.timer()
+        conn = self.connections.get(tid)
+        if conn is not None:
+            opened, used = self._used.get(tid, (now, now))
+            if self.max_age is not None and now - opened >= self.max_age:
+                with self._lock:
+                    self.recycled += 1
+                self.disconnect(conn)
+                conn = None
+            elif self.ping is not None and now - used >= self.ping and \
+                    not self._alive(conn):
+                with self._lock:
+                    self.ping_failures += 1
+                self.disconnect(conn)
+                conn = None
+
+        if conn is None:
+            conn = adbapi.ConnectionPool.connect(self)
+            with self._lock:
+                self.connects += 1
+                self._used[tid] = [now, now]
+            try:
+                self._setup(conn)
+            except:
+                self.disconnect(conn)
+                raise
+        return conn
+
+    def disconnect(self, conn):
+        adbapi.ConnectionPool.disconnect(self, conn)
+        with self._lock:
+            self.disconnects += 1
+            self._used.pop(self.threadID(), None)
+
+    def _alive(self, conn):
+        try:
+            curs = conn.cursor()
+            curs.execute(self.good_sql)
+            curs.fetchall()
+            curs.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _setup(self, conn):
+        if self.init:
+            curs = conn.cursor()
+            for q in self.init:
+                curs.execute(q)
+            curs.close()
+        for f, args, kwargs in self._hooks:
+            f(conn, *args, **kwargs)
+        conn.commit()
+
+    def _reap(self):
+        # runs on a pool thread; connections in use are never picked
+        now = self.timer()
+        with self._lock:
+            idle = sorted([(used, tid) for tid, (opened, used)
+                           in self._used.items()
+                           if tid not in self._busy and
+                           now - used >= self.idle])
+            conns = []
+            for used, tid in idle[:max(0, len(self.connections) - self.min)]:
+                conn = self.connections.pop(tid, None)
+                del self._used[tid]
+                if conn is not None:
+                    conns.append(conn)
+            self.disconnects += len(conns)
+
+        for conn in conns:
+            self._close(conn)
+
+    def runOperationMany(self, *args, **kwargs):
+        return self.runInteraction(self._runOperationMany, *args, **kwargs)
+
+    def _runOperationMany(self, trans, *args, **kwargs):
+        trans.executemany(*args, **kwargs)
+
+    def _transaction(self, trans, func, args, kwargs):
+        txn = Transaction(self, trans._connection, trans)
+        return txn, txn.run(func, args, kwargs)
+
+    def transaction(self, func, *args, **kwargs):
+        """
+        Call ``func(txn, *args, **kwargs)`` on a pool thread, with every
+        statement, including model calls, on one connection and committed
+        once at the end, or rolled back if ``func`` raises.
+
+        Returns a Deferred firing with the result of ``func``.
+        """
+        txn = Transaction.current(self)
+        if txn is not None:
+            return txn.run(func, args, kwargs)
+
+        d = self.runInteraction(self._transaction, func, args, kwargs)
+        d.addCallback(Transaction.finish)
+        return d
+
+
+class Transaction(object):
+    """
+    The database as seen from inside ``db.transaction()``.
+
+    It has the same run* methods as the database, but they run right
+    away on the transaction's cursor and return plain results. Model
+    calls made by the transaction function on the same thread use it
+    instead of their ``db``, so they fire synchronously and are part of
+    the transaction. The function must not wait on anything else.
+    """
+    _local = threading.local()
+
+    def __init__(self, db, conn, curs):
+        self.db = db
+        self.conn = conn
+        self.curs = curs
+        self.dbapiName = db.dbapiName
+        self.dialect = db.dialect
+        self._on_commit = []
+        if isinstance(db, InlineSQLite):
+            self._convert = db._convert
+        else:
+            self._convert = db.dialect.convert
+
+    @classmethod
+    def current(cls, db):
+        """
+        Return the transaction open on ``db`` in this thread, or None.
+        """
+        return cls._local.__dict__.get("open", {}).get(db)
+
+    def run(self, func, args, kwargs):
+        """
+        Call ``func(self, *args, **kwargs)`` with this transaction open and
+        return its result, which may be a Deferred that already fired.
+        """
+        opened = self._local.__dict__.setdefault("open", {})
+        outer = opened.get(self.db)
+        opened[self.db] = self
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            if outer is None:
+                del opened[self.db]
+
+        if isinstance(result, defer.Deferred):
+            rs = []
+            result.addBoth(rs.append)
+            if not rs:
+                raise RuntimeError("the transaction function waited on a "
+                                   "Deferred outside the transaction")
+            if isinstance(rs[0], failure.Failure):
+                rs[0].raiseException()
+            result = rs[0]
+        return result
+
+    def after_commit(self, f, *args, **kwargs):
+        """
+        Call ``f(*args, **kwargs)`` once the transaction has committed.
+        """
+        self._on_commit.append((f, args, kwargs))
+
+    def committed(self):
+        for f, args, kwargs in self._on_commit:
+            f(*args, **kwargs)
+        del self._on_commit[:]
+
+    @staticmethod
+    def finish(rs):
+        txn, result = rs
+        txn.committed()
+        return result
+
+    def runQuery(self, query, *args, **kwargs):
+        self.curs.execute(self._convert(query), *args, **kwargs)
+        return self.curs.fetchall()
+
+    def runOperation(self, command, *args, **kwargs):
+        self.curs.execute(self._convert(command), *args, **kwargs)
+
+    def runOperationMany(self, command, *args, **kwargs):
+        self.curs.executemany(self._convert(command), *args, **kwargs)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        return interaction(self.curs, *args, **kwargs)
+
+    def runWithConnection(self, func, *args, **kwargs):
+        return func(self.conn, *args, **kwargs)
+
+
 def ConnectionPool(dbapiName, *args, **kwargs):
     if dbapiName == "sqlite3":
-        if sys.version_info < (2, 6):
-            # hax for py2.5
-            def __row(cursor, row):
-                d = {}
-                for idx, col in enumerate(cursor.description):
-                    d[col[0]] = row[idx]
-                return d
-
-            kwargs["cursorclass"] = __row
-        else:
-            kwargs["cursorclass"] = sqlite3.Row
+        inline = kwargs.pop("inline", None)
+        if inline is None:
+            dbname = args[0] if args else kwargs.get("dbname")
+            inline = dbname == ":memory:"
+
+        kwargs["cursorclass"] = sqlite3.Row
 
-        return InlineSQLite(*args, **kwargs)
+        if inline:
+            return InlineSQLite(*args, **kwargs)
+        else:
+            return ThreadedSQLite(*args, **kwargs)
 
     elif dbapiName == "MySQLdb":
         import MySQLdb.cursors
         kwargs["cursorclass"] = MySQLdb.cursors.DictCursor
-        return adbapi.ConnectionPool(dbapiName, *args, **kwargs)
+        return AdbapiPool(dbapiName, *args, **kwargs)
 
     elif dbapiName == "psycopg2":
-        import psycopg2
         import psycopg2.extras
-        psycopg2.connect = psycopg2.extras.RealDictConnection
-        return adbapi.ConnectionPool(dbapiName, *args, **kwargs)
+        kwargs.setdefault("connection_factory",
+                          psycopg2.extras.RealDictConnection)
+        return AdbapiPool(dbapiName, *args, **kwargs)
+
+    elif dbapiName in dialects:
+        # a driver registered by the application, with rows as dicts
+        return AdbapiPool(dbapiName, *args, **kwargs)
 
     else:
         raise ValueError("Database %s is not yet supported." % dbapiName)
 
 
+class Replicas(object):
+    """
+    Read-only copies of a database, for the ``replicas`` attribute of
+    models that use it as their ``db``.
+
+    Reads made outside of transactions go to one of ``pools``, picked
+    in turn, or with ``policy="least_busy"`` the one with the fewest
+    reads in flight. For ``read_your_writes`` seconds after a write is
+    sent through any model using them, reads go to the primary instead,
+    so replication lag does not hide it.
+    """
+    policies = ("round_robin", "least_busy")
+    timer = staticmethod(time.time)
+
+    def __init__(self, pools, policy="round_robin", read_your_writes=1.0):
+        if policy not in self.policies:
+            raise ValueError("Unknown replica policy %r" % policy)
+        self.pools = list(pools)
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self.reads = [0] * len(self.pools)
+        self.busy = [0] * len(self.pools)
+        self.primary_reads = 0
+        self._next = 0
+        self._pinned_until = 0.0
+
+    def wrote(self):
+        until = self.timer() + self.read_your_writes
+        if until > self._pinned_until:
+            self._pinned_until = until
+
+    def pinned(self):
+        return self.timer() < self._pinned_until
+
+    def pick(self):
+        """
+        Return the index of the pool for the next read, or None for the
+        primary.
+        """
+        if not self.pools or self.pinned():
+            return None
+        if self.policy == "least_busy":
+            return min(xrange(len(self.pools)),
+                       key=lambda n: (self.busy[n], self.reads[n]))
+        n = self._next % len(self.pools)
+        self._next = n + 1
+        return n
+
+    def run(self, primary, f, *args):
+        """
+        Return ``f(db, *args)`` with ``db`` the pool picked for a read.
+        """
+        n = self.pick()
+        if n is None:
+            self.primary_reads += 1
+            return f(primary, *args)
+
+        self.reads[n] += 1
+        self.busy[n] += 1
+        try:
+            d = f(self.pools[n], *args)
+        except:
+            self.busy[n] -= 1
+            raise
+
+        if isinstance(d, defer.Deferred):
+            d.addBoth(self._done, n)
+        else:
+            self.busy[n] -= 1
+        return d
+
+    def _done(self, result, n):
+        self.busy[n] -= 1
+        return result
+
+    def info(self):
+        return {"policy": self.policy, "reads": list(self.reads),
+                "busy": list(self.busy), "primary_reads": self.primary_reads,
+                "pinned": self.pinned()}
+
+
+class QueryCache(object):
+    """
+    Results of the selects and counts of the models that set it as their
+    ``query_cache``, keyed by SQL and arguments.
+
+    Entries are dropped least recently used first once there are more
+    than ``maxsize`` of them or they take more than ``maxbytes``, as
+    estimated by sizeof(), and ``ttl`` seconds after they were read.
+    A write through any of those models drops the entries of its table
+    (see forget()). Identical queries that miss while one is in flight
+    wait for its result instead of running again.
+    """
+
+    def __init__(self, maxbytes=16 << 20, ttl=60, maxsize=10000):
+        self.lru = LRUCache(maxsize, ttl, maxbytes, self.sizeof)
+        self.coalesced = self.invalidations = 0
+        self._gens = {}
+        self._inflight = {}
+
+    @staticmethod
+    def sizeof(rs):
+        """
+        Return the approximate bytes taken by the rows ``rs``.
+        """
+        getsizeof = sys.getsizeof
+        nbytes = getsizeof(rs)
+        for r in rs:
+            nbytes += getsizeof(r)
+            for v in isinstance(r, dict) and r.itervalues() or r:
+                nbytes += getsizeof(v)
+        return nbytes
+
+    def forget(self, table):
+        """
+        Drop the results read from ``table``, a ``(db, name)`` pair. They
+        are no longer found and age out of the LRU; results in flight
+        are not stored.
+        """
+        self.invalidations += 1
+        self._gens[table] = self._gens.get(table, 0) + 1
+
+    def run(self, table, key, f, *args):
+        """
+        Return a Deferred firing with the cached result of ``key`` read
+        from ``table``, or with the result of ``f(*args)``, then cached.
+        """
+        gen = self._gens.get(table, 0)
+        key = (table, gen, key)
+        try:
+            rs = self.lru.get(key)
+        except TypeError:
+            # unhashable arguments
+            return defer.maybeDeferred(f, *args)
+        if rs is not None:
+            return defer.succeed(rs)
+
+        waiting = self._inflight.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+        waiting = self._inflight[key] = []
+
+        def done(rs):
+            del self._inflight[key]
+            if gen == self._gens.get(table, 0):
+                self.lru.set(key, rs)
+            for d in waiting:
+                d.callback(rs)
+            return rs
+
+        def failed(f):
+            del self._inflight[key]
+            for d in waiting:
+                d.errback(f)
+            return f
+
+        d = defer.maybeDeferred(f, *args)
+        d.addCallbacks(done, failed)
+        return d
+
+    def info(self):
+        info = self.lru.info()
+        info.update({"coalesced": self.coalesced,
+                     "invalidations": self.invalidations,
+                     "inflight": len(self._inflight)})
+        return info
+
+
+class WriteBehind(object):
+    """
+    Holds the updates that ``save()`` makes to a model's rows and writes
+    them in batches, one transaction per flush.
+
+    Changes to the same row are merged, later values winning, so a row
+    saved many times between flushes is written once. A flush runs
+    ``delay`` seconds after the first pending save, or as soon as
+    ``max_rows`` rows are pending. Flushes run one at a time, in order.
+    """
+
+    def __init__(self, model, delay, max_rows=1000, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.model = model
+        self.delay = delay
+        self.max_rows = max_rows
+        self.clock = clock
+        self.saves = self.coalesced = self.flushes = 0
+        self.rows = self.failures = 0
+        self._pending = {}
+        self._timer = None
+        self._lock = defer.DeferredLock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, id, changes):
+        """
+        Queue ``changes`` (encoded column values) for row ``id``. Returns
+        a Deferred that fires once they are committed.
+        """
+        self.saves += 1
+        entry = self._pending.get(id)
+        if entry is None:
+            entry = self._pending[id] = ({}, [])
+        else:
+            self.coalesced += 1
+        entry[0].update(changes)
+        d = defer.Deferred()
+        entry[1].append(d)
+
+        if len(self._pending) >= self.max_rows:
+            self.flush().addErrback(lambda f: None)
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.delay, self._expired)
+        return d
+
+    def _expired(self):
+        self._timer = None
+        # failures are reported to the Deferreds of the saves
+        self.flush().addErrback(lambda f: None)
+
+    def flush(self):
+        """
+        Write all pending changes now. Returns a Deferred firing with the
+        number of rows written once they, and any earlier flush, are
+        committed.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        return self._lock.run(self._write, batch)
+
+    def _write(self, batch):
+        if not batch:
+            return defer.succeed(0)
+
+        model = self.model
+        groups = {}
+        for id, (changes, ds) in batch.items():
+            keys = tuple(sorted(changes))
+            groups.setdefault(keys, []).append(
+                [changes[k] for k in keys] + [id])
+
+        def build(keys):
+            return "update %s set %s where id=%%s" % (
+                model.__table__(), ",".join(["%s=%%s" % k for k in keys]))
+
+        def _write_behind_transaction(trans):
+            for keys, args in groups.items():
+                q = model._sql(("update", keys, "id=%s", None), build, keys)
+                trans.executemany(q, args)
+
+        def forget(result):
+            for id in batch:
+                model._forget_rows(("id=%s", id))
+            return result
+
+        def done(result):
+            self.flushes += 1
+            self.rows += len(batch)
+            for changes, ds in batch.values():
+                for d in ds:
+                    d.callback(None)
+            return len(batch)
+
+        def failed(f):
+            self.failures += 1
+            for changes, ds in batch.values():
+                for d in ds:
+                    d.errback(f)
+            return f
+
+        forget(None)
+        d = defer.maybeDeferred(model._db().runInteraction,
+                                _write_behind_transaction)
+        d.addBoth(forget)
+        d.addCallbacks(done, failed)
+        return d
+
+    def info(self):
+        return {"saves": self.saves, "coalesced": self.coalesced,
+                "flushes": self.flushes, "rows": self.rows,
+                "failures": self.failures, "pending": len(self._pending),
+                "delay": self.delay, "max_rows": self.max_rows}
+
+
+class Loader(object):
+    """
+    Collects the ids a model's load() is asked for during one reactor
+    turn and reads them on the next, with one ``select ... where id in
+    (...)`` per chunk of ``prefetch_chunk_size`` ids. An id asked for
+    more than once is read once, and its callers share the object.
+    """
+
+    def __init__(self, model, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.model = model
+        self.clock = clock
+        self.loads = self.coalesced = self.batches = self.queries = 0
+        self._pending = {}
+        self._ids = []
+        self._call = None
+
+    def load(self, id):
+        """
+        Return a Deferred firing with the row of ``id``, or None, once
+        the batch it is in has been read.
+        """
+        self.loads += 1
+        waiting = self._pending.get(id)
+        if waiting is None:
+            waiting = self._pending[id] = []
+            self._ids.append(id)
+        else:
+            self.coalesced += 1
+        d = defer.Deferred()
+        waiting.append(d)
+        if self._call is None:
+            self._call = self.clock.callLater(0, self._expired)
+        return d
+
+    def _expired(self):
+        self._call = None
+        # failures are reported to the Deferreds of the loads
+        self.dispatch().addErrback(lambda f: None)
+
+    def dispatch(self):
+        """
+        Read the pending ids now. Returns a Deferred firing with the
+        number of rows found.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        pending, self._pending = self._pending, {}
+        ids, self._ids = self._ids, []
+        if not ids:
+            return defer.succeed(0)
+
+        model = self.model
+        cache = model._row_cache()
+        gen = cache is not None and model._row_cache_gen
+        wheres = list(model._in_chunks("id", ids))
+        self.batches += 1
+        self.queries += len(wheres)
+
+        def done(rs):
+            found = {}
+            for objs in rs:
+                for obj in objs:
+                    found[obj["id"]] = obj
+            if cache is not None and gen == model._row_cache_gen:
+                for id, obj in found.iteritems():
+                    cache.set(id, obj)
+            for id in ids:
+                for d in pending[id]:
+                    d.callback(found.get(id))
+            return len(found)
+
+        def failed(f):
+            f = f.check(defer.FirstError) and f.value.subFailure or f
+            for id in ids:
+                for d in pending[id]:
+                    d.errback(f)
+            return f
+
+        d = defer.gatherResults([model.select(where=where)
+                                 for where in wheres], consumeErrors=True)
+        d.addCallbacks(done, failed)
+        return d
+
+    def info(self):
+        return {"loads": self.loads, "coalesced": self.coalesced,
+                "batches": self.batches, "queries": self.queries,
+                "pending": len(self._ids)}
+
+
+class Columnar(object):
+    """
+    Collects the rows of a select, batch by batch as they are fetched,
+    into one array per column instead of an object per row.
+
+    Integer columns go into ``array("l")``, float columns, and integer
+    columns with NULLs, into ``array("d")`` with NULL as NaN, and other
+    columns into lists. columns() returns them by name, as NumPy arrays
+    if NumPy is installed.
+    """
+    _ints = frozenset([int, long, bool])
+    _floats = _ints | frozenset([float, type(None)])
+    nan = float("nan")
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.data = None
+        self.nrows = 0
+        self._index = None
+
+    def add(self, rs):
+        if not rs:
+            return
+        if self.data is None:
+            # sqlite3.Row repeats id with dialect.star; keep the first
+            names = []
+            index = []
+            for n, k in enumerate(rs[0].keys()):
+                if k not in names:
+                    names.append(k)
+                    index.append(n)
+            self.names = names
+            self._index = index
+            self.data = [None] * len(names)
+
+        if isinstance(rs[0], dict):
+            values = [[r[k] for r in rs] for k in self.names]
+        else:
+            transposed = zip(*rs)
+            values = [transposed[n] for n in self._index]
+
+        data = self.data
+        for n, vs in enumerate(values):
+            data[n] = self._extend(data[n], vs)
+        self.nrows += len(rs)
+
+    def _extend(self, col, values):
+        kinds = set(map(type, values))
+        if isinstance(col, list) or not kinds <= self._floats:
+            if isinstance(col, array.array):
+                col = [v if v == v else None for v in col] \
+                    if col.typecode == "d" else col.tolist()
+            col = col or []
+            col.extend(values)
+            return col
+
+        if kinds <= self._ints and (col is None or col.typecode == "l"):
+            if col is None:
+                col = array.array("l")
+            nrows = len(col)
+            try:
+                col.extend(values)
+                return col
+            except OverflowError:
+                # too big for a C long
+                return self._extend(col.tolist()[:nrows], values)
+
+        if col is None:
+            col = array.array("d")
+        elif col.typecode == "l":
+            col = array.array("d", col)
+        if type(None) in kinds:
+            nan = self.nan
+            values = [v is None and nan or v for v in values]
+        col.extend(values)
+        return col
+
+    def columns(self):
+        """
+        Return ``{name: values}`` for every column.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        data = self.data or [[] for name in self.names]
+        out = {}
+        for name, col in zip(self.names, data):
+            if numpy is None:
+                out[name] = col
+            elif isinstance(col, array.array):
+                out[name] = numpy.frombuffer(col, dtype=col.typecode)
+            else:
+                out[name] = numpy.array(col, dtype=object)
+        return out
+
+
 class DatabaseObject(object):
+    # private attributes that aren't slots go to _extra
+    __slots__ = ("_model", "_changes", "_data", "_decoded", "_related",
+                 "_deferred", "_extra")
+
     def __init__(self, model, row):
         self._model = model
         self._changes = set()
         self._data = {}
+        self._decoded = None
+        self._related = None
+        self._deferred = ()
         for k, v in dict(row).items():
             self.__setattr__(k, v)
 
+    @classmethod
+    def from_row(cls, model, row):
+        """
+        Wrap a row as returned by the driver. Values are already encoded,
+        so they are kept as they are and only decoded when read.
+        """
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, "_model", model)
+        object.__setattr__(obj, "_changes", set())
+        object.__setattr__(obj, "_data",
+                           row if type(row) is dict else dict(row))
+        object.__setattr__(obj, "_decoded", None)
+        object.__setattr__(obj, "_related", None)
+        object.__setattr__(obj, "_deferred", ())
+        return obj
+
     def __setattr__(self, k, v):
         if k[0] == "_":
-            object.__setattr__(self, k, v)
+            try:
+                object.__setattr__(self, k, v)
+            except AttributeError:
+                self._set_extra(k, v)
         else:
             if k in self._data:
                 self._changes.add(k)
 
-            if k in self._model.codecs and \
-                    not isinstance(v, types.StringTypes):
-                self._data[k] = self._model.codecs[k][0](v)
-            else:
-                self._data[k] = v
+            if k in self._model.codecs:
+                if self._decoded:
+                    self._decoded.pop(k, None)
+                if not isinstance(v, types.StringTypes):
+                    v = self._model.codecs[k][0](v)
+
+            self._data[k] = v
+
+    def _set_extra(self, k, v):
+        try:
+            self._extra[k] = v
+        except AttributeError:
+            object.__setattr__(self, "_extra", {k: v})
 
     def __getattr__(self, k):
-        if [0] == "_":
-            object.__getattr__(self, k)
+        if k[0] == "_":
+            if k != "_extra":
+                try:
+                    return self._extra[k]
+                except (AttributeError, KeyError):
+                    pass
+            raise AttributeError(k)
+        elif k in self._model.codecs:
+            decoded = self._decoded
+            if decoded is None:
+                decoded = self._decoded = {}
+            if k not in decoded:
+                decoded[k] = self._model.codecs[k][1](self._value(k))
+            return decoded[k]
         else:
-            return self._model.codecs[k][1](self._data[k]) \
-                   if k in self._model.codecs else self._data[k]
+            try:
+                return self._data[k]
+            except KeyError:
+                return self._value(k)
+
+    def _value(self, k):
+        if k in self._deferred and k not in self._data:
+            raise AttributeError("%s.%s was deferred; load it with "
+                                 "load_deferred()" %
+                                 (self._model.__table__(), k))
+        return self._data[k]
 
     def __setitem__(self, k, v):
         self.__setattr__(k, v)
@@ -114,30 +1696,107 @@ class DatabaseObject(object):
     def get(self, k, default=None):
         return self._data.get(k, default)
 
+    def related(self, name):
+        """
+        Return a Deferred firing with the rows of relation ``name``, as
+        attached by ``select(prefetch=[name])`` or loaded now.
+        """
+        related = getattr(self, "_related", None)
+        if related is not None and name in related:
+            return defer.succeed(related[name])
+
+        d = self._model.prefetch([self], [name])
+        d.addCallback(lambda _: self._related[name])
+        return d
+
+    def load_deferred(self, *names):
+        """
+        Fetch the columns left out of the select that loaded this row,
+        or just ``names``. Returns a Deferred firing with the object.
+        """
+        d = self._model.load_deferred([self], names or None)
+        d.addCallback(lambda _: self)
+        return d
+
+    def _relate(self, name, value):
+        related = getattr(self, "_related", None)
+        if related is None:
+            related = {}
+            object.__setattr__(self, "_related", related)
+        related[name] = value
+
+    def _saved(self):
+        return "id" in self._data
+
+    def _clear_changes(self):
+        self._changes.clear()
+
+    def _forget(self):
+        self._data.pop("id")
+
+    def _refresh(self, row):
+        object.__setattr__(self, "_decoded", None)
+        self._data.update(row)
+
     @defer.inlineCallbacks
     def save(self, force=False):
-        if "id" in self._data:
+        """
+        Insert or update the row. With the model's ``refresh`` set, and
+        a database that supports RETURNING, the values the database
+        stored, defaults included, are read back into the object.
+
+        With the model's ``write_behind`` set, updates made outside of
+        ``db.transaction()`` are queued instead, and the Deferred fires
+        when the model's WriteBehind has committed them; they are not
+        refreshed.
+        """
+        refresh = self._model.refresh and self._model._returning()
+        if self._saved():
+            data = self._data
+            kv = None
+            queue = self._model._write_behind()
+            if queue is not None and self._changes and not force and \
+                    Transaction.current(self._model.db) is None:
+                changes = self._model._clean_row(
+                    dict([(k, data[k]) for k in self._changes]))
+                self._clear_changes()
+                if changes:
+                    yield queue.add(data["id"], changes)
+                defer.returnValue(self)
+
             if self._changes and not force:
-                kv = dict(map(lambda k: (k, self._data[k]), self._changes))
-                kv["where"] = ("id=%s", self._data["id"])
-                yield self._model.update(**kv)
+                kv = dict(map(lambda k: (k, data[k]), self._changes))
+                kv["where"] = ("id=%s", data["id"])
             elif force:
-                k, v = self._data.items()
-                yield self._model.update(set=(k, v),
-                                         where=("id=%s", self._data["id"]))
+                kv = dict(data)
+                kv["where"] = ("id=%s", kv.pop("id"))
+
+            if kv is not None:
+                if refresh:
+                    kv["returning"] = "*"
+                rs = yield self._model.update(**kv)
+                if refresh and rs:
+                    self._refresh(rs[0])
 
-            self._changes.clear()
+            self._clear_changes()
             defer.returnValue(self)
         else:
-            rs = yield self._model.insert(**self._data)
-            self["id"] = rs["id"]
+            kwargs = dict(self._data)
+            # slotted rows keep a None id once deleted
+            if kwargs.get("id", 0) is None:
+                del kwargs["id"]
+            rs = yield self._model.insert(**kwargs)
+            if refresh:
+                self._refresh(rs._data)
+            else:
+                self["id"] = rs["id"]
             defer.returnValue(self)
 
     @defer.inlineCallbacks
     def delete(self):
-        if "id" in self._data:
-            yield self._model.delete(where=("id=%s", self._data["id"]))
-            self._data.pop("id")
+        if self._saved():
+            yield self._model.delete(where=("id=%s", self["id"]))
+            self._forget()
 
         defer.returnValue(self)
 
@@ -145,16 +1804,794 @@ class DatabaseObject(object):
         return repr(self._data)
 
 
+class DatabaseRow(DatabaseObject):
+    """
+    Base class of the row classes generated for each model.
+
+    Columns live in ``__slots__`` instead of a dict, and dirty columns
+    are tracked as bits of ``_dirty`` instead of a set. ``_data`` and
+    ``_changes`` are still available, built on demand. Attributes that
+    are not columns go to the ``_extra`` dict, and the public ones are
+    part of ``_data`` for ``allow`` and ``deny`` to filter.
+    """
+    __slots__ = ("_dirty",)
+
+    _deferred = ()
+    _identifier = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+    _columns = ()
+    _bits = {}
+    _setters = {}
+    _getters = {}
+    _forget_decoded = {}
+
+    @classmethod
+    def subclass(cls, model, columns):
+        """
+        Generate the row class of ``model`` for ``columns``, or return
+        None if the columns can't be used as attribute names.
+        """
+        for col in columns:
+            if not cls._identifier.match(col) or col[0] == "_" or \
+                    hasattr(DatabaseRow, col):
+                return None
+
+        codecs = model.codecs
+        slots = tuple([col in codecs and "_c_" + col or col
+                       for col in columns])
+        # decoded values of codec columns, filled on first read
+        memo = tuple(["_d_" + col for col in columns if col in codecs])
+        rc = type("%sRow" % model.__name__, (cls,),
+                  {"__slots__": slots + memo})
+
+        rc._model = model
+        rc._columns = tuple(columns)
+        rc._bits = dict([(col, 1 << n) for n, col in enumerate(columns)])
+        rc._setters = {}
+        rc._getters = {}
+        rc._forget_decoded = {}
+        for col, slot in zip(columns, slots):
+            rc._setters[col] = rc.__dict__[slot].__set__
+            rc._getters[col] = rc.__dict__[slot].__get__
+            if slot != col:
+                memo = rc.__dict__["_d_" + col]
+                rc._forget_decoded[col] = memo.__delete__
+                setattr(rc, col, property(cls._decoder(
+                    rc._getters[col], codecs[col][1], memo)))
+
+        # a straight-line __init__ is much faster than looping over columns
+        src = ["def __init__(self, row):"]
+        ns = {"_set_dirty": DatabaseRow.__dict__["_dirty"].__set__}
+        for n, col in enumerate(columns):
+            ns["_set%d" % n] = rc._setters[col]
+            src.append("    _set%d(self, row[%r])" % (n, col))
+        src.append("    _set_dirty(self, 0)")
+        exec "\n".join(src) in ns
+        rc.__init__ = ns["__init__"]
+        return rc
+
+    @staticmethod
+    def _decoder(get, decode, memo):
+        def fget(self):
+            try:
+                return memo.__get__(self)
+            except AttributeError:
+                v = decode(get(self))
+                memo.__set__(self, v)
+                return v
+        return fget
+
+    def __setattr__(self, k, v):
+        bit = self._bits.get(k)
+        if bit is None:
+            if k[0] == "_":
+                try:
+                    object.__setattr__(self, k, v)
+                    return
+                except AttributeError:
+                    pass
+            self._set_extra(k, v)
+            return
+
+        if k in self._model.codecs:
+            try:
+                self._forget_decoded[k](self)
+            except AttributeError:
+                pass
+            if not isinstance(v, types.StringTypes):
+                v = self._model.codecs[k][0](v)
+
+        self._setters[k](self, v)
+        object.__setattr__(self, "_dirty", self._dirty | bit)
+
+    def __getattr__(self, k):
+        if k != "_extra":
+            try:
+                return self._extra[k]
+            except (AttributeError, KeyError):
+                pass
+        raise AttributeError(k)
+
+    def __getitem__(self, k):
+        if k not in self._bits:
+            try:
+                return self._extra[k]
+            except AttributeError:
+                raise KeyError(k)
+        return getattr(self, k)
+
+    def get(self, k, default=None):
+        get = self._getters.get(k)
+        if get is None:
+            return getattr(self, "_extra", {}).get(k, default)
+        return get(self)
+
+    @property
+    def _data(self):
+        data = dict([(col, get(self)) for col, get in self._getters.items()])
+        for k, v in getattr(self, "_extra", {}).items():
+            if k[0] != "_":
+                data[k] = v
+        return data
+
+    @property
+    def _changes(self):
+        return set([col for col, bit in self._bits.items()
+                    if self._dirty & bit])
+
+    def _saved(self):
+        return self.get("id") is not None
+
+    def _clear_changes(self):
+        object.__setattr__(self, "_dirty", 0)
+
+    def _forget(self):
+        self._setters["id"](self, None)
+
+    def _refresh(self, row):
+        for k in row.keys():
+            setter = self._setters.get(k)
+            if setter is not None:
+                setter(self, row[k])
+                if k in self._forget_decoded:
+                    try:
+                        self._forget_decoded[k](self)
+                    except AttributeError:
+                        pass
+
+
+class Relation(object):
+    """
+    A relation declared in a model's ``relations``. ``model`` is the
+    related model or its class name. A name shared by several models is
+    resolved within the module of the model declaring the relation.
+    """
+    def __init__(self, model, column=None):
+        self._model = model
+        self.column = column
+
+    @property
+    def model(self):
+        return self.resolve()
+
+    def resolve(self, owner=None):
+        """
+        Return the related model, looking its name up among the models
+        of ``owner``'s module if several models have it.
+        """
+        if isinstance(self._model, types.StringTypes):
+            found = []
+            pending = [DatabaseCRUD]
+            seen = set()
+            while pending:
+                cls = pending.pop()
+                if cls in seen:
+                    continue
+                seen.add(cls)
+                if cls.__name__ == self._model:
+                    found.append(cls)
+                pending.extend(cls.__subclasses__())
+
+            if len(found) > 1 and owner is not None:
+                found = [cls for cls in found
+                         if cls.__module__ == owner.__module__]
+            if not found:
+                raise ValueError("No model named %s" % self._model)
+            elif len(found) > 1:
+                raise ValueError("Ambiguous model name %s: %s" % (
+                    self._model, ", ".join(["%s.%s" % (cls.__module__,
+                                                       cls.__name__)
+                                            for cls in found])))
+            self._model = found[0]
+        return self._model
+
+
+class BelongsTo(Relation):
+    """
+    Each row points to one row of ``model`` through its ``column``
+    (the relation name by default), e.g. ``users.phone``.
+    """
+    many = False
+
+    def key(self, name, obj):
+        return obj.get(self.column or name)
+
+    def target(self, name):
+        return "id"
+
+
+class HasMany(Relation):
+    """
+    Rows of ``model`` point to this one through their ``column``, e.g.
+    ``phones`` has many ``users`` by ``phone``.
+    """
+    many = True
+
+    def key(self, name, obj):
+        return obj.get("id")
+
+    def target(self, name):
+        return self.column
+
+
 class DatabaseCRUD(object):
     db = None
+    replicas = None
+    query_cache = None
     allow = []
     deny = []
     codecs = {}
+    type_codecs = {}
+    relations = {}
+    prefetch_chunk_size = 500
+    columns = None
+    row_slots = True
+    sql_cache_size = 128
+    row_cache_size = 0
+    row_cache_ttl = None
+    count_cache_size = 128
+    count_cache_ttl = None
+    refresh = False
+    write_behind = None
+    write_behind_rows = 1000
+
+    _by_id = re.compile(r"^\s*id\s*=\s*%s\s*$")
+    # statements are also built on pool threads, inside transactions
+    _sql_lock = threading.Lock()
 
     @classmethod
     def __table__(cls):
         return getattr(cls, "table_name", cls.__name__)
 
+    @classmethod
+    def _db(cls):
+        """
+        Return where this model's writes go: the transaction open on
+        ``db`` in this thread, if any, or ``db`` itself.
+        """
+        txn = Transaction.current(cls.db)
+        if txn is None:
+            if cls.replicas is not None:
+                cls.replicas.wrote()
+            cls._forget_results()
+            return cls.db
+
+        # the transaction may run on a pool thread, and the replicas and
+        # caches belong to the reactor's
+        if cls.replicas is not None:
+            txn.after_commit(cls.replicas.wrote)
+        cls._forget_results_on_commit()
+        return txn
+
+    @classmethod
+    def _read(cls, f, *args):
+        """
+        Return ``f(db, *args)``, with ``db`` where this model's reads go:
+        the open transaction, if any, else one of ``replicas`` or ``db``.
+        """
+        txn = Transaction.current(cls.db)
+        if txn is not None:
+            return f(txn, *args)
+        if cls.replicas is None:
+            return f(cls.db, *args)
+        return cls.replicas.run(cls.db, f, *args)
+
+    @classmethod
+    def _query(cls, q, args=()):
+        """
+        Return a Deferred firing with the rows of the select ``q``, read
+        where reads go or from ``query_cache``, outside of transactions.
+        """
+        if args:
+            run = lambda db: db.runQuery(q, args)
+        else:
+            run = lambda db: db.runQuery(q)
+
+        cache = cls.query_cache
+        if cache is None or Transaction.current(cls.db) is not None:
+            return defer.maybeDeferred(cls._read, run)
+
+        d = cache.run((cls.db, cls.__table__()), (q, tuple(args)),
+                      cls._read, run)
+        # the cached rows are shared; give each caller its own
+        d.addCallback(lambda rs: rs and type(rs[0]) is dict and
+                      [dict(r) for r in rs] or list(rs))
+        return d
+
+    @classmethod
+    def _sql(cls, key, build, *args):
+        """
+        Return the SQL for ``key`` from this model's statement cache,
+        calling ``build(*args)`` and converting its placeholders on a miss.
+        """
+        with cls._sql_lock:
+            cache = cls.__dict__.get("_sql_cache")
+            if cache is None:
+                cache = LRUCache(cls.sql_cache_size)
+                cls._sql_cache = cache
+            q = cache.get(key)
+
+        if q is None:
+            q = cls.db.dialect.convert(build(*args))
+            with cls._sql_lock:
+                cache.set(key, q)
+        return q
+
+    @classmethod
+    def sql_cache_info(cls):
+        with cls._sql_lock:
+            cache = cls.__dict__.get("_sql_cache")
+            if cache is None:
+                return LRUCache(cls.sql_cache_size).info()
+            return cache.info()
+
+    @classmethod
+    def _row_cache(cls):
+        """
+        Return this model's identity map of rows by id, or None when
+        ``row_cache_size`` is zero.
+        """
+        cache = cls.__dict__.get("_row_cache_lru")
+        if cache is None:
+            if cls.row_cache_size <= 0:
+                return None
+            cache = LRUCache(cls.row_cache_size, cls.row_cache_ttl)
+            cls._row_cache_lru = cache
+            cls._row_cache_gen = 0
+        return cache
+
+    @classmethod
+    def row_cache_info(cls):
+        cache = cls._row_cache()
+        if cache is None:
+            return LRUCache(0).info()
+        return cache.info()
+
+    @classmethod
+    def _write_behind(cls):
+        """
+        Return this model's WriteBehind queue, or None when
+        ``write_behind`` (the seconds a save may wait) is None.
+        """
+        queue = cls.__dict__.get("_write_behind_queue")
+        if queue is None:
+            if cls.write_behind is None:
+                return None
+            queue = WriteBehind(cls, cls.write_behind, cls.write_behind_rows)
+            cls._write_behind_queue = queue
+            trigger = getattr(queue.clock, "addSystemEventTrigger", None)
+            if trigger is not None:
+                trigger("before", "shutdown", queue.flush)
+        return queue
+
+    @classmethod
+    def flush(cls):
+        """
+        Write the saves queued by ``write_behind`` now. Returns a Deferred
+        firing with the number of rows written.
+        """
+        queue = cls.__dict__.get("_write_behind_queue")
+        if queue is None:
+            return defer.succeed(0)
+        return queue.flush()
+
+    @classmethod
+    def write_behind_info(cls):
+        queue = cls.__dict__.get("_write_behind_queue")
+        if queue is None:
+            return {"saves": 0, "coalesced": 0, "flushes": 0, "rows": 0,
+                    "failures": 0, "pending": 0, "delay": cls.write_behind,
+                    "max_rows": cls.write_behind_rows}
+        return queue.info()
+
+    @classmethod
+    def _count_cache(cls):
+        """
+        Return this model's cache of counts by where clause, or None when
+        ``count_cache_ttl`` is not set.
+        """
+        cache = cls.__dict__.get("_count_cache_lru")
+        if cache is None:
+            if not cls.count_cache_ttl:
+                return None
+            cache = LRUCache(cls.count_cache_size, cls.count_cache_ttl)
+            cls._count_cache_lru = cache
+            cls._count_gen = 0
+        return cache
+
+    @classmethod
+    def count_cache_info(cls):
+        cache = cls._count_cache()
+        if cache is None:
+            return LRUCache(0).info()
+        return cache.info()
+
+    @classmethod
+    def _forget_results(cls):
+        """
+        Drop the cached counts, and the table's entries of
+        ``query_cache``.
+        """
+        cache = cls.__dict__.get("_count_cache_lru")
+        if cache is not None:
+            cls._count_gen += 1
+            cache.clear()
+        if cls.query_cache is not None:
+            cls.query_cache.forget((cls.db, cls.__table__()))
+
+    @classmethod
+    def _forget_results_on_commit(cls, result=None):
+        """
+        Drop the cached counts and query results once the write that
+        fired ``result`` is committed: now, or when the open transaction
+        commits.
+        """
+        if "_count_cache_lru" in cls.__dict__ or \
+                cls.query_cache is not None:
+            txn = Transaction.current(cls.db)
+            if txn is not None:
+                txn.after_commit(cls._forget_results)
+            else:
+                cls._forget_results()
+        return result
+
+    @classmethod
+    def _where_id(cls, where):
+        """
+        Return the id matched by a ``("id=%s", id)`` where clause, or None
+        for any other clause.
+        """
+        if where and len(where) == 2 and cls._by_id.match(where[0]):
+            id = where[1]
+            return id["id"] if isinstance(id, DatabaseObject) else id
+
+    @classmethod
+    def _forget_rows(cls, where, result=None):
+        """
+        Drop the cached rows that ``where`` may touch: one row for a
+        lookup by id, all of them otherwise. Cached counts and query
+        results are dropped.
+        """
+        cls._forget_results()
+        cache = cls.__dict__.get("_row_cache_lru")
+        if cache is not None:
+            cls._row_cache_gen += 1
+            id = cls._where_id(where)
+            if id is None:
+                cache.clear()
+            else:
+                cache.pop(id)
+        return result
+
+    @classmethod
+    def _returning(cls):
+        """
+        Whether the database supports ``insert/update ... returning``.
+        """
+        return cls.db.dialect.returning
+
+    @classmethod
+    def _write(cls, where, q, args=None, returning=False):
+        """
+        Run the write ``q`` and invalidate the cached rows ``where`` may
+        touch. With ``returning``, fire with the rows it returns.
+        """
+        params = args is None and (q,) or (q, args)
+        if returning:
+            return cls._invalidate(where, "runInteraction", _fetch, *params)
+        return cls._invalidate(where, "runOperation", *params)
+
+    @classmethod
+    def _invalidate(cls, where, method, *params):
+        """
+        Call ``db.<method>(*params)`` and drop the cached rows ``where``
+        may touch, after the transaction commits if one is open.
+        """
+        db = cls._db()
+        run = getattr(db, method)
+        cached = "_row_cache_lru" in cls.__dict__ or \
+            "_count_cache_lru" in cls.__dict__ or \
+            cls.query_cache is not None
+        if db is not cls.db:
+            if cached:
+                db.after_commit(cls._forget_rows, where)
+            return run(*params)
+
+        cls._forget_rows(where)
+        d = run(*params)
+        if isinstance(d, defer.Deferred) and cached:
+            # rows read while the write was in flight may be stale
+            d.addCallback(lambda r: cls._forget_rows(where, r))
+        return d
+
+    @classmethod
+    def _write_ids(cls, ids, interaction):
+        """
+        Run ``interaction`` in a transaction and drop the cached rows of
+        ``ids``, after the transaction commits if one is open.
+        """
+        def forget(result=None):
+            cls._forget_results()
+            cache = cls.__dict__.get("_row_cache_lru")
+            if cache is not None:
+                cls._row_cache_gen += 1
+                for id in ids:
+                    cache.pop(id)
+            return result
+
+        db = cls._db()
+        if db is not cls.db:
+            db.after_commit(forget)
+            return defer.maybeDeferred(db.runInteraction, interaction)
+
+        forget()
+        d = defer.maybeDeferred(db.runInteraction, interaction)
+        d.addBoth(forget)
+        return d
+
+    @classmethod
+    def _ids(cls, objs):
+        """
+        Return the distinct ids of ``objs``, DatabaseObjects or ids, in
+        order.
+        """
+        ids = []
+        seen = set()
+        for obj in objs:
+            id = obj["id"] if isinstance(obj, DatabaseObject) else obj
+            if id not in seen:
+                seen.add(id)
+                ids.append(id)
+        return ids
+
+    @classmethod
+    def row_class(cls, columns=None):
+        """
+        Return the slotted row class for ``columns`` (by default the
+        model's declared ``columns``), generating it on first use.
+        """
+        columns = tuple(columns or cls.columns or ())
+        if "id" not in columns:
+            columns = ("id",) + columns
+
+        classes = cls.__dict__.get("_row_classes")
+        if classes is None:
+            classes = cls._row_classes = {}
+
+        if columns not in classes:
+            classes[columns] = DatabaseRow.subclass(cls, columns)
+        return classes[columns]
+
+    @classmethod
+    def _wrap(cls, rs, deferred=()):
+        """
+        Turn a list of rows from the driver into DatabaseObjects, missing
+        the ``deferred`` columns.
+        """
+        if not rs:
+            return []
+
+        if deferred:
+            # the deferred columns are added when loaded, so no slots
+            objs = [DatabaseObject.from_row(cls, d) for d in rs]
+            for obj in objs:
+                object.__setattr__(obj, "_deferred", deferred)
+            return objs
+
+        rc = None
+        if cls.row_slots:
+            columns = cls.columns or cls.__dict__.get("_table_columns")
+            if not columns:
+                columns = []
+                for k in rs[0].keys():
+                    if k not in columns:
+                        columns.append(k)
+            rc = cls.row_class(columns)
+
+        if rc is None:
+            return [DatabaseObject.from_row(cls, d) for d in rs]
+        return map(rc, rs)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def prefetch(cls, objs, names):
+        """
+        Load relations ``names`` of ``objs`` with one ``in (...)`` query
+        per relation and chunk, and attach them to each object, where
+        ``related(name)`` returns them: one row or None for BelongsTo,
+        a list for HasMany.
+        """
+        for name in names:
+            rel = cls.relations[name]
+            keys = []
+            seen = set()
+            for obj in objs:
+                k = rel.key(name, obj)
+                if k is not None and k not in seen:
+                    seen.add(k)
+                    keys.append(k)
+
+            column = rel.target(name)
+            found = {}
+            for where in cls._in_chunks(column, keys):
+                rs = yield rel.resolve(cls).select(where=where)
+                for row in rs:
+                    if rel.many:
+                        found.setdefault(row.get(column), []).append(row)
+                    else:
+                        found[row.get(column)] = row
+
+            for obj in objs:
+                k = rel.key(name, obj)
+                if rel.many:
+                    obj._relate(name, found.get(k, []))
+                else:
+                    obj._relate(name, found.get(k))
+
+        defer.returnValue(objs)
+
+    @classmethod
+    def _in_chunks(cls, column, keys):
+        """
+        Yield ``where`` clauses matching ``column`` against ``keys``, at
+        most ``prefetch_chunk_size`` per ``in (...)`` list.
+        """
+        size = cls.prefetch_chunk_size
+        for n in xrange(0, len(keys), size):
+            chunk = keys[n:n + size]
+            # pad to a power of two so the statement cache sees few
+            # distinct "in (...)" lists
+            npad = 1
+            while npad < len(chunk):
+                npad *= 2
+            chunk += chunk[-1:] * (npad - len(chunk))
+            yield ("%s in (%s)" % (column, ",".join(["%s"] * npad)),) + \
+                tuple(chunk)
+
+    @classmethod
+    def table_columns(cls):
+        """
+        Return a Deferred firing with the names of the table's columns:
+        the model's ``columns`` if declared, or else those of an empty
+        select, read once.
+        """
+        if cls.columns:
+            return defer.succeed(tuple(cls.columns))
+        columns = cls.__dict__.get("_table_columns")
+        if columns is not None:
+            return defer.succeed(columns)
+
+        q = cls._sql(("columns",), lambda: "select %s from %s where 1=0" %
+                     (cls.db.dialect.star, cls.__table__()))
+
+        def _columns_interaction(trans):
+            trans.execute(q)
+            names = []
+            for d in trans.description:
+                if d[0] not in names:
+                    names.append(d[0])
+            return tuple(names)
+
+        def _cache(columns):
+            cls._table_columns = columns
+            return columns
+
+        d = defer.maybeDeferred(cls._read, lambda db: db.runInteraction(
+            _columns_interaction))
+        d.addCallback(_cache)
+        return d
+
+    @classmethod
+    def schema(cls):
+        """
+        Return a Deferred firing with the Columns of the table, read from
+        the database catalog on first use. See introspect().
+        """
+        schema = cls.__dict__.get("_schema")
+        if schema is not None:
+            return defer.succeed(schema)
+        d = introspect(cls)
+        d.addCallback(lambda models: cls._schema)
+        return d
+
+    @classmethod
+    def _describe(cls, columns):
+        """
+        Keep the table's ``columns`` as read by introspect(), and pick
+        the codecs of their types from ``type_codecs``.
+        """
+        cls._schema = columns
+        cls._table_columns = tuple([col.name for col in columns])
+        if cls.type_codecs:
+            codecs = {}
+            for col in columns:
+                name = col.type.lower().split("(")[0].strip()
+                if name in cls.type_codecs:
+                    codecs[col.name] = cls.type_codecs[name]
+            codecs.update(cls.codecs)
+            if codecs != cls.codecs:
+                cls.codecs = codecs
+                # generated with the old codecs
+                cls._row_classes = {}
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _projection(cls, kwargs):
+        """
+        Return the columns a select with the ``columns`` (or ``only``) and
+        ``defer`` options reads, id included, and the ones it leaves out.
+        """
+        only = kwargs.get("columns") or kwargs.get("only")
+        skip = kwargs.get("defer") or ()
+        table = yield cls.table_columns()
+        columns = ["id"]
+        for col in only or table:
+            if col not in columns and col not in skip:
+                columns.append(col)
+        deferred = tuple([col for col in table if col not in columns])
+        defer.returnValue((tuple(columns), deferred))
+
+    @classmethod
+    @defer.inlineCallbacks
+    def load_deferred(cls, objs, names=None):
+        """
+        Fetch the deferred columns of ``objs``, or just ``names``, with one
+        ``in (...)`` query per chunk of rows. Returns a Deferred firing
+        with ``objs``.
+        """
+        pending = [obj for obj in objs if obj._deferred and obj._saved()]
+        columns = []
+        for obj in pending:
+            for col in names or obj._deferred:
+                if col not in columns:
+                    columns.append(col)
+
+        if columns:
+            ids = []
+            for obj in pending:
+                if obj["id"] not in ids:
+                    ids.append(obj["id"])
+
+            found = {}
+            for where in cls._in_chunks("id", ids):
+                rs = yield cls.select(where=where, columns=columns,
+                                      raw=True)
+                for row in rs:
+                    found[row["id"]] = row
+
+            for obj in pending:
+                row = found.get(obj["id"])
+                if row is None:
+                    continue
+                for col in columns:
+                    if col in obj._deferred and col in row.keys():
+                        obj._data[col] = row[col]
+                        if obj._decoded:
+                            obj._decoded.pop(col, None)
+                object.__setattr__(obj, "_deferred", tuple([
+                    col for col in obj._deferred if col not in obj._data]))
+
+        defer.returnValue(objs)
+
     @classmethod
     def kwargs_cleanup(cls, kwargs):
         if cls.allow:
@@ -165,6 +2602,13 @@ class DatabaseCRUD(object):
         if deny:
             map(lambda k: kwargs.pop(k, None), deny)
 
+        if cls.__dict__.get("_schema") is not None:
+            columns = cls._table_columns
+            unknown = [k for k in kwargs if k not in columns and k != "id"]
+            if unknown:
+                raise ValueError("%s has no column %s" % (
+                    cls.__table__(), ", ".join(sorted(unknown))))
+
         return kwargs
 
     @classmethod
@@ -172,48 +2616,319 @@ class DatabaseCRUD(object):
     def insert(cls, **kwargs):
         kwargs = cls.kwargs_cleanup(kwargs)
 
-        keys = kwargs.keys()
-        q = "insert into %s (%s) values " % (cls.__table__(),
-                                             ",".join(keys)) + "(%s)"
+        keys = tuple(kwargs.keys())
+        # the id, or the whole row with refresh, comes back in one
+        # statement where RETURNING is supported
+        returning = cls._returning() and (cls.refresh and "*" or "id")
+        q = cls._sql(("insert", keys, returning), lambda:
+                     "insert into %s (%s) values (%s)%s" %
+                     (cls.__table__(), ",".join(keys),
+                      ",".join(["%s"] * len(keys)),
+                      returning and " returning " + returning or ""))
 
-        vs = []
         vd = []
         for v in kwargs.itervalues():
-            vs.append("%s")
             vd.append(v["id"] if isinstance(v, DatabaseObject) else v)
 
-        if isinstance(cls.db, InlineSQLite):
-            vs = ["?"] * len(vs)
-
-        q = q % ",".join(vs)
-
-        if "id" in kwargs:
-            yield cls.db.runOperation(q, vd)
+        if returning:
+            if "id" in kwargs:
+                rs = yield cls._write(("id=%s", kwargs["id"]), q, vd, True)
+            else:
+                rs = yield cls._db().runInteraction(_fetch, q, vd)
+            kwargs.update(dict(rs[0]))
+        elif "id" in kwargs:
+            yield cls._write(("id=%s", kwargs["id"]), q, vd)
         else:
+            dialect = cls.db.dialect
+
             def _insert_transaction(trans, *args, **kwargs):
                 trans.execute(*args, **kwargs)
-                if isinstance(cls.db, InlineSQLite):
-                    trans.execute("select last_insert_rowid() as id")
-                elif cls.db.dbapiName == "MySQLdb":
-                    trans.execute("select last_insert_id() as id")
-                elif cls.db.dbapiName == "psycopg2":
-                    trans.execute("select currval('%s_id_seq') as id" %
-                                  cls.__table__())
-                return trans.fetchall()
-
-            r = yield cls.db.runInteraction(_insert_transaction, q, vd)
-            kwargs["id"] = r[0]["id"]
+                return dialect.last_insert_id(trans)
 
+            kwargs["id"] = yield cls._db().runInteraction(
+                _insert_transaction, q, vd)
+
+        cls._forget_results_on_commit()
         defer.returnValue(DatabaseObject(cls, kwargs))
 
+    @classmethod
+    def _clean_row(cls, row):
+        """
+        Return the columns of ``row`` that ``allow`` and ``deny`` let
+        through, with DatabaseObjects replaced by their ids.
+        """
+        kwargs = cls.kwargs_cleanup(dict(row))
+        for k, v in kwargs.items():
+            if isinstance(v, DatabaseObject):
+                kwargs[k] = v["id"]
+        return kwargs
+
+    @classmethod
+    def _encode_row(cls, row):
+        """
+        Return the columns of ``row`` that ``allow`` and ``deny`` let
+        through, encoded as they are sent to the database.
+        """
+        kwargs = cls._clean_row(row)
+        for k, v in kwargs.items():
+            if k in cls.codecs and not isinstance(v, types.StringTypes):
+                kwargs[k] = cls.codecs[k][0](v)
+        return kwargs
+
+    @classmethod
+    def upsert(cls, conflict, update=None, **kwargs):
+        """
+        Insert a row, or update the one that has the same ``conflict``
+        columns, in one statement. Returns a Deferred firing with its
+        DatabaseObject. See upsert_many().
+        """
+        d = cls.upsert_many([kwargs], conflict, update)
+        d.addCallback(lambda objs: objs[0])
+        return d
+
+    @classmethod
+    def upsert_many(cls, rows, conflict, update=None, chunk_size=500):
+        """
+        Insert rows, updating instead those that match an existing row on
+        the ``conflict`` columns, which need a unique index. ``update``
+        lists the columns to overwrite and defaults to all the others.
+
+        Uses ``on conflict ... do update`` on Postgres and SQLite, and
+        ``on duplicate key update`` on MySQL, with at most ``chunk_size``
+        rows per statement in one transaction. Returns a Deferred firing
+        with the DatabaseObjects, in order, ids included.
+        """
+        conflict = tuple(conflict)
+        items = []
+        groups = {}
+        for row in rows:
+            kwargs = cls._encode_row(row)
+            missing = [k for k in conflict if k not in kwargs]
+            if missing:
+                raise ValueError("Upsert row lacks conflict columns %s" %
+                                 ",".join(missing))
+            items.append(kwargs)
+            groups.setdefault(tuple(sorted(kwargs)), []).append(kwargs)
+
+        if not items:
+            return defer.succeed([])
+
+        dialect = cls.db.dialect
+        table = cls.__table__()
+        refresh = cls.refresh and dialect.returning
+        returning = ""
+        if dialect.returning:
+            returning = " returning " + (refresh and "*" or
+                                         ",".join(("id",) + conflict))
+
+        def _upsert_transaction(trans):
+            found = {}
+            for keys, group in groups.items():
+                cols = [k for k in keys if k not in conflict]
+                if update is not None:
+                    cols = [k for k in cols if k in update]
+                if not cols:
+                    # a no-op update, so the existing row is still returned
+                    cols = conflict[:1]
+
+                # rows repeating a key in one statement are an error on
+                # Postgres; the last one wins
+                order, last = [], {}
+                for kw in group:
+                    key = tuple([kw[k] for k in conflict])
+                    if key not in last:
+                        order.append(key)
+                    last[key] = kw
+                unique = [last[key] for key in order]
+
+                size = chunk_size
+                if dialect.max_variables:
+                    size = max(1, min(size, dialect.max_variables /
+                                      max(1, len(keys))))
+
+                for n in xrange(0, len(unique), size):
+                    chunk = unique[n:n + size]
+                    vd = []
+                    for kw in chunk:
+                        vd.extend([kw[k] for k in keys])
+
+                    q = cls._sql(("upsert", keys, conflict, tuple(cols),
+                                  len(chunk), returning), lambda:
+                                 dialect.upsert(table, keys, conflict, cols,
+                                                len(chunk)) + returning)
+                    trans.execute(q, vd)
+                    if dialect.returning:
+                        rs = trans.fetchall()
+                    else:
+                        rs = cls._conflict_ids(trans, dialect, conflict,
+                                               chunk)
+
+                    # the database may store other values than those
+                    # bound, e.g. 123 in a text column
+                    stored = dict([(tuple([r[k] for k in conflict]), r)
+                                   for r in rs])
+                    for kw in chunk:
+                        key = tuple([kw[k] for k in conflict])
+                        if len(chunk) == 1:
+                            found[key] = rs[0]
+                        elif key in stored:
+                            found[key] = stored[key]
+                        else:
+                            found[key] = cls._conflict_row(
+                                trans, dialect, conflict, kw,
+                                refresh and dialect.star or "id")
+            return found
+
+        def _objects(found):
+            objs = []
+            for kw in items:
+                r = found[tuple([kw[k] for k in conflict])]
+                if refresh:
+                    kw = dict(r)
+                else:
+                    kw["id"] = r["id"]
+                objs.append(DatabaseObject.from_row(cls, kw))
+            return objs
+
+        d = defer.maybeDeferred(cls._invalidate, None, "runInteraction",
+                                _upsert_transaction)
+        d.addCallback(_objects)
+        return d
+
+    @classmethod
+    def _conflict_ids(cls, trans, dialect, conflict, chunk):
+        """
+        Select the ids of the rows of ``chunk`` by their ``conflict``
+        columns, where the upsert couldn't return them.
+        """
+        if len(conflict) == 1:
+            where = "%s in (%s)" % (conflict[0],
+                                    ",".join(["%s"] * len(chunk)))
+        else:
+            row = "(%s)" % ",".join(["%s"] * len(conflict))
+            where = "(%s) in (%s)" % (",".join(conflict),
+                                      ",".join([row] * len(chunk)))
+
+        vd = []
+        for kw in chunk:
+            vd.extend([kw[k] for k in conflict])
+
+        q = "select %s from %s where %s" % (",".join(("id",) + conflict),
+                                           cls.__table__(), where)
+        trans.execute(dialect.convert(q), vd)
+        return trans.fetchall()
+
+    @classmethod
+    def _conflict_row(cls, trans, dialect, conflict, kw, columns):
+        """
+        Select the ``columns`` of the row matching ``kw`` on its
+        ``conflict`` columns, as the database compares them.
+        """
+        q = "select %s from %s where %s" % (
+            columns, cls.__table__(),
+            " and ".join(["%s=%%s" % k for k in conflict]))
+        trans.execute(dialect.convert(q), [kw[k] for k in conflict])
+        return trans.fetchall()[0]
+
+    @classmethod
+    def insert_many(cls, rows, chunk_size=500):
+        """
+        Insert many rows using multi-row ``values`` statements of at most
+        ``chunk_size`` rows each, all inside a single transaction.
+
+        Rows that already carry an ``id`` are sent with ``executemany``.
+        Returns a Deferred firing with the new DatabaseObjects, in order.
+        """
+        items = []
+        groups = {}
+        for row in rows:
+            kwargs = cls._encode_row(row)
+            items.append(kwargs)
+            keys = tuple(sorted(kwargs))
+            groups.setdefault(keys, []).append(kwargs)
+
+        if not items:
+            return defer.succeed([])
+
+        def _insert_many_transaction(trans):
+            cls._insert_rows(trans, groups, chunk_size)
+
+        d = defer.maybeDeferred(cls._db().runInteraction,
+                                _insert_many_transaction)
+        d.addCallback(cls._forget_results_on_commit)
+        d.addCallback(lambda _: [DatabaseObject.from_row(cls, kw)
+                                 for kw in items])
+        return d
+
+    @classmethod
+    def _insert_rows(cls, trans, groups, chunk_size):
+        """
+        Insert the encoded rows of ``groups``, lists of rows keyed by
+        their sorted columns, on ``trans``, setting the ``id`` of each.
+        """
+        dialect = cls.db.dialect
+        mark = dialect.mark
+        table = cls.__table__()
+        for keys, group in groups.items():
+            q = "insert into %s (%s) values " % (table, ",".join(keys))
+            row = "(%s)" % ",".join([mark] * len(keys))
+            if "id" in keys:
+                trans.executemany(q + row,
+                                  [[kw[k] for k in keys] for kw in group])
+                continue
+
+            size = chunk_size
+            if not (dialect.returning_many or dialect.many_ids):
+                size = 1
+            elif dialect.max_variables:
+                size = max(1, min(size, dialect.max_variables /
+                                  max(1, len(keys))))
+
+            for n in xrange(0, len(group), size):
+                chunk = group[n:n + size]
+                vd = []
+                for kw in chunk:
+                    vd.extend([kw[k] for k in keys])
+
+                stmt = q + ",".join([row] * len(chunk))
+                if dialect.returning_many:
+                    trans.execute(stmt + " returning id", vd)
+                    ids = [r["id"] for r in trans.fetchall()]
+                else:
+                    trans.execute(stmt, vd)
+                    ids = dialect.inserted_ids(trans, len(chunk))
+
+                for kw, id in zip(chunk, ids):
+                    kw["id"] = id
+
     @classmethod
     def update(cls, **kwargs):
+        """
+        Update the rows matching ``where``, or all of them. With
+        ``returning`` ("*" or a list of columns) it fires with the
+        updated rows, on databases that support RETURNING.
+        """
         where = kwargs.pop("where", None)
+        returning = kwargs.pop("returning", None)
         kwargs = cls.kwargs_cleanup(kwargs)
+        clause = where
 
-        keys = kwargs.keys()
+        if returning is True:
+            returning = "*"
+        if returning and not cls._returning():
+            raise ValueError("RETURNING is not supported by this database")
+
+        keys = tuple(kwargs.keys())
         vals = [kwargs[k] for k in keys]
-        keys = ",".join(["%s=%s" % (k, "%s") for k in keys])
+
+        def build(where):
+            q = "update %s set %s" % (cls.__table__(),
+                                      ",".join(["%s=%%s" % k for k in keys]))
+            if where:
+                q += " where %s" % where
+            if returning:
+                q += " returning %s" % returning
+            return q
 
         if where:
             where, args = where[0], list(where[1:])
@@ -223,37 +2938,148 @@ class DatabaseCRUD(object):
                 else:
                     vals.append(arg)
 
-            return cls.db.runOperation("update %s set %s where %s" %
-                                       (cls.__table__(), keys, where), vals)
-        else:
-            return cls.db.runOperation("update %s set %s" %
-                                       (cls.__table__(), keys), vals)
+        q = cls._sql(("update", keys, where, returning), build, where)
+        return cls._write(clause, q, vals, bool(returning))
 
     @classmethod
-    @defer.inlineCallbacks
-    def select(cls, **kwargs):
-        extra = []
-        star = "id,*" if isinstance(cls.db, InlineSQLite) else "*"
+    def update_many(cls, objs, **changes):
+        """
+        Set ``changes`` on the rows of ``objs``, DatabaseObjects or ids,
+        with one ``update ... where id in (...)`` per chunk of
+        ``prefetch_chunk_size`` rows, all in one transaction. The objects
+        get the new values. Returns a Deferred firing with the number of
+        rows updated.
+        """
+        changes = cls._encode_row(changes)
+        changes.pop("id", None)
+        ids = cls._ids(objs)
+        if not ids or not changes:
+            return defer.succeed(0)
+
+        keys = tuple(sorted(changes))
+        vals = [changes[k] for k in keys]
+
+        def build(where):
+            return "update %s set %s where %s" % (
+                cls.__table__(), ",".join(["%s=%%s" % k for k in keys]),
+                where)
+
+        queries = [(cls._sql(("update", keys, where[0], None), build,
+                             where[0]), vals + list(where[1:]))
+                   for where in cls._in_chunks("id", ids)]
+
+        def _update_many_transaction(trans):
+            nrows = 0
+            for q, args in queries:
+                trans.execute(q, args)
+                nrows += trans.rowcount
+            return nrows
+
+        def _refresh(nrows):
+            for obj in objs:
+                if isinstance(obj, DatabaseObject):
+                    obj._refresh(changes)
+            return nrows
+
+        d = cls._write_ids(ids, _update_many_transaction)
+        d.addCallback(_refresh)
+        return d
+
+    @classmethod
+    def save_all(cls, objs, chunk_size=500):
+        """
+        Save ``objs`` in one transaction: the changes of saved objects
+        with one ``executemany`` per set of changed columns, and the new
+        ones as insert_many() does. Unlike save(), it neither queues for
+        ``write_behind`` nor refreshes. Returns a Deferred firing with
+        ``objs``.
+        """
+        updates = {}
+        inserts = {}
+        created = []
+        ids = []
+        for obj in objs:
+            # the values of objects are already encoded
+            if not obj._saved():
+                kwargs = cls._clean_row(obj._data)
+                if kwargs.get("id", 0) is None:
+                    del kwargs["id"]
+                created.append((obj, kwargs))
+                inserts.setdefault(tuple(sorted(kwargs)), []).append(kwargs)
+            elif obj._changes:
+                data = obj._data
+                changes = cls._clean_row(dict([(k, data[k])
+                                               for k in obj._changes]))
+                changes.pop("id", None)
+                if changes:
+                    keys = tuple(sorted(changes))
+                    updates.setdefault(keys, []).append(
+                        [changes[k] for k in keys] + [data["id"]])
+                    ids.append(data["id"])
+
+        if not updates and not inserts:
+            return defer.succeed(objs)
+
+        def build(keys):
+            return "update %s set %s where id=%%s" % (
+                cls.__table__(), ",".join(["%s=%%s" % k for k in keys]))
+
+        def _save_all_transaction(trans):
+            for keys, args in updates.items():
+                q = cls._sql(("update", keys, "id=%s", None), build, keys)
+                trans.executemany(q, args)
+            if inserts:
+                cls._insert_rows(trans, inserts, chunk_size)
+
+        def _saved(result):
+            for obj, kwargs in created:
+                obj["id"] = kwargs["id"]
+            for obj in objs:
+                obj._clear_changes()
+            return objs
+
+        d = cls._write_ids(ids, _save_all_transaction)
+        d.addCallback(_saved)
+        return d
+
+    @classmethod
+    def _select_query(cls, kwargs, columns=None):
+        # keyed by what build() looks at: orderby=None is not left out
+        clauses = tuple([k in kwargs and (kwargs[k],) or None
+                         for k in ("groupby", "orderby", "limit", "offset")])
+        clauses += (kwargs.get("asc") is True, kwargs.get("desc") is True,
+                    columns)
+
+        def build(where):
+            extra = []
+            star = columns and ",".join(columns) or cls.db.dialect.star
 
-        if "groupby" in kwargs:
-            extra.append("group by %s" % kwargs["groupby"])
+            if "groupby" in kwargs:
+                extra.append("group by %s" % kwargs["groupby"])
 
-        if "orderby" in kwargs:
-            extra.append("order by %s" % kwargs["orderby"])
+            if "orderby" in kwargs:
+                extra.append("order by %s" % kwargs["orderby"])
 
-        if "asc" in kwargs and kwargs["asc"] is True:
-            extra.append("asc")
+            if "asc" in kwargs and kwargs["asc"] is True:
+                extra.append("asc")
 
-        if "desc" in kwargs and kwargs["desc"] is True:
-            extra.append("desc")
+            if "desc" in kwargs and kwargs["desc"] is True:
+                extra.append("desc")
 
-        if "limit" in kwargs:
-            extra.append("limit %s" % kwargs["limit"])
+            if "limit" in kwargs:
+                extra.append("limit %s" % kwargs["limit"])
 
-        if "offset" in kwargs:
-            extra.append("offset %s" % kwargs["offset"])
+            if "offset" in kwargs:
+                extra.append("offset %s" % kwargs["offset"])
 
-        extra = " ".join(extra)
+            extra = " ".join(extra)
+
+            if where:
+                return "select %s from %s where %s %s" % \
+                       (star, cls.__table__(), where, extra)
+            else:
+                return "select %s from %s %s" % \
+                       (star, cls.__table__(), extra)
 
         if "where" in kwargs:
             where, args = kwargs["where"][0], list(kwargs["where"][1:])
@@ -261,24 +3087,216 @@ class DatabaseCRUD(object):
                 if isinstance(arg, DatabaseObject):
                     args[n] = arg["id"]
 
-            rs = yield cls.db.runQuery("select %s from %s where %s %s" %
-                                       (star, cls.__table__(), where, extra),
-                                       args)
+            return cls._sql(("select", where, clauses), build, where), args
         else:
-            rs = yield cls.db.runQuery("select %s from %s %s" %
-                                       (star, cls.__table__(), extra))
+            return cls._sql(("select", None, clauses), build, None), ()
 
-        result = map(lambda d: DatabaseObject(cls, d), rs)
-        defer.returnValue(result)
+    @classmethod
+    @defer.inlineCallbacks
+    def select(cls, **kwargs):
+        """
+        Return a Deferred firing with the DatabaseObjects of the rows
+        matching ``where``, or of all rows.
+
+        ``columns=[...]`` (or ``only=[...]``) reads just those columns and
+        ``defer=[...]`` all but those; id is always read. The objects are
+        then partially loaded: reading a column left out raises
+        AttributeError until ``load_deferred()`` fetches it.
+
+        ``as_columns=True`` fires with ``{column: values}`` instead, one
+        array per column, filled from the cursor ``batch_size`` rows at a
+        time; see Columnar.
+        """
+        columns = deferred = ()
+        if kwargs.get("columns") or kwargs.get("only") or \
+                kwargs.get("defer"):
+            columns, deferred = yield cls._projection(kwargs)
+
+        if kwargs.get("as_columns"):
+            result = yield cls._columnar(kwargs, columns)
+            defer.returnValue(result)
+
+        q, args = cls._select_query(kwargs, columns)
+        rs = yield cls._query(q, args)
+
+        if kwargs.get("raw"):
+            # read-only: the driver's own rows, without any wrapping
+            defer.returnValue(rs)
+
+        objs = cls._wrap(rs, deferred)
+        if kwargs.get("prefetch") and objs:
+            yield cls.prefetch(objs, kwargs["prefetch"])
+        defer.returnValue(objs)
+
+    @classmethod
+    def iter_select(cls, callback, batch_size=1000, **kwargs):
+        """
+        Run a select and hand the result to ``callback`` in lists of at
+        most ``batch_size`` DatabaseObjects, without loading it all.
+        With ``raw=True`` the driver's rows are passed as they are.
+
+        The next batch is only fetched after the Deferred returned by
+        ``callback``, if any, has fired. Rows are read from a server-side
+        cursor on MySQL and Postgres. Returns a Deferred firing with the
+        number of rows delivered. Takes the same ``columns`` and ``defer``
+        options as select().
+
+        On SQLite the callback may query the same database between
+        batches. On AdbapiPool the stream holds a pool connection until
+        it ends, so a callback that waits on queries of its own must
+        leave one free: with ``cp_max`` streams at once it never fires.
+        """
+        if kwargs.get("columns") or kwargs.get("only") or \
+                kwargs.get("defer"):
+            d = cls._projection(kwargs)
+            d.addCallback(lambda projection: cls._stream(
+                callback, batch_size, kwargs, *projection))
+            return d
+        return cls._stream(callback, batch_size, kwargs)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _columnar(cls, kwargs, columns=()):
+        result = Columnar()
+        # no callback: the batches are collected where they are fetched
+        yield cls._stream(None, kwargs.get("batch_size", 1000), kwargs,
+                          columns, wrap=result.add)
+        if not result.nrows:
+            result.names = columns or (yield cls.table_columns())
+        defer.returnValue(result.columns())
+
+    @classmethod
+    def _stream(cls, callback, batch_size, kwargs, columns=(), deferred=(),
+                wrap=None):
+        q, args = cls._select_query(kwargs, columns)
+        if wrap is None:
+            if kwargs.get("raw"):
+                wrap = list
+            else:
+                wrap = lambda rs: cls._wrap(rs, deferred)
+
+        from twisted.internet import reactor
+        dialect = cls.db.dialect
+
+        def _cursor(conn):
+            return dialect.stream_cursor(
+                conn, "txdbapi_%s_%x" % (cls.__table__(), id(conn)),
+                batch_size)
+
+        def _iter_select_connection(conn):
+            curs = _cursor(conn)
+            try:
+                curs.execute(q, args)
+                total = 0
+                while True:
+                    rs = curs.fetchmany(batch_size)
+                    if not rs:
+                        break
+
+                    total += len(rs)
+                    batch = wrap(rs)
+                    if callback is not None:
+                        threads.blockingCallFromThread(reactor,
+                                                       defer.maybeDeferred,
+                                                       callback, batch)
+                return total
+            finally:
+                curs.close()
+
+        def _iter_select(db):
+            if isinstance(db, ThreadedSQLite):
+                # a worker call per batch, leaving the worker free for
+                # the queries of the callback in between
+                run = db.runWithConnection
+            elif isinstance(db, (Transaction, InlineSQLite)):
+                run = lambda f: f(db.conn)
+            else:
+                return db.runWithConnection(_iter_select_connection)
+            return cls._iter_batches(run, _cursor, callback, batch_size,
+                                     wrap, q, args)
+
+        return cls._read(_iter_select)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _iter_batches(cls, run, cursor, callback, batch_size, wrap, q,
+                      args):
+        """
+        Hand the rows of ``q`` to ``callback`` in batches fetched by
+        separate calls of ``run(f)``, which calls ``f(conn)``, from the
+        ``cursor(conn)`` it is run on.
+        """
+        def _open(conn):
+            curs = cursor(conn)
+            try:
+                curs.execute(q, args)
+            except:
+                curs.close()
+                raise
+            return curs
+
+        curs = yield run(_open)
+        try:
+            total = 0
+            while True:
+                rs = yield run(lambda conn: curs.fetchmany(batch_size))
+                if not rs:
+                    break
+
+                total += len(rs)
+                batch = wrap(rs)
+                if callback is not None:
+                    yield callback(batch)
+        finally:
+            yield run(lambda conn: curs.close())
+
+        defer.returnValue(total)
 
     @classmethod
     def delete(cls, **kwargs):
         if "where" in kwargs:
             where, args = kwargs["where"][0], kwargs["where"][1:]
-            return cls.db.runOperation("delete from %s where %s" %
-                                       (cls.__table__(), where), args)
+            q = cls._sql(("delete", where), lambda:
+                         "delete from %s where %s" % (cls.__table__(), where))
+            return cls._write(kwargs["where"], q, args)
         else:
-            return cls.db.runOperation("delete from %s" % cls.__table__())
+            q = cls._sql(("delete", None), lambda:
+                         "delete from %s" % cls.__table__())
+            return cls._write(None, q)
+
+    @classmethod
+    def delete_many(cls, objs):
+        """
+        Delete the rows of ``objs``, DatabaseObjects or ids, with one
+        ``delete ... where id in (...)`` per chunk of
+        ``prefetch_chunk_size`` rows, all in one transaction. Returns a
+        Deferred firing with the number of rows deleted.
+        """
+        ids = cls._ids(objs)
+        if not ids:
+            return defer.succeed(0)
+
+        queries = [(cls._sql(("delete", where[0]), lambda where:
+                             "delete from %s where %s" % (cls.__table__(),
+                                                          where), where[0]),
+                    where[1:]) for where in cls._in_chunks("id", ids)]
+
+        def _delete_many_transaction(trans):
+            nrows = 0
+            for q, args in queries:
+                trans.execute(q, args)
+                nrows += trans.rowcount
+            return nrows
+
+        def _forget(nrows):
+            for obj in objs:
+                if isinstance(obj, DatabaseObject) and obj._saved():
+                    obj._forget()
+            return nrows
+
+        d = cls._write_ids(ids, _delete_many_transaction)
+        d.addCallback(_forget)
+        return d
 
     def __str__(self):
         return str(self.data)
@@ -288,16 +3306,57 @@ class DatabaseModel(DatabaseCRUD):
     @classmethod
     @defer.inlineCallbacks
     def count(cls, **kwargs):
-        if "where" in kwargs:
-            where, args = kwargs["where"][0], kwargs["where"][1:]
-            rs = yield cls.db.runQuery("select count(*) as count from %s"
-                                       "where %s" %
-                                       (cls.__table__(), where), args)
-        else:
-            rs = yield cls.db.runQuery("select count(*) as count from %s" %
-                                       cls.__table__())
+        """
+        Return a Deferred firing with the number of rows matching
+        ``where``, or of all rows.
+
+        With ``count_cache_ttl`` set, counts made outside of transactions
+        are cached for that many seconds per where clause, until a write
+        through this model. With ``approximate=True`` and no ``where``,
+        the row estimate of the planner statistics is used instead, where
+        the database has one; it is as fresh as the last ANALYZE.
+        """
+        where = kwargs.get("where")
+        approximate = kwargs.get("approximate") and not where
+        cache = None
+        if Transaction.current(cls.db) is None:
+            cache = cls._count_cache()
+        if cache is not None:
+            key = (approximate,) + tuple([
+                arg["id"] if isinstance(arg, DatabaseObject) else arg
+                for arg in where or ()])
+            try:
+                n = cache.get(key)
+            except TypeError:
+                # unhashable arguments
+                cache = None
+            else:
+                if n is not None:
+                    defer.returnValue(n)
+                gen = cls._count_gen
+
+        n = None
+        if approximate:
+            n = yield cls._read(lambda db: db.runInteraction(
+                cls.db.dialect.estimate_rows, cls.__table__()))
+
+        if n is None:
+            if where:
+                where, args = where[0], where[1:]
+                q = cls._sql(("count", where), lambda:
+                             "select count(*) as count from %s where %s" %
+                             (cls.__table__(), where))
+                rs = yield cls._query(q, args)
+            else:
+                q = cls._sql(("count", None), lambda:
+                             "select count(*) as count from %s" %
+                             cls.__table__())
+                rs = yield cls._query(q)
+            n = rs[0]["count"]
 
-        defer.returnValue(rs[0]["count"])
+        if cache is not None and gen == cls._count_gen:
+            cache.set(key, n)
+        defer.returnValue(n)
 
     @classmethod
     def all(cls):
@@ -307,9 +3366,169 @@ class DatabaseModel(DatabaseCRUD):
     def find(cls, **kwargs):
         return cls.select(**kwargs)
 
+    @classmethod
+    def paginate(cls, order_by="id", after=None, page_size=100, desc=False,
+                 **kwargs):
+        """
+        Return a Deferred firing with ``(objs, token)``: the page of at
+        most ``page_size`` rows ordered by ``order_by`` and then ``id``
+        that follows the page ``after`` came from, and the token of the
+        next page, or None on the last one.
+
+        Pages are found with a seek predicate on ``(order_by, id)``
+        instead of an offset, so every page costs about the same given an
+        index on those columns, and rows inserted meanwhile don't shift
+        the pages. ``order_by`` must be a column that is never null.
+        Other arguments, like ``where``, go to select().
+        """
+        cols = order_by == "id" and ("id",) or (order_by, "id")
+        order = desc and " desc" or ""
+        # the page token needs the order columns
+        only = kwargs.pop("only", None) or kwargs.get("columns")
+        if only:
+            kwargs["columns"] = list(only) + [c for c in cols
+                                              if c not in only]
+        if kwargs.get("defer"):
+            kwargs["defer"] = [c for c in kwargs["defer"] if c not in cols]
+        kwargs["orderby"] = ", ".join([c + order for c in cols])
+        kwargs["limit"] = page_size + 1
+        for k in ("asc", "offset"):
+            kwargs.pop(k, None)
+
+        if after is not None:
+            key = list(cls._page_key(after, order_by, desc))
+            seek = cls._seek(cols, desc and "<" or ">", key)
+            if "where" in kwargs:
+                where = kwargs["where"]
+                kwargs["where"] = ("(%s) and %s" % (where[0], seek),) + \
+                    tuple(where[1:]) + tuple(key)
+            else:
+                kwargs["where"] = (seek,) + tuple(key)
+
+        def _page(objs):
+            if len(objs) <= page_size:
+                return objs, None
+            objs = objs[:page_size]
+            return objs, cls.page_token(objs[-1], order_by, desc)
+
+        d = cls.select(**kwargs)
+        d.addCallback(_page)
+        return d
+
+    @classmethod
+    def page_token(cls, obj, order_by="id", desc=False):
+        """
+        Return the token of the page that follows ``obj``.
+        """
+        key = [obj.get(order_by)]
+        if order_by != "id":
+            key.append(obj.get("id"))
+        token = json.dumps([order_by, bool(desc), key], default=str)
+        return base64.urlsafe_b64encode(token)
+
+    @classmethod
+    def _seek(cls, cols, op, key):
+        """
+        Return the predicate for rows past ``key`` on ``cols``, adjusting
+        ``key`` to its placeholders.
+        """
+        if len(cols) == 1:
+            return "%s %s %%s" % (cols[0], op)
+        elif not cls.db.dialect.row_values:
+            key.insert(1, key[0])
+            return "(%s %s %%s or (%s = %%s and id %s %%s))" % \
+                (cols[0], op, cols[0], op)
+        return "(%s) %s (%s)" % (", ".join(cols), op,
+                                 ", ".join(["%s"] * len(cols)))
+
+    @classmethod
+    def _page_key(cls, token, order_by, desc):
+        try:
+            o, d, key = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid page token %r" % token)
+
+        if o != order_by or d != bool(desc):
+            raise ValueError("Page token is for order_by=%r, desc=%r" %
+                             (o, d))
+        return key
+
+    @classmethod
+    def get(cls, id):
+        """
+        Return a Deferred firing with the row whose id is ``id``, or None.
+
+        With ``row_cache_size`` set, rows are kept in a per-model identity
+        map: repeated lookups return the same object without a query until
+        ``save()``, ``delete()``, ``update()`` or ``delete(where=...)`` on
+        this model invalidates it, or ``row_cache_ttl`` seconds pass.
+        Writes made through raw SQL or another model are not seen.
+        """
+        if isinstance(id, DatabaseObject):
+            id = id["id"]
+
+        # uncommitted rows of a transaction are not cached
+        cache = None
+        if Transaction.current(cls.db) is None:
+            cache = cls._row_cache()
+        if cache is not None:
+            obj = cache.get(id)
+            if obj is not None:
+                return defer.succeed(obj)
+            gen = cls._row_cache_gen
+
+        def _cache(rs):
+            obj = rs[0] if rs else None
+            if cache is not None and obj is not None and \
+                    gen == cls._row_cache_gen:
+                cache.set(id, obj)
+            return obj
+
+        d = cls.select(where=("id=%s", id), limit=1)
+        d.addCallback(_cache)
+        return d
+
+    @classmethod
+    def load(cls, id):
+        """
+        Return a Deferred firing with the row whose id is ``id``, or None,
+        like get(), but read together with every other id loaded from
+        this model during the same reactor turn; see Loader. Inside
+        ``db.transaction()`` it is get().
+        """
+        if isinstance(id, DatabaseObject):
+            id = id["id"]
+        if Transaction.current(cls.db) is not None:
+            return cls.get(id)
+
+        cache = cls._row_cache()
+        if cache is not None:
+            obj = cache.get(id)
+            if obj is not None:
+                return defer.succeed(obj)
+
+        loader = cls.__dict__.get("_loader")
+        if loader is None:
+            loader = cls._loader = Loader(cls)
+        return loader.load(id)
+
+    @classmethod
+    def load_info(cls):
+        loader = cls.__dict__.get("_loader")
+        if loader is None:
+            return {"loads": 0, "coalesced": 0, "batches": 0, "queries": 0,
+                    "pending": 0}
+        return loader.info()
+
     @classmethod
     @defer.inlineCallbacks
     def find_first(cls, **kwargs):
+        if cls.row_cache_size > 0:
+            id = cls._where_id(kwargs.get("where"))
+            if id is not None and len(kwargs) == 1:
+                obj = yield cls.get(id)
+                defer.returnValue(obj)
+
         kwargs["limit"] = 1
         rs = yield cls.select(**kwargs)
         defer.returnValue(rs[0] if rs else None)
@@ -317,3 +3536,49 @@ class DatabaseModel(DatabaseCRUD):
     @classmethod
     def new(cls, **kwargs):
         return DatabaseObject(cls, kwargs)
+
+
+def introspect(*models):
+    """
+    Read the columns of the tables of ``models`` from the database
+    catalog, with one query per database, and keep them on each model;
+    see DatabaseCRUD.schema(). Returns a Deferred firing with ``models``.
+
+    Once done, each model rejects unknown columns before sending a
+    write, maps codecs to columns by type with ``type_codecs`` and
+    generates its row class ahead of the first select. Call it at
+    startup, and again after changing the tables.
+    """
+    groups = []
+    for model in models:
+        for db, group in groups:
+            if db is model.db:
+                group.append(model)
+                break
+        else:
+            groups.append((model.db, [model]))
+
+    def _found(found, group):
+        for model in group:
+            columns = found.get(model.__table__())
+            if not columns:
+                raise ValueError("Table %s does not exist" %
+                                 model.__table__())
+            model._describe(columns)
+
+    ds = []
+    for db, group in groups:
+        tables = []
+        for model in group:
+            if model.__table__() not in tables:
+                tables.append(model.__table__())
+        d = defer.maybeDeferred(db.runInteraction, db.dialect.describe,
+                                tables)
+        d.addCallback(_found, group)
+        ds.append(d)
+
+    d = defer.gatherResults(ds, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure
+                 if f.check(defer.FirstError) else f)
+    d.addCallback(lambda r: models)
+    return d